@@ -0,0 +1,88 @@
+"""Helpers shared by the benchmarks.
+
+A benchmark compares the current code with a module as it was at an
+earlier revision, read with ``git show``. The old module is imported as
+a submodule of the package, so its relative imports resolve to the
+current code.
+"""
+import argparse
+import os
+import subprocess
+import sys
+import time
+import types
+
+PACKAGE = "viur.database.datastore"
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def load(revision, path, name):
+	"""Import ``path`` of the repository as it was at ``revision``.
+
+	:type revision: str
+	:param revision: A git revision, e.g. ``"0d59584^"``.
+
+	:type path: str
+	:param path: Path of the module in the repository.
+
+	:type name: str
+	:param name: Name of the module inside the package.
+
+	:rtype: module
+	:returns: The module, or ``None`` if git or the revision is not
+			  available.
+	"""
+	try:
+		source = subprocess.check_output(
+			["git", "show", "%s:%s" % (revision, path)], cwd=ROOT, stderr=subprocess.DEVNULL
+		)
+	except (OSError, subprocess.CalledProcessError):
+		return None
+	module = types.ModuleType("%s.%s" % (PACKAGE, name))
+	module.__package__ = PACKAGE
+	module.__file__ = "%s:%s" % (revision, path)
+	sys.modules[module.__name__] = module
+	exec(compile(source, module.__file__, "exec"), module.__dict__)
+	return module
+
+
+def parser(description, baseline):
+	"""Command line options common to all benchmarks."""
+	arguments = argparse.ArgumentParser(description=description)
+	arguments.add_argument(
+		"--baseline",
+		default=baseline,
+		help="git revision to compare with (default: %(default)s)",
+	)
+	arguments.add_argument(
+		"--repeat", type=int, default=5, help="runs per workload, the best one counts"
+	)
+	return arguments
+
+
+def best_of_each(functions, repeat):
+	"""Seconds of the fastest of ``repeat`` calls of every function.
+
+	The functions are called in turns, so a noisy machine slows all of
+	them alike. ``None`` functions are skipped and get ``None``.
+	"""
+	best = [None if function is None else float("inf") for function in functions]
+	for _ in range(repeat):
+		for index, function in enumerate(functions):
+			if function is None:
+				continue
+			started = time.perf_counter()
+			function()
+			best[index] = min(best[index], time.perf_counter() - started)
+	return best
+
+
+def report(rows):
+	"""Print ``(workload, baseline seconds or None, current seconds)`` rows."""
+	print("%-34s %10s %10s %8s" % ("workload", "baseline", "current", "speedup"))
+	for name, before, after in rows:
+		if before is None:
+			print("%-34s %10s %9.3fs %8s" % (name, "-", after, "-"))
+		else:
+			print("%-34s %9.3fs %9.3fs %7.1fx" % (name, before, after, before / after))
@@ -0,0 +1,100 @@
+"""Benchmark the binary entity codec against the dict/JSON path.
+
+The baseline is the tagged JSON encoding the sqlite driver used before
+the codec::
+
+	python benchmarks/bench_codec.py [--size 20000] [--baseline REV]
+"""
+import datetime
+import json
+
+from _baseline import best_of_each, load, parser, report
+
+from viur.database.datastore import codec
+from viur.database.datastore.entity import Entity
+from viur.database.datastore.geopoint import GeoPoint
+from viur.database.datastore.key import Key
+
+
+def _entity(number):
+	"""An entity with 15 properties of mixed types."""
+	entity = Entity(Key("User", number + 1, project="p"), exclude_from_indexes=["bio"])
+	address = Entity(Key("Address", "a%d" % number, project="p", namespace="ns"))
+	address["street"] = "Main Street"
+	entity.update({
+		"name": "user %d" % number,
+		"email": "u%d@example.com" % number,
+		"age": number % 90,
+		"score": number * 1.5,
+		"active": bool(number % 2),
+		"created": datetime.datetime(2020, 1, 1) + datetime.timedelta(seconds=number),
+		"bio": "x" * 200,
+		"tags": ["a", "b", "c"],
+		"avatar": b"\x00\x01" * 20,
+		"friend": Key("User", number + 2, project="p"),
+		"location": GeoPoint(1.5, 2.5),
+		"none": None,
+		"address": address,
+		"meta": {"k": 1, "at": datetime.datetime(2020, 1, 1, tzinfo=datetime.timezone.utc)},
+		"big": 2 ** 100,
+	})
+	return entity
+
+
+def main():
+	arguments = parser(__doc__.splitlines()[0], baseline="75c4835^")
+	arguments.add_argument("--size", type=int, default=20000)
+	options = arguments.parse_args()
+
+	entities = [_entity(number) for number in range(options.size)]
+	encoded = [codec.encode_entity(entity) for entity in entities]
+	stream = b"".join(codec.encode_entities(entities))
+
+	old = load(options.baseline, "datastore/sqlite.py", "_baseline_sqlite")
+	baseline_encode = baseline_decode = baseline_read_one = None
+	if old is not None:
+		def json_encode(entity):
+			return json.dumps([old._encode_key(entity.key), old._encode_properties(entity)])
+
+		def json_decode(raw):
+			key, data = json.loads(raw)
+			return old._decode_entity(old._decode_key(key), data)
+
+		json_encoded = [json_encode(entity) for entity in entities]
+
+		def baseline_encode():
+			return [json_encode(entity) for entity in entities]
+
+		def baseline_decode():
+			return [json_decode(raw) for raw in json_encoded]
+
+		def baseline_read_one():
+			return [json_decode(raw)["age"] for raw in json_encoded]
+
+		print("average payload: json %d bytes, binary %d bytes" % (
+			sum(len(raw.encode()) for raw in json_encoded) / len(entities),
+			sum(map(len, encoded)) / len(entities),
+		))
+	else:
+		print("average payload: binary %d bytes" % (sum(map(len, encoded)) / len(entities)))
+
+	workloads = [
+		("encode", baseline_encode, lambda: [codec.encode_entity(e) for e in entities]),
+		("decode", baseline_decode, lambda: [codec.decode_entity(r) for r in encoded]),
+		(
+			"read one property (LazyEntity)",
+			baseline_read_one,
+			lambda: [codec.LazyEntity(raw)["age"] for raw in encoded],
+		),
+		("encode_entities stream", None, lambda: b"".join(codec.encode_entities(entities))),
+		("decode_entities stream", None, lambda: list(codec.decode_entities(stream))),
+	]
+	rows = []
+	for name, before, after in workloads:
+		times = best_of_each([before, after], options.repeat)
+		rows.append((name, times[0], times[1]))
+	report(rows)
+
+
+if __name__ == "__main__":
+	main()
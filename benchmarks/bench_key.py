@@ -0,0 +1,82 @@
+"""Benchmark :class:`~.key.Key` on dict and set heavy workloads.
+
+Compares the current key with the one before it became a slotted object
+with a cached hash::
+
+	python benchmarks/bench_key.py [--size 200000] [--baseline REV]
+"""
+import random
+
+from _baseline import best_of_each, load, parser, report
+
+from viur.database.datastore.key import Key
+
+
+def workloads(key_class, size):
+	"""Timed functions for ``key_class``, on ``size`` random keys."""
+	random.seed(1)
+	ids = [random.randint(1, 10 ** 9) for _ in range(size)]
+	keys = [key_class("Kind", id, project="p", namespace="ns") for id in ids]
+	equal_keys = [key_class("Kind", id, project="p", namespace="ns") for id in ids]
+	children = [key_class("Child", "c%d" % id, parent=key) for id, key in zip(ids, keys)]
+	encoded = [key.to_legacy_urlsafe() for key in keys[:size // 10]]
+	encoded = [urlsafe.decode() if isinstance(urlsafe, bytes) else urlsafe for urlsafe in encoded]
+
+	def construct():
+		for id in ids:
+			key_class("Kind", id, project="p")
+
+	def set_lookups():
+		unique = set(keys)
+		return sum(1 for key in equal_keys if key in unique)
+
+	def dict_grouping():
+		counts = {}
+		for child in children:
+			counts[child.parent] = counts.get(child.parent, 0) + 1
+		return len(counts)
+
+	def accessors():
+		return sum(1 for key in keys if key.kind == "Kind" and key.id and not key.is_partial)
+
+	def sort():
+		return sorted(keys, key=lambda key: key.id_or_name)
+
+	def urlsafe_encode():
+		for key in keys[:size // 10]:
+			key.to_legacy_urlsafe()
+
+	def urlsafe_decode():
+		for urlsafe in encoded:
+			key_class.from_legacy_urlsafe(urlsafe)
+
+	return [
+		("construct %d keys" % size, construct),
+		("set of keys, %d lookups" % size, set_lookups),
+		("dict keyed by parent", dict_grouping),
+		("kind/id/is_partial access", accessors),
+		("sort by id_or_name", sort),
+		("to_legacy_urlsafe, %d keys" % (size // 10), urlsafe_encode),
+		("from_legacy_urlsafe, %d keys" % (size // 10), urlsafe_decode),
+	]
+
+
+def main():
+	arguments = parser(__doc__.splitlines()[0], baseline="0d59584^")
+	arguments.add_argument("--size", type=int, default=200000)
+	options = arguments.parse_args()
+
+	current = workloads(Key, options.size)
+	old = load(options.baseline, "datastore/key.py", "_baseline_key")
+	before = [None] * len(current)
+	if old is not None:
+		before = [function for _, function in workloads(old.Key, options.size)]
+	rows = []
+	for (name, after), baseline in zip(current, before):
+		times = best_of_each([baseline, after], options.repeat)
+		rows.append((name, times[0], times[1]))
+	report(rows)
+
+
+if __name__ == "__main__":
+	main()
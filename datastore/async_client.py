@@ -0,0 +1,647 @@
+# Copyright 2020 Andreas H. Kelch
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+"""Client for :mod:`asyncio` applications.
+
+:class:`AsyncClient` mirrors :class:`~.client.Client`, with coroutines
+for everything talking to the backend. Drivers implementing
+:class:`~.driver.AsyncDriver` are used directly; every other driver runs
+on a thread pool through :class:`~.driver.ThreadedAsyncDriver`.
+"""
+import asyncio
+import collections
+import random
+import time
+
+from .batch import Batch, MAX_CHUNK_BYTES, MAX_CHUNK_ENTITIES
+from .client import LIFO, _checked_empty, _checked_keys, _in_order
+from .coalesce import AsyncCoalescer
+from .driver import AsyncDriver, DEFAULT_DRIVER, ThreadedAsyncDriver, get_driver
+from .entity import Entity
+from .helpers import estimate_size
+from .key import Key
+from .query import DEFAULT_PAGE_SIZE, Iterator, Query
+from .transaction import Conflict, Transaction
+
+
+class AsyncBatch(Batch):
+	"""Batch of an :class:`AsyncClient`, used with ``async with``.
+
+	:meth:`put` and :meth:`delete` only buffer mutations, which are sent
+	in chunks by :meth:`commit`.
+	"""
+
+	_stream = False  # sending happens in commit(), put() can't wait
+
+	async def commit(self):
+		"""Send the buffered mutations.
+
+		:raises: :class:`~exceptions.ValueError` if the batch is not
+				 in progress.
+		"""
+		if self._status != self._IN_PROGRESS:
+			raise ValueError("Batch must be in progress to commit()")
+
+		try:
+			await self._client.connect()
+			await self._flush_async()
+		finally:
+			self._status = self._FINISHED
+
+	async def rollback(self):
+		"""Drop the buffered mutations, see :meth:`.Batch.rollback`."""
+		Batch.rollback(self)
+
+	def __enter__(self):
+		raise TypeError("Use 'async with'")
+
+	async def __aenter__(self):
+		await self._client.connect()
+		self.begin()
+		self._client._push_batch(self)
+		return self
+
+	async def __aexit__(self, exc_type, exc_val, exc_tb):
+		try:
+			if exc_type is None:
+				await self.commit()
+			else:
+				await self.rollback()
+		finally:
+			self._client._pop_batch()
+
+	async def _flush_async(self):
+		"""Send all buffered mutations inside one backend transaction."""
+		chunks = self._chunks()
+		self._clear()
+		if not chunks:
+			return
+
+		driver = self._driver
+		try:
+			transaction = await driver.begin()
+			try:
+				await self._validate_async(transaction)
+				for puts, deletes, size in chunks:
+					if puts:
+						await driver.put_multi(puts, transaction=transaction)
+					if deletes:
+						await driver.delete_multi(deletes, transaction=transaction)
+			except BaseException:
+				await driver.rollback(transaction)
+				raise
+			await driver.commit(transaction)
+		finally:
+			self._written(chunks)
+		for puts, deletes, size in chunks:
+			self._chunk_sent(puts, deletes, size)
+
+	async def _validate_async(self, transaction):
+		"""Check the batch can be written, see :meth:`.Batch._validate`."""
+
+
+class AsyncTransaction(AsyncBatch, Transaction):
+	"""Optimistic transaction of an :class:`AsyncClient`.
+
+	Behaves like :class:`~.transaction.Transaction`; :meth:`commit`
+	raises :class:`~.transaction.Conflict` if an entity read in the
+	transaction changed in the meantime.
+	"""
+
+	async def commit(self):
+		try:
+			await super(AsyncTransaction, self).commit()
+		finally:
+			self._end()
+
+	async def rollback(self):
+		try:
+			await super(AsyncTransaction, self).rollback()
+		finally:
+			self._end()
+
+	async def _get_multi(self, keys):
+		"""Read entities as seen by this transaction.
+
+		See :meth:`.Transaction._get_multi`.
+		"""
+		fetch = self._unknown(keys)
+		if fetch:
+			untracked = self._untracked(fetch)
+			if untracked:
+				self._track_versions(untracked, await self._driver.versions(untracked))
+			self._remember(fetch, await self._driver.get_multi(fetch))
+		return self._visible(keys)
+
+	async def _query_results(self, entities):
+		"""Track query results, see :meth:`.Transaction._query_results`."""
+		fetch = self._unknown(entity.key for entity in entities)
+		if fetch:
+			untracked = self._untracked(fetch)
+			if untracked:
+				self._track_versions(untracked, await self._driver.versions(untracked))
+			self._remember(fetch, await self._driver.get_multi(fetch))
+		return self._seen(entities)
+
+	async def _validate_async(self, transaction):
+		if not self._read_versions:
+			return
+		keys = list(self._read_versions)
+		self._check_versions(
+			keys, await self._driver.versions(keys, transaction=transaction)
+		)
+
+
+class AsyncIterator(Iterator):
+	"""Query results of an :class:`AsyncClient`.
+
+	Use ``async for`` over the iterator for the results, or over
+	:attr:`pages` for the pages.
+	"""
+
+	def __iter__(self):
+		raise TypeError("Use 'async for'")
+
+	@property
+	def pages(self):
+		if self._started:
+			raise ValueError("Iterator has already started", self)
+		self._started = True
+		return self._page_aiter(increment=True)
+
+	def __aiter__(self):
+		if self._started:
+			raise ValueError("Iterator has already started", self)
+		self._started = True
+		return self._items_aiter()
+
+	async def _items_aiter(self):
+		async for page in self._page_aiter(increment=False):
+			for item in page:
+				self.num_results += 1
+				yield item
+
+	async def _page_aiter(self, increment):
+		await self.client.connect()
+		while True:
+			request = self._page_request()
+			if request is None:
+				return
+			cached, fingerprint, token = self._cached_page(request)
+			if cached is not None:
+				results, cursor, more_results, by_key = cached
+				if by_key:
+					results = await self.client.get_multi(results)
+				page = self._page(results, cursor, more_results)
+			else:
+				entities, cursor, more_results = await self.client._driver.run_query(
+					self._query, **request
+				)
+				if self._tracked:
+					entities = await self._transaction._query_results(entities)
+				self._cache_page(fingerprint, token, entities, cursor, more_results)
+				page = self._page(entities, cursor, more_results)
+			self.page_number += 1
+			self.next_page_token = page.next_page_token
+			if increment:
+				self.num_results += page.num_items
+			yield page
+
+
+class AsyncQuery(Query):
+	"""Query of an :class:`AsyncClient`.
+
+	:meth:`fetch` returns an :class:`AsyncIterator` and :meth:`split`
+	is a coroutine.
+	"""
+
+	def fetch(
+		self,
+		limit=None,
+		offset=0,
+		start_cursor=None,
+		end_cursor=None,
+		client=None,
+		eventual=False,
+		page_size=DEFAULT_PAGE_SIZE,
+	):
+		"""Execute the query, see :meth:`.Query.fetch`.
+
+		:rtype: :class:`AsyncIterator`
+		"""
+		if client is None:
+			client = self._client
+
+		return AsyncIterator(
+			self,
+			client,
+			limit=limit,
+			offset=offset,
+			start_cursor=start_cursor,
+			end_cursor=end_cursor,
+			eventual=eventual,
+			page_size=page_size,
+		)
+
+	async def split(self, num_shards, sample_size=None):
+		"""Partition the query, see :meth:`.Query.split`."""
+		if num_shards < 1:
+			raise ValueError("num_shards must be positive", num_shards)
+		if num_shards == 1:
+			return [self._copy()]
+
+		sample_size = sample_size or 8 * num_shards
+		sampler = self._sampler()
+		sample, cursor, stride = [], None, 1
+		while True:
+			iterator = sampler.fetch(limit=1, offset=stride - 1, start_cursor=cursor)
+			keys = [key async for key in iterator]
+			if not keys:
+				break
+			sample.append(keys[0])
+			cursor = iterator.next_page_token
+			if cursor is None:
+				break
+			if len(sample) >= 2 * sample_size:
+				del sample[::2]
+				stride *= 2
+		return self._split_at(sample, num_shards)
+
+
+class AsyncClient(object):
+	"""Datastore client for :mod:`asyncio`.
+
+	Batches and transactions are tracked per :mod:`contextvars` context,
+	so concurrent tasks sharing a client don't see each other's.
+
+	:type project: str
+	:param project: (Optional) The project of the keys.
+
+	:type namespace: str
+	:param namespace: (Optional) The namespace of the keys.
+
+	:type driver: str or :class:`~.driver.AsyncDriver` or :class:`~.driver.Driver`
+	:param driver: (Optional) Registered name or instance of the driver.
+
+	:type driver_options: dict
+	:param driver_options: (Optional) Options of a driver given by name.
+
+	:type chunk_entities: int
+	:param chunk_entities: (Optional) Mutations sent at once.
+
+	:type chunk_bytes: int
+	:param chunk_bytes: (Optional) Estimated bytes sent at once.
+
+	:type max_workers: int
+	:param max_workers: (Optional) Threads running a blocking driver.
+
+	:type cache: :class:`~.cache.EntityCache`
+	:param cache: (Optional) Cache for lookups outside of transactions.
+
+	:type query_cache: :class:`~.cache.QueryCache`
+	:param query_cache: (Optional) Cache for queries outside of
+						transactions.
+
+	:type coalesce: bool
+	:param coalesce: (Optional) Merge the :meth:`get` calls made during
+					 one iteration of the event loop into one lookup, see
+					 :class:`~.coalesce.AsyncCoalescer`.
+
+	:type lookup_chunk_size: int
+	:param lookup_chunk_size: (Optional) Keys per driver call of
+							  :meth:`get_multi`; chunks are fetched
+							  concurrently.
+
+	:type lookup_timeout: float
+	:param lookup_timeout: (Optional) Seconds after which a
+						   :meth:`get_multi` with ``deferred`` stops.
+
+	:type lookup_max_bytes: int
+	:param lookup_max_bytes: (Optional) Estimated bytes after which a
+							 :meth:`get_multi` with ``deferred`` stops.
+	"""
+
+	def __init__(
+		self,
+		project=None,
+		namespace=None,
+		driver=DEFAULT_DRIVER,
+		driver_options=None,
+		chunk_entities=MAX_CHUNK_ENTITIES,
+		chunk_bytes=MAX_CHUNK_BYTES,
+		max_workers=None,
+		cache=None,
+		query_cache=None,
+		coalesce=True,
+		lookup_chunk_size=1000,
+		lookup_timeout=None,
+		lookup_max_bytes=None,
+	):
+		self.project = project
+		self.namespace = namespace
+		self.chunk_entities = chunk_entities
+		self.chunk_bytes = chunk_bytes
+		self.transaction_stats = collections.Counter()
+		self.cache = cache
+		self.query_cache = query_cache
+		self.shared_cache = None  # blocking, would stall the event loop
+		self.coalescer = AsyncCoalescer(self.get_multi) if coalesce else None
+		self.lookup_chunk_size = lookup_chunk_size
+		self.lookup_timeout = lookup_timeout
+		self.lookup_max_bytes = lookup_max_bytes
+
+		self._batch_stack = LIFO()
+
+		if isinstance(driver, str):
+			driver = get_driver(driver, **(driver_options or {}))
+		if not isinstance(driver, AsyncDriver):
+			driver = ThreadedAsyncDriver(driver, max_workers=max_workers)
+		self._driver = driver
+		self._connected = None
+
+	@property
+	def driver(self):
+		"""The :class:`~.driver.AsyncDriver` used by this client."""
+		return self._driver
+
+	async def connect(self):
+		"""Connect the driver; done on first use if not called."""
+		if self._connected is None:
+			self._connected = asyncio.ensure_future(self._driver.connect())
+		try:
+			await self._connected
+		except BaseException:
+			self._connected = None
+			raise
+
+	async def close(self):
+		"""Close the driver; it is connected again on next use."""
+		self._connected = None
+		await self._driver.close()
+
+	async def __aenter__(self):
+		await self.connect()
+		return self
+
+	async def __aexit__(self, exc_type, exc_val, exc_tb):
+		await self.close()
+
+	def _push_batch(self, batch):
+		self._batch_stack.push(batch)
+
+	def _pop_batch(self):
+		return self._batch_stack.pop()
+
+	@property
+	def current_batch(self):
+		"""Active batch or transaction of the current context, or ``None``."""
+		return self._batch_stack.top
+
+	@property
+	def current_transaction(self):
+		"""Active transaction of the current context, or ``None``."""
+		if isinstance(self.current_batch, Transaction):
+			return self.current_batch
+		return None
+
+	async def get(self, key, missing=None, deferred=None, transaction=None):
+		"""Retrieve an entity, see :meth:`.Client.get`."""
+		if (
+			self.coalescer is not None
+			and missing is None
+			and deferred is None
+			and transaction is None
+			and self.current_transaction is None
+		):
+			return await self.coalescer.get(_checked_keys([key], self.project)[0])
+
+		entities = await self.get_multi(
+			[key], missing=missing, deferred=deferred, transaction=transaction
+		)
+		if entities:
+			return entities[0]
+
+	async def get_multi(self, keys, missing=None, deferred=None, transaction=None):
+		"""Retrieve entities, see :meth:`.Client.get_multi`."""
+		_checked_empty("missing", missing)
+		_checked_empty("deferred", deferred)
+		if not keys:
+			return []
+
+		keys = _checked_keys(keys, self.project)
+		unique = list(dict.fromkeys(keys))
+		await self.connect()
+
+		if transaction is None:
+			transaction = self.current_transaction
+
+		if transaction is not None:
+			entities = await transaction._get_multi(unique)
+		elif self.cache is None:
+			entities = await self._lookup(unique, deferred)
+		else:
+			found, uncached, generation = self.cache.lookup(unique)
+			if uncached:
+				fetched = await self._lookup(uncached, deferred)
+				self.cache.fill(fetched, generation)
+				found.update((entity.key, entity) for entity in fetched)
+			entities = list(found.values())
+
+		return _in_order(keys, entities, missing, deferred or ())
+
+	async def _lookup(self, keys, deferred=None):
+		"""Fetch entities in concurrent chunks, see :meth:`.Client._lookup`."""
+		size = self.lookup_chunk_size
+		if len(keys) <= size:
+			return await self._driver.get_multi(keys)
+
+		chunks = [keys[start:start + size] for start in range(0, len(keys), size)]
+		tasks = [asyncio.ensure_future(self._driver.get_multi(chunk)) for chunk in chunks]
+		try:
+			if deferred is None:
+				results = await asyncio.gather(*tasks)
+				return [entity for result in results for entity in result]
+			return await self._collect(chunks, tasks, deferred)
+		except BaseException:
+			for task in tasks:
+				task.cancel()
+			raise
+
+	async def _collect(self, chunks, tasks, deferred):
+		"""Gather the chunks fetched in time, deferring the others."""
+		started = time.monotonic()
+		await tasks[0]  # always collected, so repeated calls make progress
+		if self.lookup_timeout is not None:
+			timeout = max(0, self.lookup_timeout - (time.monotonic() - started))
+			await asyncio.wait(tasks, timeout=timeout)
+		else:
+			await asyncio.wait(tasks)
+		entities = []
+		fetched_bytes = 0
+		exhausted = False
+		for chunk, task in zip(chunks, tasks):
+			if exhausted or not task.done():
+				exhausted = True
+				task.cancel()
+				deferred.extend(chunk)
+				continue
+			result = task.result()
+			entities.extend(result)
+			if self.lookup_max_bytes is not None:
+				fetched_bytes += sum(estimate_size(entity) for entity in result)
+				exhausted = fetched_bytes >= self.lookup_max_bytes
+		return entities
+
+	async def put(self, entity):
+		"""Save an entity, see :meth:`.Client.put`."""
+		await self.put_multi([entity])
+
+	async def put_multi(self, entities, progress=None):
+		"""Save entities, see :meth:`.Client.put_multi`.
+
+		Outside of a batch the entities are sent right away, in chunks.
+		"""
+		if isinstance(entities, Entity):
+			raise ValueError("Pass a sequence of entities")
+
+		if not entities:
+			return
+
+		current = self.current_batch
+		if current is not None:
+			for entity in entities:
+				current.put(entity)
+			return
+
+		await self.connect()
+		batch = self.batch(progress=progress)
+		batch.begin()
+		for entity in entities:
+			batch.put(entity)
+		await batch.commit()
+
+	async def delete(self, key):
+		"""Delete an entity, see :meth:`.Client.delete`."""
+		await self.delete_multi([key])
+
+	async def delete_multi(self, keys, progress=None):
+		"""Delete entities, see :meth:`.Client.delete_multi`."""
+		if not keys:
+			return
+
+		current = self.current_batch
+		if current is not None:
+			for key in keys:
+				current.delete(key)
+			return
+
+		await self.connect()
+		batch = self.batch(progress=progress)
+		batch.begin()
+		for key in keys:
+			batch.delete(key)
+		await batch.commit()
+
+	async def allocate_ids(self, incomplete_key, num_ids):
+		"""Allocate IDs, see :meth:`.Client.allocate_ids`."""
+		if not incomplete_key.is_partial:
+			raise ValueError(('Key is not partial.', incomplete_key))
+
+		await self.connect()
+		return await self._driver.allocate_ids(incomplete_key, num_ids)
+
+	def key(self, *path_args, **kwargs):
+		"""Create a key with our project, see :meth:`.Client.key`."""
+		if "project" in kwargs:
+			raise TypeError("Cannot pass project")
+		kwargs["project"] = self.project
+		if "namespace" not in kwargs:
+			kwargs["namespace"] = self.namespace
+		return Key(*path_args, **kwargs)
+
+	def batch(self, max_entities=None, max_bytes=None, progress=None):
+		"""Create an :class:`AsyncBatch`, see :meth:`.Client.batch`."""
+		return AsyncBatch(
+			self, max_entities=max_entities, max_bytes=max_bytes, progress=progress
+		)
+
+	def transaction(self, **kwargs):
+		"""Create an :class:`AsyncTransaction`, see :meth:`.Client.transaction`."""
+		return AsyncTransaction(self, **kwargs)
+
+	async def run_in_transaction(
+		self, function, retries=3, backoff=0.05, max_backoff=2.0, read_only=False
+	):
+		"""Await ``function(transaction)``, retrying on conflicts.
+
+		See :meth:`.Client.run_in_transaction`; ``function`` is a
+		coroutine function here.
+		"""
+		await self.connect()
+		stats = self.transaction_stats
+		attempt = 0
+		while True:
+			try:
+				async with self.transaction(read_only=read_only) as transaction:
+					result = await function(transaction)
+			except Conflict:
+				stats["conflicts"] += 1
+				if attempt >= retries:
+					stats["failures"] += 1
+					raise
+				stats["retries"] += 1
+				await asyncio.sleep(
+					random.uniform(0, min(max_backoff, backoff * 2 ** attempt))
+				)
+				attempt += 1
+			else:
+				stats["commits"] += 1
+				return result
+
+	def query(self, **kwargs):
+		"""Create a query, see :meth:`.Client.query`.
+
+		:rtype: :class:`AsyncQuery`
+		"""
+		if "client" in kwargs:
+			raise TypeError("Cannot pass client")
+		if "project" in kwargs:
+			raise TypeError("Cannot pass project")
+		kwargs["project"] = self.project
+		if "namespace" not in kwargs:
+			kwargs["namespace"] = self.namespace
+		return AsyncQuery(self, **kwargs)
+
+	def fetch(
+		self,
+		query,
+		limit=None,
+		offset=0,
+		start_cursor=None,
+		end_cursor=None,
+		page_size=DEFAULT_PAGE_SIZE,
+	):
+		"""Run a query, see :meth:`.Query.fetch`.
+
+		:rtype: :class:`AsyncIterator`
+		"""
+		return AsyncIterator(
+			query,
+			self,
+			limit=limit,
+			offset=offset,
+			start_cursor=start_cursor,
+			end_cursor=end_cursor,
+			page_size=page_size,
+		)
@@ -15,6 +15,13 @@
 # Modifications copyright 2020 Andreas H. Kelch
 #  - removed google dependency
 #
+from .helpers import estimate_size
+
+MAX_CHUNK_ENTITIES = 500
+"""Default maximum number of mutations sent to the backend at once."""
+
+MAX_CHUNK_BYTES = 10 * 1024 * 1024
+"""Default maximum estimated size of the mutations sent at once."""
 
 
 class Batch(object):
@@ -33,11 +40,21 @@ class Batch(object):
 	_FINISHED = 3
 	"""Enum value for _FINISHED status of batch/transaction."""
 
-	def __init__(self, client):
+	_stream = True
+	"""Whether full chunks are sent before :meth:`commit`."""
+
+	def __init__(self, client, max_entities=None, max_bytes=None, progress=None):
 		self._client = client
-		self._mutations = []
+		self._driver = client.driver
+		self._mutations = {}
+		self._mutation_sizes = {}
 		self._partial_key_entities = []
+		self._buffered_bytes = 0
 		self._status = self._INITIAL
+		self.max_entities = max_entities or client.chunk_entities
+		self.max_bytes = max_bytes or client.chunk_bytes
+		self._progress = progress
+		self._chunks_sent = 0
 
 	def current(self):
 		"""Return the topmost batch / transaction, or None."""
@@ -61,6 +78,14 @@ class Batch(object):
 		"""
 		return self._client.namespace
 
+	@property
+	def chunks_sent(self):
+		"""Number of chunks committed to the backend so far.
+
+		:rtype: int
+		"""
+		return self._chunks_sent
+
 	@property
 	def mutations(self):
 		"""Getter for the changes accumulated by this batch.
@@ -68,14 +93,23 @@ class Batch(object):
 		Every batch is committed with a single commit request containing all
 		the work to be done as mutations. Inside a batch, calling :meth:`put`
 		with an entity, or :meth:`delete` with a key, builds up the request by
-		adding a new mutation. This getter returns the protobuf that has been
-		built-up so far.
+		adding a new mutation. Mutations of the same key replace each other,
+		so only the last one is sent. This getter returns the mutations that
+		have been built-up so far and not been sent yet.
+
+		Once ``max_entities`` mutations or ``max_bytes`` (estimated) are
+		buffered, a batch sends them right away as one chunk, so arbitrarily
+		large batches only hold one chunk in memory. Chunks already sent are
+		not undone by :meth:`rollback`.
 
 		:rtype: iterable
-		:returns: The list of :class:`.datastore_pb2.Mutation`
-				  protobufs to be sent in the commit request.
+		:returns: The list of ``("insert", entity)``, ``("upsert", entity)``
+				  and ``("delete", key)`` tuples to be sent in the commit
+				  request.
 		"""
-		return self._mutations
+		return [
+			("insert", entity) for entity in self._partial_key_entities
+		] + list(self._mutations.values())
 
 	def put(self, entity):
 		"""Remember an entity's state to be saved during :meth:`commit`.
@@ -100,8 +134,9 @@ class Batch(object):
 		:param entity: the entity to be saved.
 
 		:raises: :class:`~exceptions.ValueError` if the batch is not in
-				 progress, if entity has no key assigned, or if the key's
-				 ``project`` does not match ours.
+				 progress, if entity has no key assigned, if the key's
+				 ``project`` does not match ours, or if the entity is the
+				 result of a projection query.
 		"""
 		if self._status != self._IN_PROGRESS:
 			raise ValueError("Batch must be in progress to put()")
@@ -109,19 +144,16 @@ class Batch(object):
 		if entity.key is None:
 			raise ValueError("Entity must have a key")
 
+		if entity.is_projection:
+			raise ValueError("Cannot put the result of a projection query", entity.key)
+
 		if self.project != entity.key.project:
 			raise ValueError("Key must be from same project as batch")
 
-		#if entity.key.is_partial:
-		#	entity_pb = self._add_partial_key_entity_pb()
-		#	self._partial_key_entities.append(entity)
-		#else:
-		#	entity_pb = self._add_complete_key_entity_pb()
-
-		#_assign_entity_to_pb(entity_pb, entity)
-
-		from viur.xeno.databases import dbinterface
-		dbinterface.put(entity)
+		if entity.key.is_partial:
+			self._add_partial_key_entity(entity)
+		else:
+			self._add_complete_key_entity(entity)
 
 	def delete(self, key):
 		"""Remember a key to be deleted during :meth:`commit`.
@@ -142,11 +174,7 @@ class Batch(object):
 		if self.project != key.project:
 			raise ValueError("Key must be from same project as batch")
 
-		#key_pb = key.to_protobuf()
-		#self._add_delete_key_pb().CopyFrom(key_pb)
-
-		from viur.xeno.databases import dbinterface
-		dbinterface.delete(key)
+		self._add_delete_key(key)
 
 	def begin(self):
 		"""Begins a batch.
@@ -163,11 +191,6 @@ class Batch(object):
 			raise ValueError("Batch already started previously.")
 		self._status = self._IN_PROGRESS
 
-		from viur.xeno.databases import dbinterface
-		dbinterface.transaction_start()
-		dbinterface.transaction_rollback()
-
-
 	def commit(self):
 		"""Commits the batch.
 
@@ -182,15 +205,16 @@ class Batch(object):
 			raise ValueError("Batch must be in progress to commit()")
 
 		try:
-			from viur.xeno.databases import dbinterface
-			dbinterface.transaction_commit()
+			self._commit()
 		finally:
 			self._status = self._FINISHED
 
 	def rollback(self):
 		"""Rolls back the current batch.
 
-		Marks the batch as aborted (can't be used again).
+		Marks the batch as aborted (can't be used again) and drops the
+		buffered mutations. Chunks already sent to the backend because they
+		were full are not undone.
 
 		Overridden by :class:`google.cloud.datastore.transaction.Transaction`.
 
@@ -201,9 +225,7 @@ class Batch(object):
 			raise ValueError("Batch must be in progress to rollback()")
 
 		self._status = self._ABORTED
-
-		from viur.xeno.databases import dbinterface
-		dbinterface.transaction_rollback()
+		self._clear()
 
 	def __enter__(self):
 		self.begin()
@@ -226,55 +248,158 @@ class Batch(object):
 
 		This is called by :meth:`commit`.
 		"""
-		if self._id is None:
-			mode = _datastore_pb2.CommitRequest.NON_TRANSACTIONAL
-		else:
-			mode = _datastore_pb2.CommitRequest.TRANSACTIONAL
+		self._flush()
 
-		commit_response_pb = self._client._datastore_api.commit(
-			self.project, mode, self._mutations, transaction=self._id
-		)
-		_, updated_keys = _parse_commit_response(commit_response_pb)
-		# If the back-end returns without error, we are guaranteed that
-		# ``commit`` will return keys that match (length and
-		# order) directly ``_partial_key_entities``.
-		for new_key_pb, entity in zip(updated_keys, self._partial_key_entities):
-			new_id = new_key_pb.path[-1].id
-			entity.key = entity.key.completed_key(new_id)
+	def _clear(self):
+		"""Drop all buffered mutations."""
+		self._mutations.clear()
+		self._mutation_sizes.clear()
+		del self._partial_key_entities[:]
+		self._buffered_bytes = 0
 
+	def _chunks(self):
+		"""Split the buffered mutations into chunks within the limits.
 
-	def _add_partial_key_entity_pb(self):
-		"""Adds a new mutation for an entity with a partial key.
+		:rtype: list of tuple
+		:returns: ``(puts, deletes, size)`` for every chunk.
+		"""
+		chunks = []
+		puts, deletes, size = [], [], 0
+		mutations = [
+			("insert", entity, estimate_size(entity))
+			for entity in self._partial_key_entities
+		] + [
+			(operation, value, self._mutation_sizes[key])
+			for key, (operation, value) in self._mutations.items()
+		]
+		for operation, value, value_size in mutations:
+			if (puts or deletes) and (
+				len(puts) + len(deletes) >= self.max_entities
+				or size + value_size > self.max_bytes
+			):
+				chunks.append((puts, deletes, size))
+				puts, deletes, size = [], [], 0
+			if operation == "delete":
+				deletes.append(value)
+			else:
+				puts.append(value)
+			size += value_size
+		if puts or deletes:
+			chunks.append((puts, deletes, size))
+		return chunks
+
+	def _flush(self):
+		"""Send all buffered mutations inside one backend transaction.
 
-		:rtype: :class:`.entity_pb2.Entity`
-		:returns: The newly created entity protobuf that will be
-				  updated and sent with a commit.
+		Every chunk is sent with one bulk put and one bulk delete.
 		"""
-		new_mutation = _datastore_pb2.Mutation()
-		self._mutations.append(new_mutation)
-		return new_mutation.insert
+		chunks = self._chunks()
+		self._clear()
+		if not chunks:
+			return
 
-	def _add_complete_key_entity_pb(self):
+		try:
+			transaction = self._driver.begin()
+			try:
+				self._validate(transaction)
+				for puts, deletes, size in chunks:
+					if puts:
+						# The driver completes partial keys in place.
+						self._driver.put_multi(puts, transaction=transaction)
+					if deletes:
+						self._driver.delete_multi(deletes, transaction=transaction)
+			except:  # noqa: E722 do not use bare except, specify exception instead
+				self._driver.rollback(transaction)
+				raise
+			self._driver.commit(transaction)
+		finally:
+			self._written(chunks)
+		for puts, deletes, size in chunks:
+			self._chunk_sent(puts, deletes, size)
+
+	def _chunk_sent(self, puts, deletes, size):
+		"""Count a chunk committed by :meth:`_flush` and report the progress."""
+		self._chunks_sent += 1
+		if self._progress is not None:
+			self._progress(self._chunks_sent, len(puts) + len(deletes), size)
+
+	def _written(self, chunks):
+		"""Invalidate the sent chunks in the client's caches.
+
+		Done after the backend transaction ended, also if it failed, since
+		not every backend can undo writes.
+		"""
+		cache = self._client.cache
+		query_cache = self._client.query_cache
+		shared_cache = self._client.shared_cache
+		if cache is None and query_cache is None and shared_cache is None:
+			return
+		keys = []
+		for puts, deletes, _ in chunks:
+			keys.extend(entity.key for entity in puts)
+			keys.extend(deletes)
+		complete = [key for key in keys if not key.is_partial]
+		if shared_cache is not None:
+			shared_cache.invalidate(complete)
+		if cache is not None:
+			cache.invalidate(complete)
+		if query_cache is not None:
+			query_cache.invalidate(set(key.kind for key in keys))
+
+	def _validate(self, transaction):
+		"""Check the batch can be written, inside the backend transaction.
+
+		Overridden by :class:`google.cloud.datastore.transaction.Transaction`.
+		"""
+
+	def _buffered(self, size):
+		"""Account for a new mutation and send a full chunk."""
+		self._buffered_bytes += size
+		if self._stream and (
+			len(self._mutations) + len(self._partial_key_entities) >= self.max_entities
+			or self._buffered_bytes >= self.max_bytes
+		):
+			self._flush()
+
+	def _add_partial_key_entity(self, entity):
+		"""Adds a new mutation for an entity with a partial key.
+
+		Partial keys have no identity yet, so these are never coalesced.
+
+		:type entity: :class:`google.cloud.datastore.entity.Entity`
+		:param entity: the entity to be inserted.
+		"""
+		self._partial_key_entities.append(entity)
+		self._buffered(estimate_size(entity))
+
+	def _add_mutation(self, key, mutation, size):
+		"""Replace any earlier mutation of ``key`` with ``mutation``."""
+		if key in self._mutations:
+			del self._mutations[key]
+			self._buffered_bytes -= self._mutation_sizes[key]
+		self._mutations[key] = mutation
+		self._mutation_sizes[key] = size
+		self._buffered(size)
+
+	def _add_complete_key_entity(self, entity):
 		"""Adds a new mutation for an entity with a completed key.
 
-		:rtype: :class:`.entity_pb2.Entity`
-		:returns: The newly created entity protobuf that will be
-				  updated and sent with a commit.
+		Replaces any earlier mutation of the same key.
+
+		:type entity: :class:`google.cloud.datastore.entity.Entity`
+		:param entity: the entity to be saved.
 		"""
 		# We use ``upsert`` for entities with completed keys, rather than
 		# ``insert`` or ``update``, in order not to create race conditions
 		# based on prior existence / removal of the entity.
-		new_mutation = _datastore_pb2.Mutation()
-		self._mutations.append(new_mutation)
-		return new_mutation.upsert
+		self._add_mutation(entity.key, ("upsert", entity), estimate_size(entity))
 
-	def _add_delete_key_pb(self):
+	def _add_delete_key(self, key):
 		"""Adds a new mutation for a key to be deleted.
 
-		:rtype: :class:`.entity_pb2.Key`
-		:returns: The newly created key protobuf that will be
-				  deleted when sent with a commit.
+		Replaces any earlier mutation of the same key.
+
+		:type key: :class:`google.cloud.datastore.key.Key`
+		:param key: the key to be deleted.
 		"""
-		new_mutation = _datastore_pb2.Mutation()
-		self._mutations.append(new_mutation)
-		return new_mutation.delete
+		self._add_mutation(key, ("delete", key), estimate_size(key))
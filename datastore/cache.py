@@ -0,0 +1,327 @@
+# Copyright 2020 Andreas H. Kelch
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+"""In-process entity and query caches.
+
+A :class:`~.client.Client` created with an :class:`EntityCache` answers
+lookups outside of transactions from the cache and fills it with the
+entities it had to fetch. Likewise, with a :class:`QueryCache` it answers
+repeated queries with the keys they returned before.
+
+Every batch or transaction invalidates the keys and kinds it wrote once it
+is done, so the caches never outlive a write made through a client sharing
+them. Writes made elsewhere are only picked up after ``ttl``.
+"""
+import collections
+import threading
+import time
+
+from .helpers import copy_entity, estimate_size
+from .key import Key
+
+
+class EntityCache(object):
+	"""Least recently used cache of entities by key.
+
+	Counts ``hits``, ``misses``, ``evictions`` (for room),
+	``expirations`` (after ``ttl``) and ``invalidations`` in :attr:`stats`.
+
+	:type max_entries: int
+	:param max_entries: (Optional) Maximum number of cached entities.
+
+	:type max_bytes: int
+	:param max_bytes: (Optional) Maximum estimated size of the cached
+					  entities.
+
+	:type ttl: float
+	:param ttl: (Optional) Seconds an entity is cached, forever if
+				``None``.
+	"""
+
+	def __init__(self, max_entries=10000, max_bytes=64 * 1024 * 1024, ttl=None):
+		self.max_entries = max_entries
+		self.max_bytes = max_bytes
+		self.ttl = ttl
+		self.stats = collections.Counter()
+		self._entries = collections.OrderedDict()  # key: (entity, size, expires)
+		self._bytes = 0
+		self._generation = 0
+		self._lock = threading.Lock()
+
+	def __len__(self):
+		return len(self._entries)
+
+	@property
+	def num_bytes(self):
+		"""Estimated size of the cached entities."""
+		return self._bytes
+
+	def lookup(self, keys):
+		"""Look up entities.
+
+		:type keys: list of :class:`~.key.Key`
+		:param keys: The keys to look up.
+
+		:rtype: tuple
+		:returns: ``(found, missing, generation)``: a dict of the cached
+				  entities (copies) by key, the keys not cached, each once,
+				  and the token to pass to :meth:`fill` with the entities
+				  fetched for them.
+		"""
+		found = {}
+		missing = []
+		seen = set()
+		now = time.monotonic()
+		with self._lock:
+			generation = self._generation
+			for key in keys:
+				if key in seen:
+					continue
+				seen.add(key)
+				entry = self._entries.get(key)
+				if entry is not None and entry[2] is not None and entry[2] <= now:
+					self._remove(key)
+					self.stats["expirations"] += 1
+					entry = None
+				if entry is None:
+					missing.append(key)
+					continue
+				self._entries.move_to_end(key)
+				found[key] = entry[0]
+			self.stats["hits"] += len(found)
+			self.stats["misses"] += len(missing)
+		found = dict((key, copy_entity(entity)) for key, entity in found.items())
+		return found, missing, generation
+
+	def fill(self, entities, generation):
+		"""Cache entities fetched after a :meth:`lookup`.
+
+		Nothing is cached if any key was invalidated since the lookup, as
+		the entities may have been read before that write.
+
+		:type entities: list of :class:`~.entity.Entity`
+		:param entities: The fetched entities.
+
+		:type generation: int
+		:param generation: The token returned by :meth:`lookup`.
+		"""
+		entries = [(entity.key, copy_entity(entity), estimate_size(entity)) for entity in entities]
+		expires = None if self.ttl is None else time.monotonic() + self.ttl
+		with self._lock:
+			if generation != self._generation:
+				return
+			for key, entity, size in entries:
+				if size > self.max_bytes:
+					continue
+				if key in self._entries:
+					self._remove(key)
+				self._entries[key] = (entity, size, expires)
+				self._bytes += size
+			while len(self._entries) > self.max_entries or self._bytes > self.max_bytes:
+				self._remove(next(iter(self._entries)))
+				self.stats["evictions"] += 1
+
+	def invalidate(self, keys):
+		"""Drop entities, e.g. after they were written.
+
+		:type keys: list of :class:`~.key.Key`
+		:param keys: The keys to drop.
+		"""
+		with self._lock:
+			self._generation += 1
+			for key in keys:
+				if key in self._entries:
+					self._remove(key)
+					self.stats["invalidations"] += 1
+
+	def clear(self):
+		"""Drop all entities."""
+		with self._lock:
+			self._generation += 1
+			self._entries.clear()
+			self._bytes = 0
+
+	def _remove(self, key):
+		_, size, _ = self._entries.pop(key)
+		self._bytes -= size
+
+
+def _freeze(value):
+	"""Hashable form of a filter value.
+
+	Values carry their type, so ``True``, ``1`` and ``1.0``, which compare
+	equal but are indexed differently, never share a fingerprint.
+	"""
+	if isinstance(value, (list, tuple)):
+		return (type(value).__name__,) + tuple(_freeze(item) for item in value)
+	if isinstance(value, dict):
+		return (type(value).__name__,) + tuple(
+			sorted((name, _freeze(item)) for name, item in value.items())
+		)
+	hash(value)  # raises TypeError for other unhashable values
+	return (type(value).__name__, value)
+
+
+def query_fingerprint(query, request):
+	"""Canonical identity of a query page, for :class:`QueryCache`.
+
+	Queries asking for the same results get the same fingerprint, no
+	matter the order their filters were added in.
+
+	:type query: :class:`~.query.Query`
+	:param query: The query.
+
+	:type request: dict
+	:param request: ``limit``, ``offset``, ``start_cursor`` and
+					``end_cursor`` of the page.
+
+	:rtype: tuple
+	:returns: The fingerprint, or ``None`` if a filter value is not
+			  hashable and the query can't be cached.
+	"""
+	try:
+		filters = tuple(sorted(
+			((name, operator, _freeze(value)) for name, operator, value in query.filters),
+			key=lambda item: (item[0], item[1], repr(item[2])),
+		))
+	except TypeError:
+		return None
+	return (
+		query.project,
+		query.namespace,
+		query.kind,
+		query.ancestor,
+		filters,
+		tuple(query.order),
+		tuple(query.projection),
+		tuple(query.distinct_on),
+		request["limit"],
+		request["offset"] or 0,
+		request["start_cursor"],
+		request["end_cursor"],
+	)
+
+
+class QueryCache(object):
+	"""Least recently used cache of query pages.
+
+	Pages are stored with the write generation of their kind, which every
+	batch or transaction writing to the kind bumps; kindless queries use a
+	generation bumped by every write. Whole entities are stored as keys
+	and looked up again, through the :class:`EntityCache` if the client
+	has one, while keys only and projection results are stored as is.
+
+	Counts ``hits``, ``misses``, ``evictions``, ``expirations`` and
+	``stale`` (pages dropped after a write) in :attr:`stats`.
+
+	:type max_entries: int
+	:param max_entries: (Optional) Maximum number of cached pages.
+
+	:type ttl: float
+	:param ttl: (Optional) Seconds a page is cached, forever if ``None``.
+	"""
+
+	def __init__(self, max_entries=1000, ttl=60.0):
+		self.max_entries = max_entries
+		self.ttl = ttl
+		self.stats = collections.Counter()
+		self._entries = collections.OrderedDict()  # fingerprint: (page, token, expires)
+		self._kinds = {}
+		self._generation = 0
+		self._lock = threading.Lock()
+
+	def __len__(self):
+		return len(self._entries)
+
+	def _token(self, kind):
+		if kind is None:
+			return self._generation
+		return self._kinds.get(kind, 0)
+
+	def lookup(self, fingerprint, kind):
+		"""Look up a page.
+
+		:type fingerprint: tuple
+		:param fingerprint: See :func:`query_fingerprint`.
+
+		:type kind: str
+		:param kind: The kind of the query.
+
+		:rtype: tuple
+		:returns: ``(page, token)``: the page ``(results, cursor,
+				  more_results, by_key)`` as given to :meth:`store` or
+				  ``None``, and the token to pass to :meth:`store`.
+		"""
+		now = time.monotonic()
+		with self._lock:
+			token = self._token(kind)
+			entry = self._entries.get(fingerprint)
+			if entry is not None:
+				if entry[1] != token:
+					del self._entries[fingerprint]
+					self.stats["stale"] += 1
+					entry = None
+				elif entry[2] is not None and entry[2] <= now:
+					del self._entries[fingerprint]
+					self.stats["expirations"] += 1
+					entry = None
+			if entry is None:
+				self.stats["misses"] += 1
+				return None, token
+			self._entries.move_to_end(fingerprint)
+			self.stats["hits"] += 1
+		results, cursor, more_results, by_key = entry[0]
+		if not by_key:
+			results = [result if isinstance(result, Key) else copy_entity(result) for result in results]
+		return (results, cursor, more_results, by_key), token
+
+	def store(self, fingerprint, kind, results, cursor, more_results, by_key, token):
+		"""Cache a page fetched after a :meth:`lookup`.
+
+		Nothing is cached if the kind was written since the lookup.
+
+		:type results: list
+		:param results: Keys of the entities if ``by_key``, otherwise the
+						results of the query.
+
+		:type by_key: bool
+		:param by_key: Whether ``results`` are keys of whole entities.
+		"""
+		if not by_key:
+			results = [result if isinstance(result, Key) else copy_entity(result) for result in results]
+		expires = None if self.ttl is None else time.monotonic() + self.ttl
+		with self._lock:
+			if token != self._token(kind):
+				return
+			self._entries[fingerprint] = ((results, cursor, more_results, by_key), token, expires)
+			self._entries.move_to_end(fingerprint)
+			while len(self._entries) > self.max_entries:
+				self._entries.popitem(last=False)
+				self.stats["evictions"] += 1
+
+	def invalidate(self, kinds):
+		"""Mark the cached pages of kinds as stale, e.g. after a write.
+
+		:type kinds: iterable of str
+		:param kinds: The kinds written.
+		"""
+		with self._lock:
+			self._generation += 1
+			for kind in kinds:
+				self._kinds[kind] = self._kinds.get(kind, 0) + 1
+
+	def clear(self):
+		"""Drop all pages."""
+		with self._lock:
+			self._entries.clear()
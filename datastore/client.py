@@ -16,32 +16,190 @@
 #  - removed google dependency
 #
 
+import collections
+import concurrent.futures
+import contextvars
+import functools
+import os
+import random
+import threading
+import time
+
 from .key import Key
 from .entity import Entity
-from .transaction import Transaction
-from .batch import Batch
-from .query import Query
+from .transaction import Conflict, Transaction
+from .batch import Batch, MAX_CHUNK_BYTES, MAX_CHUNK_ENTITIES
+from .query import DEFAULT_PAGE_SIZE, Query
+from .driver import Driver, DEFAULT_DRIVER, get_driver
+from .coalesce import Coalescer
+from .helpers import copy_entity, estimate_size
+
+
+def _checked_empty(name, value):
+	"""Check an output list argument of ``get_multi``."""
+	if value is not None and len(value):
+		raise ValueError("%s must be None or an empty list" % name)
+
+
+def _in_order(keys, entities, missing=None, deferred=()):
+	"""Arrange looked up entities in the order of their keys.
+
+	Keys given more than once get a copy of the entity for every further
+	occurrence. Keys neither found nor in ``deferred`` are reported as
+	key-only entities in ``missing``.
+	"""
+	found = dict((entity.key, entity) for entity in entities)
+	deferred = set(deferred)
+	results = []
+	returned = set()
+	for key in keys:
+		entity = found.get(key)
+		if entity is None:
+			if missing is not None and key not in deferred and key not in returned:
+				missing.append(Entity(key=key))
+				returned.add(key)
+		elif key in returned:
+			results.append(copy_entity(entity))
+		else:
+			results.append(entity)
+			returned.add(key)
+	return results
+
+
+_shard_clients = {}
+"""Clients of worker processes of :meth:`Client.fetch_parallel`."""
+
+
+def _fetch_page(query, cursor, page_size):
+	"""Fetch a page of a shard of :meth:`Client.fetch_parallel`.
+
+	:rtype: tuple
+	:returns: ``(results, cursor)``, the cursor of the next page is
+			  ``None`` after the last one.
+	"""
+	pages = query.fetch(start_cursor=cursor, page_size=page_size).pages
+	try:
+		page = next(pages, None)
+	finally:
+		pages.close()
+	if page is None:
+		return [], None
+	results = list(page)
+	return results, page.next_page_token if results else None
+
+
+def _fetch_page_in_process(client_factory, project, query_args, cursor, page_size):
+	"""Fetch a page of a shard of :meth:`Client.fetch_parallel` in a worker
+	process."""
+	client = _shard_clients.get(client_factory)
+	if client is None:
+		client = _shard_clients[client_factory] = client_factory()
+	if client.project != project:
+		raise ValueError("client_factory returned a client of another project")
+	return _fetch_page(client.query(**query_args), cursor, page_size)
+
+
+def _streamed(create_executor, fetch, shards, slots):
+	"""Yield the results of shards page by page as they are fetched.
+
+	At most ``slots`` pages are being fetched or waiting to be yielded,
+	the next page of a shard is requested once its previous one is taken.
+	The executor is only created once iteration starts, and shut down
+	when it ends or the generator is closed.
+	"""
+	waiting = collections.deque((shard, None) for shard in shards)
+	running = {}
+	executor = create_executor()
+	try:
+		while waiting or running:
+			while waiting and len(running) < slots:
+				shard, cursor = waiting.popleft()
+				running[executor.submit(fetch, shard, cursor)] = shard
+			done, _ = concurrent.futures.wait(
+				running, return_when=concurrent.futures.FIRST_COMPLETED
+			)
+			for future in done:
+				shard = running.pop(future)
+				results, cursor = future.result()
+				if cursor is not None:
+					waiting.append((shard, cursor))
+				for result in results:
+					yield result
+	finally:
+		for future in running:
+			future.cancel()
+		executor.shutdown(wait=False)
+
+
+def _checked_keys(keys, project):
+	"""Convert tuple keys to :class:`Key` and check their project.
+
+	:raises: :class:`ValueError` if a key is from another project.
+	"""
+	keys = [ Key.interned(key) if isinstance(key,tuple) else key for key in keys]
+
+	ids = set(key.project for key in keys)
+	for current_id in ids:
+		if current_id != project:
+			raise ValueError("Keys do not match project")
+	return keys
+
 
 class LIFO(object):
+	"""Stack kept per thread and per :mod:`asyncio` task.
+
+	The stack lives in a :class:`contextvars.ContextVar` and is replaced,
+	never modified, so every thread (and every task, which starts with a
+	copy of its creator's context) pushes and pops its own stack.
+	"""
+
 	def __init__(self):
-		self._stack = []
+		self._stack = contextvars.ContextVar("datastore_lifo_%d" % id(self), default=())
 
 	def __iter__(self):
-		return iter(reversed(self._stack))
+		return iter(reversed(self._stack.get()))
 
 	def push(self, resource):
-		self._stack.append(resource)
+		self._stack.set(self._stack.get() + (resource,))
 
 	def pop(self):
-		return self._stack.pop()
+		stack = self._stack.get()
+		resource = stack[-1]
+		self._stack.set(stack[:-1])
+		return resource
 
 	@property
 	def top(self):
-		if self._stack:
-			return self._stack[-1]
+		stack = self._stack.get()
+		if stack:
+			return stack[-1]
 
 
 class Client(object):
+	"""Datastore client.
+
+	A client can be shared between threads and :mod:`asyncio` tasks: the
+	batches and transactions started with it are tracked per thread and
+	per task, see :attr:`current_batch`.
+
+	The driver is connected on first use, not when the client is created,
+	and again in a forked child process.
+
+	Lookups outside of transactions are served from ``cache``, an
+	:class:`~.cache.EntityCache`, and queries from ``query_cache``, a
+	:class:`~.cache.QueryCache`, if given. Lookups missing ``cache`` go to
+	``shared_cache``, e.g. a :class:`~.memcache.MemcacheEntityCache`
+	shared by processes, before the datastore.
+
+	With ``coalesce_window`` (seconds), :meth:`get` calls of concurrent
+	threads are merged into one lookup by a :class:`~.coalesce.Coalescer`.
+
+	:meth:`get_multi` fetches at most ``lookup_chunk_size`` keys per driver
+	call, with up to ``lookup_workers`` calls in parallel. Given a
+	``deferred`` list, it stops after ``lookup_timeout`` seconds or
+	``lookup_max_bytes`` (estimated) bytes.
+	"""
+
 	def __init__(
 		self,
 		project=None,
@@ -51,15 +209,79 @@ class Client(object):
 		client_options=None,
 		_http=None,
 		_use_grpc=None,
+		driver=DEFAULT_DRIVER,
+		driver_options=None,
+		chunk_entities=MAX_CHUNK_ENTITIES,
+		chunk_bytes=MAX_CHUNK_BYTES,
+		cache=None,
+		query_cache=None,
+		shared_cache=None,
+		coalesce_window=None,
+		lookup_chunk_size=1000,
+		lookup_workers=4,
+		lookup_timeout=None,
+		lookup_max_bytes=None,
 	):
 		self.project = project
 		self.namespace = namespace
 		self.credentials = credentials
+		self.chunk_entities = chunk_entities
+		self.chunk_bytes = chunk_bytes
+		self.transaction_stats = collections.Counter()
+		self.cache = cache
+		self.query_cache = query_cache
+		self.shared_cache = shared_cache
+		self.coalescer = None
+		if coalesce_window is not None:
+			self.coalescer = Coalescer(self.get_multi, window=coalesce_window)
+		self.lookup_chunk_size = lookup_chunk_size
+		self.lookup_workers = lookup_workers
+		self.lookup_timeout = lookup_timeout
+		self.lookup_max_bytes = lookup_max_bytes
+		self._lookup_executor = None
+		self._lookup_pid = None
 
 		self._batch_stack = LIFO()
 
-		from viur.xeno.databases import dbinterface
-		dbinterface.connect()
+		if not isinstance(driver, Driver):
+			driver = get_driver(driver, **(driver_options or {}))
+		self._driver = driver
+		self._connected_pid = None
+		self._connect_lock = threading.Lock()
+
+	@property
+	def driver(self):
+		"""The backend driver used by this client, connected on first use.
+
+		:rtype: :class:`~.driver.Driver`
+		:returns: The driver resolved when the client was created.
+		"""
+		self.connect()
+		return self._driver
+
+	def connect(self):
+		"""Connect the driver, unless done in this process already.
+
+		Called on first use. A child process connects again, so a client
+		created before a pre-fork server forks its workers keeps working.
+		"""
+		pid = os.getpid()
+		if self._connected_pid == pid:
+			return
+		with self._connect_lock:
+			if self._connected_pid != pid:
+				self._driver.connect()
+				self._connected_pid = pid
+
+	def close(self):
+		"""Close the connection of the driver, if connected."""
+		with self._connect_lock:
+			if self._lookup_executor is not None:
+				self._lookup_executor.shutdown(wait=False)
+				self._lookup_executor = None
+			if self._connected_pid is not None:
+				self._connected_pid = None
+				self._driver.close()
 
 	def _push_batch(self, batch):
 		"""Push a batch/transaction onto our stack.
@@ -86,7 +308,7 @@ class Client(object):
 
 	@property
 	def current_batch(self):
-		"""Currently-active batch.
+		"""Currently-active batch of the calling thread or task.
 
 		:rtype: :class:`google.cloud.datastore.batch.Batch`, or an object
 				implementing its API, or ``NoneType`` (if no batch is active).
@@ -96,7 +318,7 @@ class Client(object):
 
 	@property
 	def current_transaction(self):
-		"""Currently-active transaction.
+		"""Currently-active transaction of the calling thread or task.
 
 		:rtype: :class:`google.cloud.datastore.transaction.Transaction`, or an
 				object implementing its API, or ``NoneType`` (if no transaction
@@ -143,6 +365,15 @@ class Client(object):
 
 		:raises: :class:`ValueError` if eventual is True and in a transaction.
 		"""
+		if (
+			self.coalescer is not None
+			and missing is None
+			and deferred is None
+			and transaction is None
+			and self.current_transaction is None
+		):
+			return self.coalescer.get(_checked_keys([key], self.project)[0])
+
 		entities = self.get_multi(
 			keys=[key],
 			missing=missing,
@@ -162,19 +393,25 @@ class Client(object):
 		:param keys: The keys to be retrieved from the datastore.
 
 		:type missing: list
-		:param missing: (Optional) If a list is passed, the key-only entities
-						returned by the backend as "missing" will be copied
+		:param missing: (Optional) If a list is passed, key-only entities
+						for the keys which don't exist will be copied
 						into it. If the list is not empty, an error will occur.
 
 		:type deferred: list
-		:param deferred: (Optional) If a list is passed, the keys returned
-						 by the backend as "deferred" will be copied into it.
-						 If the list is not empty, an error will occur.
+		:param deferred: (Optional) If a list is passed, the lookup stops
+						 after :attr:`lookup_timeout` seconds or
+						 :attr:`lookup_max_bytes` bytes, and the keys not
+						 looked up yet are copied into it, to be passed
+						 to another call. If the list is not empty, an
+						 error will occur.
 
 		:type transaction:
 			:class:`~google.cloud.datastore.transaction.Transaction`
 		:param transaction: (Optional) Transaction to use for read consistency.
 							If not passed, uses current transaction, if set.
+							Inside a transaction, pending puts and deletes of
+							the transaction are visible and every key is
+							fetched from the backend only once.
 
 		:type eventual: bool
 		:param eventual: (Optional) Defaults to strongly consistent (False).
@@ -182,35 +419,138 @@ class Client(object):
 						 be used inside a transaction or will raise ValueError.
 
 		:rtype: list of :class:`google.cloud.datastore.entity.Entity`
-		:returns: The requested entities.
+		:returns: The requested entities which exist, in the order of
+				  ``keys``.
 		:raises: :class:`ValueError` if one or more of ``keys`` has a project
 				 which does not match our project.
 		:raises: :class:`ValueError` if eventual is True and in a transaction.
+		:raises: :class:`ValueError` if ``missing`` or ``deferred`` is not
+				 empty.
 		"""
+		_checked_empty("missing", missing)
+		_checked_empty("deferred", deferred)
 		if not keys:
 			return []
 
-		keys = [ Key(*key) if isinstance(key,tuple) else key for key in keys]
-
-		ids = set(key.project for key in keys)
-		for current_id in ids:
-			if current_id != self.project:
-				raise ValueError("Keys do not match project")
+		keys = _checked_keys(keys, self.project)
+		unique = list(dict.fromkeys(keys))
 
 		if transaction is None:
 			transaction = self.current_transaction
 
-		from viur.xeno.databases import dbinterface
-		entities = dbinterface.get_multi(keys)
+		if transaction is not None:
+			entities = transaction._get_multi(unique)
+		elif self.cache is not None or self.shared_cache is not None:
+			entities = self._get_cached(unique, deferred)
+		else:
+			entities = self._lookup(unique, deferred)
+
+		return _in_order(keys, entities, missing, deferred or ())
+
+	def _get_cached(self, keys, deferred=None):
+		"""Look up entities in the caches, fetching and caching the others."""
+		cache = self.cache
+		if cache is None:
+			found, missing = {}, keys
+		else:
+			found, missing, generation = cache.lookup(keys)
+		if missing:
+			entities = self._get_shared(missing, deferred)
+			if cache is not None:
+				cache.fill(entities, generation)
+			found.update((entity.key, entity) for entity in entities)
+		return list(found.values())
+
+	def _get_shared(self, keys, deferred=None):
+		"""Look up entities in the shared cache, then in the datastore."""
+		shared_cache = self.shared_cache
+		if shared_cache is None:
+			return self._lookup(keys, deferred)
+		found, missing = shared_cache.lookup(keys)
+		entities = list(found.values())
+		if missing:
+			fetched = self._lookup(missing, deferred)
+			shared_cache.fill(fetched)
+			entities.extend(fetched)
+		return entities
+
+	def _lookup(self, keys, deferred=None):
+		"""Fetch entities from the driver in chunks, in parallel.
 
-		if missing is not None:
-			pass #Fixme
+		Without ``deferred`` every chunk is fetched. Otherwise chunks are
+		collected in order until the time or size budget is used up and
+		the keys of the remaining chunks are added to ``deferred``. The
+		first chunk is always collected, so repeated calls make progress.
+		"""
+		size = self.lookup_chunk_size
+		driver = self.driver
+		if len(keys) <= size:
+			return driver.get_multi(keys)
 
-		if deferred is not None:
-			pass#Fixme
+		chunks = [keys[start:start + size] for start in range(0, len(keys), size)]
+		if self.lookup_workers <= 1:
+			return self._collect(chunks, [None] * len(chunks), deferred)
 
+		executor = self._executor()
+		results = [executor.submit(driver.get_multi, chunk) for chunk in chunks]
+		try:
+			return self._collect(chunks, results, deferred)
+		except BaseException:
+			for result in results:
+				result.cancel()
+			raise
+
+	def _collect(self, chunks, results, deferred):
+		"""Gather the chunks of :meth:`_lookup` in order.
+
+		``results`` holds the future of every chunk, or ``None`` for the
+		chunks to fetch here.
+		"""
+		driver = self.driver
+		deadline = None
+		if deferred is not None and self.lookup_timeout is not None:
+			deadline = time.monotonic() + self.lookup_timeout
+		max_bytes = self.lookup_max_bytes if deferred is not None else None
+		entities = []
+		fetched_bytes = 0
+		exhausted = False
+		for index, (chunk, result) in enumerate(zip(chunks, results)):
+			if not exhausted:
+				if result is None:
+					chunk_entities = driver.get_multi(chunk)
+				else:
+					timeout = None
+					if deadline is not None and index:
+						timeout = max(0, deadline - time.monotonic())
+					try:
+						chunk_entities = result.result(timeout)
+					except concurrent.futures.TimeoutError:
+						exhausted = True
+			if exhausted:
+				if result is not None:
+					result.cancel()
+				deferred.extend(chunk)
+				continue
+			entities.extend(chunk_entities)
+			if max_bytes is not None:
+				fetched_bytes += sum(estimate_size(entity) for entity in chunk_entities)
+				exhausted = fetched_bytes >= max_bytes
+			if deadline is not None and time.monotonic() >= deadline:
+				exhausted = True
 		return entities
 
+	def _executor(self):
+		"""Thread pool of :meth:`_lookup`, created on first use."""
+		pid = os.getpid()
+		if self._lookup_executor is None or self._lookup_pid != pid:
+			with self._connect_lock:
+				if self._lookup_executor is None or self._lookup_pid != pid:
+					self._lookup_executor = concurrent.futures.ThreadPoolExecutor(
+						self.lookup_workers, thread_name_prefix="datastore-lookup"
+					)
+					self._lookup_pid = pid
+		return self._lookup_executor
+
 	def put(self, entity):
 		"""Save an entity in the Cloud Datastore.
 
@@ -225,12 +565,22 @@ class Client(object):
 		"""
 		self.put_multi(entities=[entity])
 
-	def put_multi(self, entities):
+	def put_multi(self, entities, progress=None):
 		"""Save entities in the Cloud Datastore.
 
+		The entities are sent in chunks of at most :attr:`chunk_entities`
+		entities and :attr:`chunk_bytes` (estimated) bytes. Outside of a
+		batch, every full chunk is sent right away, so ``entities`` may be
+		a generator of any length.
+
 		:type entities: list of :class:`google.cloud.datastore.entity.Entity`
 		:param entities: The entities to be saved to the datastore.
 
+		:type progress: callable
+		:param progress: (Optional) Called as ``progress(chunk, mutations,
+						 size)`` once a chunk is committed, see
+						 :meth:`batch`. Ignored inside a batch.
+
 		:raises: :class:`ValueError` if ``entities`` is a single entity.
 		"""
 		if isinstance(entities, Entity):
@@ -243,7 +593,7 @@ class Client(object):
 		in_batch = current is not None
 
 		if not in_batch:
-			current = self.batch()
+			current = self.batch(progress=progress)
 			current.begin()
 
 		for entity in entities:
@@ -266,11 +616,17 @@ class Client(object):
 		"""
 		self.delete_multi(keys=[key])
 
-	def delete_multi(self, keys):
+	def delete_multi(self, keys, progress=None):
 		"""Delete keys from the Cloud Datastore.
 
+		Keys are sent in chunks like in :meth:`put_multi`.
+
 		:type keys: list of :class:`google.cloud.datastore.key.Key`
 		:param keys: The keys to be deleted from the Datastore.
+
+		:type progress: callable
+		:param progress: (Optional) Called once a chunk is committed, see
+						 :meth:`batch`. Ignored inside a batch.
 		"""
 		if not keys:
 			return
@@ -280,7 +636,7 @@ class Client(object):
 		in_batch = current is not None
 
 		if not in_batch:
-			current = self.batch()
+			current = self.batch(progress=progress)
 			current.begin()
 
 		for key in keys:
@@ -307,32 +663,7 @@ class Client(object):
 		if not incomplete_key.is_partial:
 			raise ValueError(('Key is not partial.', incomplete_key))
 
-		if num_ids>1:
-			raise ValueError("Actually you can only request one Key")
-
-		from random import random
-		from time import time
-
-
-
-		try:
-			from viur.xeno.databases import dbinterface
-			newId = str(dbinterface.generateID())
-		except :
-			newId = int(time()*1000)^int(random()*10000000000000) #we need something better
-
-		return [incomplete_key.completed_key(newId)]
-
-		incomplete_key_pb = incomplete_key.to_protobuf()
-		incomplete_key_pbs = [incomplete_key_pb] * num_ids
-
-		conn = self.connection
-		allocated_key_pbs = conn.allocate_ids(incomplete_key.project,
-											  incomplete_key_pbs)
-		allocated_ids = [allocated_key_pb.path[-1].id
-						 for allocated_key_pb in allocated_key_pbs]
-		return [incomplete_key.completed_key(allocated_id)
-				for allocated_id in allocated_ids]
+		return self.driver.allocate_ids(incomplete_key, num_ids)
 
 	def key(self, *path_args, **kwargs):
 		"""Proxy to :class:`google.cloud.datastore.key.Key`.
@@ -346,9 +677,26 @@ class Client(object):
 			kwargs["namespace"] = self.namespace
 		return Key(*path_args, **kwargs)
 
-	def batch(self):
-		"""Proxy to :class:`google.cloud.datastore.batch.Batch`."""
-		return Batch(self)
+	def batch(self, max_entities=None, max_bytes=None, progress=None):
+		"""Proxy to :class:`google.cloud.datastore.batch.Batch`.
+
+		:type max_entities: int
+		:param max_entities: (Optional) Maximum number of mutations sent at
+							 once. Defaults to :attr:`chunk_entities`.
+
+		:type max_bytes: int
+		:param max_bytes: (Optional) Maximum estimated size of the mutations
+						  sent at once. Defaults to :attr:`chunk_bytes`.
+
+		:type progress: callable
+		:param progress: (Optional) Called as ``progress(chunk, mutations,
+						 size)`` once a chunk is committed, with the number
+						 of chunks committed so far, the number of mutations
+						 in the chunk and its estimated size.
+		"""
+		return Batch(
+			self, max_entities=max_entities, max_bytes=max_bytes, progress=progress
+		)
 
 	def transaction(self, **kwargs):
 		"""Proxy to :class:`google.cloud.datastore.transaction.Transaction`.
@@ -357,6 +705,58 @@ class Client(object):
 		"""
 		return Transaction(self, **kwargs)
 
+	def run_in_transaction(
+		self, function, retries=3, backoff=0.05, max_backoff=2.0, read_only=False
+	):
+		"""Call ``function`` inside a transaction, retrying on conflicts.
+
+		If the commit fails with
+		:class:`~google.cloud.datastore.transaction.Conflict`, the whole
+		transaction, including ``function``, is run again after sleeping
+		for a random time between zero and ``backoff * 2 ** attempt``
+		seconds (capped at ``max_backoff``). ``function`` must therefore
+		do all its reads through the client and have no other side effects.
+
+		The outcome is counted in :attr:`transaction_stats` under
+		``commits``, ``conflicts``, ``retries`` and ``failures``.
+
+		:type function: callable
+		:param function: Called with the active transaction.
+
+		:type retries: int
+		:param retries: (Optional) How often to retry after a conflict.
+
+		:type backoff: float
+		:param backoff: (Optional) Base delay in seconds.
+
+		:type max_backoff: float
+		:param max_backoff: (Optional) Maximum delay in seconds.
+
+		:type read_only: bool
+		:param read_only: (Optional) Run a read only transaction.
+
+		:returns: The return value of ``function``.
+		:raises: :class:`~google.cloud.datastore.transaction.Conflict` if
+				 the transaction still conflicts after ``retries`` retries.
+		"""
+		stats = self.transaction_stats
+		attempt = 0
+		while True:
+			try:
+				with self.transaction(read_only=read_only) as transaction:
+					result = function(transaction)
+			except Conflict:
+				stats["conflicts"] += 1
+				if attempt >= retries:
+					stats["failures"] += 1
+					raise
+				stats["retries"] += 1
+				time.sleep(random.uniform(0, min(max_backoff, backoff * 2 ** attempt)))
+				attempt += 1
+			else:
+				stats["commits"] += 1
+				return result
+
 	def query(self, **kwargs):
 		"""Proxy to :class:`google.cloud.datastore.query.Query`.
 
@@ -439,3 +839,140 @@ class Client(object):
 		if "namespace" not in kwargs:
 			kwargs["namespace"] = self.namespace
 		return Query(self, **kwargs)
+
+	def scan(
+		self, kind, start_key=None, end_key=None, limit=None, ancestor=None, batch_size=500
+	):
+		"""Iterate over the entities of a kind in key order.
+
+		The range is given as keys, ordered like their
+		:meth:`~google.cloud.datastore.key.Key.to_ordered_bytes`, so drivers
+		serve it as a contiguous read of their key index rather than
+		filtering. Results are fetched in batches of ``batch_size``.
+
+		:type kind: str
+		:param kind: The kind to scan.
+
+		:type start_key: :class:`google.cloud.datastore.key.Key`
+		:param start_key: (Optional) First key of the range (inclusive).
+
+		:type end_key: :class:`google.cloud.datastore.key.Key`
+		:param end_key: (Optional) End of the range (exclusive).
+
+		:type limit: int
+		:param limit: (Optional) Maximum number of entities to return.
+
+		:type ancestor: :class:`google.cloud.datastore.key.Key`
+		:param ancestor: (Optional) Only scan descendants of this key.
+
+		:type batch_size: int
+		:param batch_size: (Optional) Number of entities fetched at once.
+
+		:rtype: iterator of :class:`google.cloud.datastore.entity.Entity`
+		:raises: :class:`ValueError` if a key is partial or belongs to
+				 another project.
+		"""
+		for key in (start_key, end_key, ancestor):
+			if key is None:
+				continue
+			key.to_ordered_bytes()  # raises for partial keys
+			if key.project != self.project:
+				raise ValueError("Key project does not match the client's project")
+
+		query = self.query(kind=kind, ancestor=ancestor, order=["__key__"])
+		if start_key is not None:
+			query.key_filter(start_key, ">=")
+		if end_key is not None:
+			query.key_filter(end_key, "<")
+		return iter(query.fetch(limit=limit, page_size=batch_size))
+
+	def fetch_parallel(
+		self,
+		query,
+		num_shards,
+		workers=None,
+		processes=False,
+		client_factory=None,
+		page_size=DEFAULT_PAGE_SIZE,
+	):
+		"""Run a query as key range shards on a pool of workers.
+
+		The query is divided by :meth:`~google.cloud.datastore.query.Query.split`
+		and the shards are fetched page by page in threads, or in processes
+		of a :class:`concurrent.futures.ProcessPoolExecutor` if ``processes``
+		is set. Pages are yielded as they arrive, in no particular order,
+		not in query order; at most one page per worker is held at a time.
+		Nothing is fetched before iteration starts.
+
+		Processes don't share the client: each one creates its own by calling
+		``client_factory``, which must be picklable, e.g. a module level
+		function.
+
+		:type query: :class:`google.cloud.datastore.query.Query`
+		:param query: The query, limits and cursors are not supported.
+
+		:type num_shards: int
+		:param num_shards: The number of shards to split the query into.
+
+		:type workers: int
+		:param workers: (Optional) Size of the pool, defaults to one thread
+						per shard or one process per CPU.
+
+		:type processes: bool
+		:param processes: (Optional) Fetch the shards in processes.
+
+		:type client_factory: callable
+		:param client_factory: (Optional) Creates the client of a process,
+							   required with ``processes``.
+
+		:type page_size: int
+		:param page_size: (Optional) Number of results fetched at once.
+
+		:rtype: iterator
+		:returns: The results of the query. Closing it early cancels the
+				  shards not started yet.
+		:raises: :class:`ValueError` if ``processes`` is set without a
+				 ``client_factory``.
+		"""
+		if processes and client_factory is None:
+			raise ValueError("client_factory is required to fetch in processes")
+		return self._fetch_parallel(
+			query, num_shards, workers, processes, client_factory, page_size
+		)
+
+	def _fetch_parallel(
+		self, query, num_shards, workers, processes, client_factory, page_size
+	):
+		"""Generator of :meth:`fetch_parallel`, started on first use."""
+		queries = query.split(num_shards)
+
+		if processes:
+			workers = workers or os.cpu_count() or 1
+			shards = [
+				dict(
+					kind=shard.kind,
+					namespace=shard.namespace,
+					ancestor=shard.ancestor,
+					filters=shard.filters,
+					projection=shard.projection,
+					order=shard.order,
+					distinct_on=shard.distinct_on,
+				)
+				for shard in queries
+			]
+			fetch = functools.partial(
+				_fetch_page_in_process, client_factory, self.project, page_size=page_size
+			)
+			create_executor = functools.partial(
+				concurrent.futures.ProcessPoolExecutor, workers
+			)
+		else:
+			workers = workers or len(queries)
+			shards = queries
+			fetch = functools.partial(_fetch_page, page_size=page_size)
+			create_executor = functools.partial(
+				concurrent.futures.ThreadPoolExecutor,
+				workers,
+				thread_name_prefix="datastore-scan",
+			)
+		yield from _streamed(create_executor, fetch, shards, workers)
@@ -0,0 +1,187 @@
+# Copyright 2020 Andreas H. Kelch
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+"""Coalescing of concurrent single key lookups.
+
+Lookups of single keys issued at about the same time are collected and
+sent as one ``get_multi``, every key once. :class:`Coalescer` collects
+the lookups of threads during a short window, :class:`AsyncCoalescer`
+those of :mod:`asyncio` tasks during one iteration of the event loop.
+
+Every caller gets an entity of its own: callers of the same key after
+the first get a copy.
+
+Both count ``calls``, ``fetches`` (``get_multi`` calls) and ``keys``
+(distinct keys fetched) in ``stats``.
+"""
+import asyncio
+import collections
+import threading
+
+from .helpers import copy_entity
+
+
+class _Batch(object):
+	"""Lookups collected for one ``get_multi``."""
+
+	def __init__(self):
+		self.keys = {}
+		self.claimed = set()
+		self.full = threading.Event()
+		self.done = threading.Event()
+		self.results = None
+		self.error = None
+
+
+class Coalescer(object):
+	"""Merge the lookups of concurrent threads.
+
+	The first lookup waits ``window`` seconds (or until ``max_keys``
+	keys were collected) for others, then fetches all collected keys.
+
+	:type fetch: callable
+	:param fetch: ``get_multi`` of the client, called with a list of keys.
+
+	:type window: float
+	:param window: (Optional) Seconds to collect lookups.
+
+	:type max_keys: int
+	:param max_keys: (Optional) Keys after which a batch is sent at once.
+	"""
+
+	def __init__(self, fetch, window=0.002, max_keys=1000):
+		self._fetch = fetch
+		self.window = window
+		self.max_keys = max_keys
+		self.stats = collections.Counter()
+		self._lock = threading.Lock()
+		self._pending = None
+
+	def get(self, key):
+		"""Look up a single key.
+
+		:type key: :class:`~.key.Key`
+		:param key: The key to look up.
+
+		:rtype: :class:`~.entity.Entity` or ``NoneType``
+		"""
+		with self._lock:
+			self.stats["calls"] += 1
+			batch = self._pending
+			leader = batch is None
+			if leader:
+				batch = self._pending = _Batch()
+			batch.keys[key] = None
+			if len(batch.keys) >= self.max_keys:
+				self._pending = None
+				batch.full.set()
+
+		if leader:
+			batch.full.wait(self.window)
+			with self._lock:
+				if self._pending is batch:
+					self._pending = None
+			self._send(batch)
+		else:
+			batch.done.wait()
+
+		if batch.error is not None:
+			raise batch.error
+		entity = batch.results.get(key)
+		if entity is not None:
+			with self._lock:
+				if key in batch.claimed:
+					entity = copy_entity(entity)
+				else:
+					batch.claimed.add(key)
+		return entity
+
+	def _send(self, batch):
+		keys = list(batch.keys)
+		self.stats["fetches"] += 1
+		self.stats["keys"] += len(keys)
+		try:
+			batch.results = dict((entity.key, entity) for entity in self._fetch(keys))
+		except BaseException as exc:
+			batch.error = exc
+		finally:
+			batch.done.set()
+
+
+class AsyncCoalescer(object):
+	"""Merge the lookups of :mod:`asyncio` tasks.
+
+	Lookups made during one iteration of the event loop, e.g. by the
+	tasks of an :func:`asyncio.gather`, are fetched together right after.
+
+	:type fetch: callable
+	:param fetch: Coroutine function, ``get_multi`` of the client.
+	"""
+
+	def __init__(self, fetch):
+		self._fetch = fetch
+		self.stats = collections.Counter()
+		self._pending = None
+		self._tasks = set()  # the loop only keeps weak references
+
+	def get(self, key):
+		"""Look up a single key.
+
+		:type key: :class:`~.key.Key`
+		:param key: The key to look up.
+
+		:rtype: :class:`asyncio.Future`
+		:returns: Resolves to the :class:`~.entity.Entity` or ``None``.
+		"""
+		loop = asyncio.get_running_loop()
+		self.stats["calls"] += 1
+		if self._pending is None:
+			self._pending = {}
+			loop.call_soon(self._dispatch, loop)
+		future = loop.create_future()
+		self._pending.setdefault(key, []).append(future)
+		return future
+
+	def _dispatch(self, loop):
+		pending, self._pending = self._pending, None
+		task = loop.create_task(self._send(pending))
+		self._tasks.add(task)
+		task.add_done_callback(self._tasks.discard)
+
+	async def _send(self, pending):
+		self.stats["fetches"] += 1
+		self.stats["keys"] += len(pending)
+		try:
+			entities = await self._fetch(list(pending))
+		except asyncio.CancelledError:
+			for futures in pending.values():
+				for future in futures:
+					future.cancel()
+			raise
+		except Exception as exc:
+			for futures in pending.values():
+				for future in futures:
+					if not future.done():
+						future.set_exception(exc)
+			return
+
+		found = dict((entity.key, entity) for entity in entities)
+		for key, futures in pending.items():
+			entity = found.get(key)
+			for index, future in enumerate(futures):
+				if not future.done():
+					if index and entity is not None:
+						future.set_result(copy_entity(entity))
+					else:
+						future.set_result(entity)
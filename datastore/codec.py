@@ -0,0 +1,714 @@
+# Copyright 2020 Andreas H. Kelch
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+"""Binary entity codec.
+
+Encodes :class:`~.entity.Entity` objects, including their key, excluded
+indexes and all property types of this package, without touching the
+entity. Every value is a one byte tag followed by its payload:
+
+* ``None``, ``False`` and ``True`` have no payload,
+* integers are a varint length and the signed big endian bytes,
+* floats are 8 byte big endian doubles, geo points two of them,
+* strings and bytes are a varint length and the (UTF-8) bytes,
+* datetimes are microseconds since the epoch; aware datetimes are
+  stored in UTC and decoded with :data:`datetime.timezone.utc`,
+* keys are project, namespace and the flat path,
+* lists and dicts are an item count and their items,
+* entities are their key (or a "no key" tag), the excluded property
+  names and the properties. Every property is its name, the byte length
+  of its value and the value, so single properties can be found and
+  decoded without reading the others (see :class:`LazyEntity`).
+
+An encoded entity starts with :data:`VERSION`. Streams of entities are
+the encoded entities, each prefixed with its varint length.
+"""
+import datetime
+import functools
+import struct
+
+from .entity import Entity
+from .geopoint import GeoPoint
+from .key import Key, _decoded_key
+
+VERSION = b"\x01"
+"""First byte of every encoded entity."""
+
+(
+	_NONE,
+	_FALSE,
+	_TRUE,
+	_INT,
+	_FLOAT,
+	_STR,
+	_BYTES,
+	_DATETIME,
+	_DATETIME_UTC,
+	_GEOPOINT,
+	_KEY,
+	_LIST,
+	_DICT,
+	_ENTITY,
+	_NO_KEY,
+) = range(15)
+
+_EPOCH = datetime.datetime(1970, 1, 1)
+_EPOCH_UTC = datetime.datetime(1970, 1, 1, tzinfo=datetime.timezone.utc)
+
+_double = struct.Struct(">d")
+_double_pair = struct.Struct(">dd")
+
+
+def _write_length(out, length):
+	while length >= 0x80:
+		out.append((length & 0x7f) | 0x80)
+		length >>= 7
+	out.append(length)
+
+
+def _read_length(raw_bytes, position):
+	length = raw_bytes[position]
+	position += 1
+	if length < 0x80:
+		return length, position
+	length &= 0x7f
+	shift = 7
+	while True:
+		byte = raw_bytes[position]
+		position += 1
+		length |= (byte & 0x7f) << shift
+		if byte < 0x80:
+			return length, position
+		shift += 7
+
+
+def _write_str(out, value):
+	raw = value.encode()
+	_write_length(out, len(raw))
+	out += raw
+
+
+def _write_optional_str(out, value):
+	if value is None:
+		out.append(0)
+	else:
+		raw = value.encode()
+		_write_length(out, len(raw) + 1)
+		out += raw
+
+
+def _write_int(out, value):
+	raw = value.to_bytes((value.bit_length() + 8) // 8, "big", signed=True)
+	out.append(_INT)
+	_write_length(out, len(raw))
+	out += raw
+
+
+def _write_float(out, value):
+	out.append(_FLOAT)
+	out += _double.pack(value)
+
+
+def _write_text(out, value):
+	out.append(_STR)
+	_write_str(out, value)
+
+
+def _write_bytes(out, value):
+	out.append(_BYTES)
+	_write_length(out, len(value))
+	out += value
+
+
+def _write_datetime(out, value):
+	if value.tzinfo is None:
+		out.append(_DATETIME)
+		delta = value - _EPOCH
+	else:
+		out.append(_DATETIME_UTC)
+		delta = value - _EPOCH_UTC
+	micros = (delta.days * 86400 + delta.seconds) * 1000000 + delta.microseconds
+	raw = micros.to_bytes((micros.bit_length() + 8) // 8, "big", signed=True)
+	_write_length(out, len(raw))
+	out += raw
+
+
+def _write_geopoint(out, value):
+	out.append(_GEOPOINT)
+	out += _double_pair.pack(value.latitude, value.longitude)
+
+
+def _write_key(out, key):
+	out.append(_KEY)
+	_write_optional_str(out, key._project)
+	_write_optional_str(out, key._namespace)
+	flat_path = key._flat_path
+	_write_length(out, len(flat_path))
+	for element in flat_path:
+		if isinstance(element, str):
+			_write_text(out, element)
+		else:
+			_write_int(out, int(element))
+
+
+def _write_list(out, value):
+	out.append(_LIST)
+	_write_length(out, len(value))
+	for item in value:
+		_write_value(out, item)
+
+
+def _write_dict(out, value):
+	out.append(_DICT)
+	_write_length(out, len(value))
+	for name, item in value.items():
+		_write_str(out, name)
+		_write_value(out, item)
+
+
+def _write_entity(out, entity):
+	if entity.key is None:
+		out.append(_NO_KEY)
+	else:
+		_write_key(out, entity.key)
+	excluded = entity.exclude_from_indexes
+	_write_length(out, len(excluded))
+	for name in sorted(excluded):
+		_write_str(out, name)
+	_write_length(out, len(entity))
+	for name, value in entity.items():
+		_write_str(out, name)
+		start = len(out)
+		_write_value(out, value)
+		size = len(out) - start
+		if size < 0x80:
+			out.insert(start, size)
+		else:
+			length = bytearray()
+			_write_length(length, size)
+			out[start:start] = length
+
+
+def _write_nested_entity(out, entity):
+	out.append(_ENTITY)
+	_write_entity(out, entity)
+
+
+_WRITERS = {
+	type(None): lambda out, value: out.append(_NONE),
+	bool: lambda out, value: out.append(_TRUE if value else _FALSE),
+	int: _write_int,
+	float: _write_float,
+	str: _write_text,
+	bytes: _write_bytes,
+	datetime.datetime: _write_datetime,
+	GeoPoint: _write_geopoint,
+	Key: _write_key,
+	list: _write_list,
+	tuple: _write_list,
+	dict: _write_dict,
+	Entity: _write_nested_entity,
+}
+
+
+_SUBCLASSABLE = (
+	bool, int, float, str, bytes, datetime.datetime, GeoPoint, Key, Entity, dict, list, tuple,
+)
+
+
+def _write_value(out, value):
+	writer = _WRITERS.get(type(value))
+	if writer is None:
+		# Subclasses; bool before int and Entity before dict, as they are
+		# subclasses themselves.
+		for value_type in _SUBCLASSABLE:
+			if isinstance(value, value_type):
+				writer = _WRITERS[value_type]
+				break
+		else:
+			raise TypeError("Cannot encode value of type", type(value))
+	writer(out, value)
+
+
+def _read_str(raw_bytes, position):
+	length, position = _read_length(raw_bytes, position)
+	end = position + length
+	return str(raw_bytes[position:end], "utf-8"), end
+
+
+def _read_optional_str(raw_bytes, position):
+	length, position = _read_length(raw_bytes, position)
+	if not length:
+		return None, position
+	end = position + length - 1
+	return str(raw_bytes[position:end], "utf-8"), end
+
+
+def _read_signed(raw_bytes, position):
+	length, position = _read_length(raw_bytes, position)
+	end = position + length
+	return int.from_bytes(raw_bytes[position:end], "big", signed=True), end
+
+
+def _read_int(raw_bytes, position):
+	return _read_signed(raw_bytes, position)
+
+
+def _read_float(raw_bytes, position):
+	return _double.unpack_from(raw_bytes, position)[0], position + 8
+
+
+def _read_bytes(raw_bytes, position):
+	length, position = _read_length(raw_bytes, position)
+	end = position + length
+	return bytes(raw_bytes[position:end]), end
+
+
+def _read_datetime(raw_bytes, position):
+	micros, position = _read_signed(raw_bytes, position)
+	return _EPOCH + datetime.timedelta(microseconds=micros), position
+
+
+def _read_datetime_utc(raw_bytes, position):
+	micros, position = _read_signed(raw_bytes, position)
+	return _EPOCH_UTC + datetime.timedelta(microseconds=micros), position
+
+
+def _read_geopoint(raw_bytes, position):
+	latitude, longitude = _double_pair.unpack_from(raw_bytes, position)
+	return GeoPoint(latitude, longitude), position + 16
+
+
+def _read_key(raw_bytes, position):
+	# Keys are decoded for every entity and key property, so the lengths,
+	# which almost always fit into one byte, are read inline.
+	strings = []
+	for _ in range(2):
+		length = raw_bytes[position]
+		if length < 0x80:
+			position += 1
+		else:
+			length, position = _read_length(raw_bytes, position)
+		if length:
+			end = position + length - 1
+			strings.append(str(raw_bytes[position:end], "utf-8"))
+			position = end
+		else:
+			strings.append(None)
+	count = raw_bytes[position]
+	if count < 0x80:
+		position += 1
+	else:
+		count, position = _read_length(raw_bytes, position)
+	if not count:
+		raise ValueError("Empty key path")
+	# Kinds are strings, ids or names strings or integers, so the path is
+	# valid by construction.
+	flat_path = []
+	append = flat_path.append
+	for index in range(count):
+		tag = raw_bytes[position]
+		length = raw_bytes[position + 1]
+		if length < 0x80:
+			start = position + 2
+		else:
+			length, start = _read_length(raw_bytes, position + 1)
+		position = start + length
+		if tag == _STR:
+			append(str(raw_bytes[start:position], "utf-8"))
+		elif tag == _INT and index % 2:
+			append(int.from_bytes(raw_bytes[start:position], "big", signed=True))
+		else:
+			raise ValueError("Invalid key path element tag", tag)
+	return _decoded_key(tuple(flat_path), strings[0], strings[1]), position
+
+
+def _read_list(raw_bytes, position):
+	length, position = _read_length(raw_bytes, position)
+	items = []
+	append = items.append
+	read_value = _read_value
+	for _ in range(length):
+		if raw_bytes[position] == _STR and raw_bytes[position + 1] < 0x80:
+			end = position + 2 + raw_bytes[position + 1]
+			append(raw_bytes[position + 2:end].decode())
+			position = end
+		else:
+			item, position = read_value(raw_bytes, position)
+			append(item)
+	return items, position
+
+
+def _read_dict(raw_bytes, position):
+	length, position = _read_length(raw_bytes, position)
+	value = {}
+	read_value = _read_value
+	for _ in range(length):
+		name_length = raw_bytes[position]
+		if name_length < 0x80:
+			end = position + 1 + name_length
+			name = raw_bytes[position + 1:end].decode()
+		else:
+			name, end = _read_str(raw_bytes, position)
+		value[name], position = read_value(raw_bytes, end)
+	return value, position
+
+
+def _read_entity_header(raw_bytes, position):
+	"""Read the key and excluded indexes of an entity.
+
+	:rtype: tuple
+	:returns: ``(key, exclude_from_indexes, property_count, position)``.
+	"""
+	if raw_bytes[position] == _NO_KEY:
+		key = None
+		position += 1
+	else:
+		key, position = _read_key(raw_bytes, position + 1)
+	length, position = _read_length(raw_bytes, position)
+	excluded = []
+	for _ in range(length):
+		name, position = _read_str(raw_bytes, position)
+		excluded.append(name)
+	length, position = _read_length(raw_bytes, position)
+	return key, excluded, length, position
+
+
+def _read_entity(raw_bytes, position, projection=None):
+	key, excluded, length, position = _read_entity_header(raw_bytes, position)
+	entity = Entity(key=key, exclude_from_indexes=excluded, projection=projection or ())
+	for _ in range(length):
+		# Property names and values are almost always shorter than 128 bytes.
+		name_length = raw_bytes[position]
+		if name_length < 0x80:
+			end = position + 1 + name_length
+			name = raw_bytes[position + 1:end].decode()
+		else:
+			name, end = _read_str(raw_bytes, position)
+		size = raw_bytes[end]
+		if size < 0x80:
+			end += 1
+		else:
+			size, end = _read_length(raw_bytes, end)
+		position = end + size
+		if projection is not None and name not in projection:
+			continue
+		# The size of a property tells where its value ends, which saves
+		# reading the length of strings, integers and bytes.
+		tag = raw_bytes[end]
+		if tag == _STR or tag == _INT or tag == _BYTES:
+			start = end + 2 if raw_bytes[end + 1] < 0x80 else _read_length(raw_bytes, end + 1)[1]
+			if tag == _STR:
+				entity[name] = raw_bytes[start:position].decode()
+			elif tag == _INT:
+				entity[name] = int.from_bytes(raw_bytes[start:position], "big", signed=True)
+			else:
+				entity[name] = bytes(raw_bytes[start:position])
+		elif tag <= _TRUE:
+			entity[name] = _CONSTANTS[tag]
+		else:
+			entity[name] = _read_value(raw_bytes, end)[0]
+	return entity, position
+
+
+_CONSTANTS = (None, False, True)
+
+_unpack_double = _double.unpack_from
+
+_READERS = [None] * _NO_KEY
+_READERS[_NONE] = lambda raw_bytes, position: (None, position)
+_READERS[_FALSE] = lambda raw_bytes, position: (False, position)
+_READERS[_TRUE] = lambda raw_bytes, position: (True, position)
+_READERS[_INT] = _read_int
+_READERS[_FLOAT] = _read_float
+_READERS[_STR] = _read_str
+_READERS[_BYTES] = _read_bytes
+_READERS[_DATETIME] = _read_datetime
+_READERS[_DATETIME_UTC] = _read_datetime_utc
+_READERS[_GEOPOINT] = _read_geopoint
+_READERS[_KEY] = _read_key
+_READERS[_LIST] = _read_list
+_READERS[_DICT] = _read_dict
+_READERS[_ENTITY] = _read_entity
+
+
+def _read_value(raw_bytes, position):
+	tag = raw_bytes[position]
+	position += 1
+	# The most common values are inlined: short strings and integers,
+	# booleans, None and floats.
+	if tag == _STR:
+		length = raw_bytes[position]
+		if length < 0x80:
+			end = position + 1 + length
+			return raw_bytes[position + 1:end].decode(), end
+	elif tag == _INT:
+		length = raw_bytes[position]
+		if length < 0x80:
+			end = position + 1 + length
+			return int.from_bytes(raw_bytes[position + 1:end], "big", signed=True), end
+	elif tag <= _TRUE:
+		return _CONSTANTS[tag], position
+	elif tag == _FLOAT:
+		return _unpack_double(raw_bytes, position)[0], position + 8
+	elif tag >= len(_READERS):
+		raise ValueError("Unknown value tag", tag)
+	return _READERS[tag](raw_bytes, position)
+
+
+def encode_entity(entity):
+	"""Encode an entity.
+
+	The entity is not modified.
+
+	:type entity: :class:`~.entity.Entity`
+	:param entity: The entity to encode.
+
+	:rtype: bytes
+	:raises: :class:`TypeError` if a property has an unsupported type.
+	"""
+	out = bytearray(VERSION)
+	_write_entity(out, entity)
+	return bytes(out)
+
+
+def decode_entity(raw_bytes, projection=None):
+	"""Decode an entity encoded by :func:`encode_entity`.
+
+	:type raw_bytes: bytes
+	:param raw_bytes: The encoded entity.
+
+	:type projection: collection of str
+	:param projection: (Optional) Only keep these properties; the entity
+					   is marked as projection result.
+
+	:rtype: :class:`~.entity.Entity`
+	:raises: :class:`ValueError` if ``raw_bytes`` is not a valid entity.
+	"""
+	if raw_bytes[:1] != VERSION:
+		raise ValueError("Unknown entity encoding version", raw_bytes[:1])
+	try:
+		entity, position = _read_entity(raw_bytes, 1, projection)
+	except (IndexError, TypeError, UnicodeDecodeError, struct.error) as exc:
+		raise ValueError("Invalid entity encoding", exc)
+	if position != len(raw_bytes):
+		raise ValueError("Trailing bytes after the entity")
+	return entity
+
+
+_PENDING = object()
+"""Value of the properties of a :class:`LazyEntity` not decoded yet."""
+
+
+class LazyEntity(Entity):
+	"""Entity decoding its properties from an encoded record on access.
+
+	The key and excluded indexes are decoded right away, the properties
+	only when they are read. Until then they hold a placeholder, so the
+	entity has all its names, in the stored order, from the start.
+	Modifying the entity decodes the remaining properties and drops the
+	record, from then on it is a plain :class:`~.entity.Entity`.
+
+	A memoryview is kept as is, not copied; a property's value is copied
+	out of it when the property is first read. Threads may read the same
+	entity: a property read by two at once is decoded twice and the first
+	value stored is kept.
+
+	:type raw_bytes: bytes or memoryview
+	:param raw_bytes: An entity encoded by :func:`encode_entity`.
+
+	:type projection: collection of str
+	:param projection: (Optional) Only keep these properties; the entity
+					   is marked as projection result.
+
+	:raises: :class:`ValueError` if ``raw_bytes`` is not a valid entity.
+	"""
+
+	def __init__(self, raw_bytes, projection=None):
+		if raw_bytes[:1] != VERSION:
+			raise ValueError("Unknown entity encoding version", bytes(raw_bytes[:1]))
+		offsets = {}
+		try:
+			key, excluded, length, position = _read_entity_header(raw_bytes, 1)
+			for _ in range(length):
+				name, position = _read_str(raw_bytes, position)
+				size, start = _read_length(raw_bytes, position)
+				position = start + size
+				if projection is None or name in projection:
+					offsets[name] = (start, position)
+		except (IndexError, TypeError, UnicodeDecodeError) as exc:
+			raise ValueError("Invalid entity encoding", exc)
+		if position != len(raw_bytes):
+			raise ValueError("Trailing bytes after the entity")
+		super(LazyEntity, self).__init__(
+			key=key, exclude_from_indexes=excluded, projection=projection or ()
+		)
+		dict.update(self, dict.fromkeys(offsets, _PENDING))
+		self._raw = raw_bytes
+		self._offsets = offsets
+
+	@property
+	def is_lazy(self):
+		"""``True`` as long as some properties are not decoded yet."""
+		return self._offsets is not None
+
+	def _decode(self, name):
+		offsets, raw_bytes = self._offsets, self._raw
+		if offsets is not None and raw_bytes is not None:
+			start, end = offsets[name]
+			value = _read_value(bytes(raw_bytes[start:end]), 0)[0]
+			if dict.get(self, name) is _PENDING:
+				dict.__setitem__(self, name, value)
+		# Decoded by another thread meanwhile, if not by us.
+		return dict.__getitem__(self, name)
+
+	def _decode_all(self):
+		"""Decode the remaining properties."""
+		if self._offsets is None:
+			return
+		for name, value in list(dict.items(self)):
+			if value is _PENDING:
+				self._decode(name)
+		self._offsets = None
+		self._raw = None
+
+	def __getitem__(self, name):
+		value = dict.__getitem__(self, name)
+		if value is _PENDING:
+			return self._decode(name)
+		return value
+
+	def get(self, name, default=None):
+		value = dict.get(self, name, default)
+		if value is _PENDING:
+			return self._decode(name)
+		return value
+
+	def __iter__(self):
+		# Overridden, so dict(entity) and update(entity) use __getitem__.
+		return dict.__iter__(self)
+
+	def values(self):
+		self._decode_all()
+		return super(LazyEntity, self).values()
+
+	def items(self):
+		self._decode_all()
+		return super(LazyEntity, self).items()
+
+	def __eq__(self, other):
+		self._decode_all()
+		if isinstance(other, LazyEntity):
+			other._decode_all()
+		return super(LazyEntity, self).__eq__(other)
+
+	def __ne__(self, other):
+		return not self == other
+
+	def __repr__(self):
+		self._decode_all()
+		return super(LazyEntity, self).__repr__()
+
+	def __reduce__(self):
+		# Pickle as a plain entity.
+		return (_unpickle_entity, (
+			self.key, self.exclude_from_indexes, list(self.items()), self._meanings,
+			self._projection,
+		))
+
+	def _mutating(method):
+		@functools.wraps(method)
+		def wrapper(self, *args, **kwargs):
+			self._decode_all()
+			return method(self, *args, **kwargs)
+		return wrapper
+
+	__setitem__ = _mutating(Entity.__setitem__)
+	__delitem__ = _mutating(Entity.__delitem__)
+	__ior__ = _mutating(Entity.__ior__)
+	clear = _mutating(Entity.clear)
+	pop = _mutating(Entity.pop)
+	popitem = _mutating(Entity.popitem)
+	setdefault = _mutating(Entity.setdefault)
+	update = _mutating(Entity.update)
+	del _mutating
+
+
+def _unpickle_entity(key, exclude_from_indexes, items, meanings, projection=()):
+	entity = Entity(
+		key=key, exclude_from_indexes=exclude_from_indexes, projection=projection
+	)
+	entity.update(items)
+	entity._meanings = meanings
+	return entity
+
+
+def encode_entities(entities):
+	"""Encode a stream of entities.
+
+	:type entities: iterable of :class:`~.entity.Entity`
+	:param entities: The entities to encode.
+
+	:rtype: iterator of bytes
+	:returns: One length prefixed chunk per entity; their concatenation
+			  can be read by :func:`decode_entities`.
+	"""
+	for entity in entities:
+		raw_bytes = encode_entity(entity)
+		out = bytearray()
+		_write_length(out, len(raw_bytes))
+		out += raw_bytes
+		yield bytes(out)
+
+
+def decode_entities(stream, chunk_size=65536, lazy=False):
+	"""Decode a stream written by :func:`encode_entities`.
+
+	:type stream: bytes or file-like object
+	:param stream: The encoded entities, or a binary file to read them
+				   from in chunks of ``chunk_size`` bytes.
+
+	:type lazy: bool
+	:param lazy: (Optional) Return :class:`LazyEntity` objects.
+
+	:rtype: iterator of :class:`~.entity.Entity`
+	:raises: :class:`ValueError` if the stream ends inside an entity.
+	"""
+	decode = LazyEntity if lazy else decode_entity
+	if isinstance(stream, (bytes, bytearray, memoryview)):
+		read = iter((bytes(stream),)).__next__
+	else:
+		read = lambda: stream.read(chunk_size)  # noqa: E731
+	buffer = b""
+	position = 0
+	while True:
+		length = None
+		try:
+			length, start = _read_length(buffer, position)
+		except IndexError:
+			pass
+		if length is not None and start + length <= len(buffer):
+			yield decode(buffer[start:start + length])
+			position = start + length
+			continue
+		try:
+			chunk = read()
+		except StopIteration:
+			chunk = b""
+		if not chunk:
+			if position != len(buffer):
+				raise ValueError("Truncated entity stream")
+			return
+		buffer = buffer[position:] + chunk
+		position = 0
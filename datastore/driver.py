@@ -0,0 +1,462 @@
+# Copyright 2020 Andreas H. Kelch
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+"""Backend driver interface and registry.
+
+A :class:`~.client.Client` talks to exactly one driver, which is resolved
+once when the client is constructed and held on ``client._driver``.
+"""
+import asyncio
+import concurrent.futures
+import functools
+import importlib
+
+from .helpers import decode_cursor, encode_cursor, project_entity
+
+DEFAULT_DRIVER = "xeno"
+
+_drivers = {}
+
+_BUILTIN_DRIVERS = {
+	"xeno": (".driver", "XenoDriver"),
+	"memory": (".memory", "MemoryDriver"),
+	"sqlite": (".sqlite", "SQLiteDriver"),
+}
+"""Drivers shipped with this package, imported on first use."""
+
+
+class Driver(object):
+	"""Interface every backend driver implements.
+
+	All methods take and return the objects of this package
+	(:class:`~.key.Key`, :class:`~.entity.Entity`,
+	:class:`~.query.Query`), never backend specific records.
+	"""
+
+	def connect(self):
+		"""Open the connection to the backend."""
+
+	def close(self):
+		"""Release the connection to the backend."""
+
+	def get_multi(self, keys, transaction=None):
+		"""Look up entities.
+
+		:type keys: list of :class:`~.key.Key`
+		:param keys: The (complete) keys to look up.
+
+		:type transaction: object
+		:param transaction: (Optional) Transaction handle returned by
+							:meth:`begin`.
+
+		:rtype: list of :class:`~.entity.Entity`
+		:returns: The entities which exist. Missing keys are skipped.
+		"""
+		raise NotImplementedError
+
+	def put_multi(self, entities, transaction=None):
+		"""Store entities, replacing any stored state.
+
+		Entities with a partial key get their key completed in place.
+
+		:type entities: list of :class:`~.entity.Entity`
+		:param entities: The entities to store.
+
+		:type transaction: object
+		:param transaction: (Optional) Transaction handle returned by
+							:meth:`begin`.
+		"""
+		raise NotImplementedError
+
+	def delete_multi(self, keys, transaction=None):
+		"""Delete entities.
+
+		:type keys: list of :class:`~.key.Key`
+		:param keys: The (complete) keys to delete.
+
+		:type transaction: object
+		:param transaction: (Optional) Transaction handle returned by
+							:meth:`begin`.
+		"""
+		raise NotImplementedError
+
+	def run_query(
+		self,
+		query,
+		limit=None,
+		offset=0,
+		start_cursor=None,
+		end_cursor=None,
+		transaction=None,
+	):
+		"""Execute a query.
+
+		:type query: :class:`~.query.Query`
+		:param query: The query to run.
+
+		:type limit: int
+		:param limit: (Optional) Maximum number of results to return.
+
+		:type offset: int
+		:param offset: (Optional) Number of results to skip.
+
+		:type start_cursor: bytes
+		:param start_cursor: (Optional) Cursor to resume the query at.
+
+		:type end_cursor: bytes
+		:param end_cursor: (Optional) Cursor to stop the query at.
+
+		:type transaction: object
+		:param transaction: (Optional) Transaction handle returned by
+							:meth:`begin`.
+
+		:rtype: tuple
+		:returns: ``(entities, cursor, more_results)`` where ``cursor``
+				  points behind the last returned entity (or is ``None``)
+				  and ``more_results`` tells if the query has more results.
+				  Keys only queries return :class:`~.key.Key` objects,
+				  projection queries entities holding only the projected
+				  properties and marked with
+				  :attr:`~.entity.Entity.is_projection`.
+		"""
+		raise NotImplementedError
+
+	def versions(self, keys, transaction=None):
+		"""Look up the version stamps of entities.
+
+		Every write (put or delete) of a key must change its version, so
+		:class:`~.transaction.Transaction` can detect concurrent changes.
+
+		:type keys: list of :class:`~.key.Key`
+		:param keys: The (complete) keys to look up.
+
+		:type transaction: object
+		:param transaction: (Optional) Transaction handle returned by
+							:meth:`begin`.
+
+		:rtype: list of int or ``NoneType``
+		:returns: One version per key, ``0`` for keys never written, or
+				  ``None`` if the backend does not track versions.
+		"""
+		return None
+
+	def begin(self):
+		"""Start a backend transaction.
+
+		:rtype: object
+		:returns: An opaque transaction handle, or ``None``.
+		"""
+
+	def commit(self, transaction):
+		"""Commit a transaction started by :meth:`begin`."""
+
+	def rollback(self, transaction):
+		"""Roll back a transaction started by :meth:`begin`."""
+
+	def allocate_ids(self, incomplete_key, num_ids):
+		"""Allocate IDs for a partial key.
+
+		:type incomplete_key: :class:`~.key.Key`
+		:param incomplete_key: Partial key to use as base for allocated IDs.
+
+		:type num_ids: int
+		:param num_ids: The number of IDs to allocate.
+
+		:rtype: list of :class:`~.key.Key`
+		:returns: The (complete) keys.
+		"""
+		raise NotImplementedError
+
+
+class XenoDriver(Driver):
+	"""Driver for the xeno-project ``dbinterface``.
+
+	``dbinterface`` returns all results of a query at once, so offsets,
+	limits and cursors are applied here: cursors hold the index of a
+	result and every page runs the query again.
+	"""
+
+	def __init__(self):
+		from viur.xeno.databases import dbinterface
+		self._dbinterface = dbinterface
+
+	def connect(self):
+		self._dbinterface.connect()
+
+	def get_multi(self, keys, transaction=None):
+		return self._dbinterface.get_multi(keys)
+
+	def put_multi(self, entities, transaction=None):
+		put = self._dbinterface.put
+		for entity in entities:
+			put(entity)
+
+	def delete_multi(self, keys, transaction=None):
+		delete = self._dbinterface.delete
+		for key in keys:
+			delete(key)
+
+	def run_query(
+		self,
+		query,
+		limit=None,
+		offset=0,
+		start_cursor=None,
+		end_cursor=None,
+		transaction=None,
+	):
+		entities = self._dbinterface.query(query)
+		start, end = 0, len(entities)
+		if start_cursor is not None:
+			start = min(self._cursor_index(start_cursor), end)
+		if end_cursor is not None:
+			end = max(min(self._cursor_index(end_cursor), end), start)
+		start = min(start + (offset or 0), end)
+		stop = end if limit is None else min(start + limit, end)
+
+		entities = entities[start:stop]
+		if query.projection:
+			# dbinterface returns whole entities, project them here.
+			entities = [project_entity(entity, query.projection) for entity in entities]
+		return entities, encode_cursor((stop,)), stop < end
+
+	@staticmethod
+	def _cursor_index(cursor):
+		position = decode_cursor(cursor)
+		if len(position) != 1 or not isinstance(position[0], int) or position[0] < 0:
+			raise ValueError("Invalid cursor", cursor)
+		return position[0]
+
+	def begin(self):
+		self._dbinterface.transaction_start()
+		self._dbinterface.transaction_rollback()
+
+	def commit(self, transaction):
+		self._dbinterface.transaction_commit()
+
+	def rollback(self, transaction):
+		self._dbinterface.transaction_rollback()
+
+	def allocate_ids(self, incomplete_key, num_ids):
+		if num_ids > 1:
+			raise ValueError("Actually you can only request one Key")
+
+		try:
+			new_id = str(self._dbinterface.generateID())
+		except:  # noqa: E722 do not use bare except, specify exception instead
+			from random import random
+			from time import time
+			new_id = int(time() * 1000) ^ int(random() * 10000000000000)  # we need something better
+
+		return [incomplete_key.completed_key(new_id)]
+
+
+class AsyncDriver(object):
+	"""Interface of drivers with native :mod:`asyncio` support.
+
+	The methods are those of :class:`Driver`, as coroutines. Used by
+	:class:`~.async_client.AsyncClient`; plain drivers are wrapped in a
+	:class:`ThreadedAsyncDriver`.
+	"""
+
+	async def connect(self):
+		"""Open the connection to the backend."""
+
+	async def close(self):
+		"""Release the connection to the backend."""
+
+	async def get_multi(self, keys, transaction=None):
+		raise NotImplementedError
+
+	async def put_multi(self, entities, transaction=None):
+		raise NotImplementedError
+
+	async def delete_multi(self, keys, transaction=None):
+		raise NotImplementedError
+
+	async def run_query(
+		self,
+		query,
+		limit=None,
+		offset=0,
+		start_cursor=None,
+		end_cursor=None,
+		transaction=None,
+	):
+		raise NotImplementedError
+
+	async def versions(self, keys, transaction=None):
+		return None
+
+	async def begin(self):
+		"""Start a backend transaction."""
+
+	async def commit(self, transaction):
+		"""Commit a transaction started by :meth:`begin`."""
+
+	async def rollback(self, transaction):
+		"""Roll back a transaction started by :meth:`begin`."""
+
+	async def allocate_ids(self, incomplete_key, num_ids):
+		raise NotImplementedError
+
+
+class _PinnedTransaction(object):
+	"""Transaction of a :class:`ThreadedAsyncDriver`.
+
+	Backend transactions are often bound to the thread which started them
+	(a connection, a lock), so all calls of one transaction run on a
+	thread of their own.
+	"""
+
+	def __init__(self):
+		self.executor = concurrent.futures.ThreadPoolExecutor(
+			1, thread_name_prefix="datastore-transaction"
+		)
+		self.handle = None
+
+
+class ThreadedAsyncDriver(AsyncDriver):
+	"""Run a blocking :class:`Driver` on a thread pool.
+
+	:type driver: :class:`Driver`
+	:param driver: The driver to wrap.
+
+	:type max_workers: int
+	:param max_workers: (Optional) Size of the thread pool, see
+						:class:`concurrent.futures.ThreadPoolExecutor`.
+	"""
+
+	def __init__(self, driver, max_workers=None):
+		self.driver = driver
+		self._max_workers = max_workers
+		self._executor = None
+
+	def _call(self, method, *args, **kwargs):
+		transaction = kwargs.get("transaction")
+		if self._executor is None:  # created again after close()
+			self._executor = concurrent.futures.ThreadPoolExecutor(
+				self._max_workers, thread_name_prefix="datastore"
+			)
+		executor = self._executor
+		if transaction is not None:
+			executor = transaction.executor
+			kwargs["transaction"] = transaction.handle
+		return asyncio.get_running_loop().run_in_executor(
+			executor, functools.partial(method, *args, **kwargs)
+		)
+
+	async def connect(self):
+		await self._call(self.driver.connect)
+
+	async def close(self):
+		try:
+			await self._call(self.driver.close)
+		finally:
+			executor, self._executor = self._executor, None
+			executor.shutdown(wait=False)
+
+	async def get_multi(self, keys, transaction=None):
+		return await self._call(self.driver.get_multi, keys, transaction=transaction)
+
+	async def put_multi(self, entities, transaction=None):
+		return await self._call(self.driver.put_multi, entities, transaction=transaction)
+
+	async def delete_multi(self, keys, transaction=None):
+		return await self._call(self.driver.delete_multi, keys, transaction=transaction)
+
+	async def run_query(
+		self,
+		query,
+		limit=None,
+		offset=0,
+		start_cursor=None,
+		end_cursor=None,
+		transaction=None,
+	):
+		return await self._call(
+			self.driver.run_query,
+			query,
+			limit=limit,
+			offset=offset,
+			start_cursor=start_cursor,
+			end_cursor=end_cursor,
+			transaction=transaction,
+		)
+
+	async def versions(self, keys, transaction=None):
+		return await self._call(self.driver.versions, keys, transaction=transaction)
+
+	async def begin(self):
+		transaction = _PinnedTransaction()
+		try:
+			transaction.handle = await asyncio.get_running_loop().run_in_executor(
+				transaction.executor, self.driver.begin
+			)
+		except BaseException:
+			transaction.executor.shutdown(wait=False)
+			raise
+		return transaction
+
+	async def commit(self, transaction):
+		try:
+			await self._call(self.driver.commit, transaction=transaction)
+		finally:
+			transaction.executor.shutdown(wait=False)
+
+	async def rollback(self, transaction):
+		try:
+			await self._call(self.driver.rollback, transaction=transaction)
+		finally:
+			transaction.executor.shutdown(wait=False)
+
+	async def allocate_ids(self, incomplete_key, num_ids):
+		return await self._call(self.driver.allocate_ids, incomplete_key, num_ids)
+
+
+def register_driver(name, factory):
+	"""Register a driver under ``name``.
+
+	:type name: str
+	:param name: The name used to select the driver, e.g. in
+				 ``Client(driver=name)``.
+
+	:type factory: callable
+	:param factory: Called with the driver options, returns a
+					:class:`Driver`. Usually the driver class itself.
+	"""
+	_drivers[name] = factory
+
+
+def get_driver(name, **options):
+	"""Instantiate the driver registered as ``name``.
+
+	:type name: str
+	:param name: The registered name of the driver.
+
+	:param options: Keyword arguments passed to the driver factory.
+
+	:rtype: :class:`Driver`
+	:returns: A new driver instance.
+	:raises: :class:`ValueError` if no driver is registered as ``name``.
+	"""
+	factory = _drivers.get(name)
+	if factory is None:
+		if name not in _BUILTIN_DRIVERS:
+			raise ValueError("Unknown driver", name)
+		module_name, class_name = _BUILTIN_DRIVERS[name]
+		module = importlib.import_module(module_name, __package__)
+		factory = getattr(module, class_name)
+		register_driver(name, factory)
+	return factory(**options)
@@ -19,11 +19,12 @@ from viur.database.datastore.key import Key
 
 class Entity(dict):
 
-	def __init__(self, key=None, exclude_from_indexes=()):
+	def __init__(self, key=None, exclude_from_indexes=(), projection=()):
 		super(Entity, self).__init__()
-		self.key = Key(*key) if isinstance(key,tuple) else key
+		self.key = Key.interned(key) if isinstance(key,tuple) else key
 		self.exclude_from_indexes = set(exclude_from_indexes)
 		self._meanings = {}
+		self._projection = tuple(projection)
 
 	def __eq__(self, other):
 		"""Compare two entities for equality.
@@ -55,6 +56,33 @@ class Entity(dict):
 		"""
 		return self != other
 
+	def copy(self):
+		"""Shallow copy of the entity.
+
+		:rtype: :class:`google.cloud.datastore.entity.Entity`
+		:returns: A new entity with the same key, properties and
+				  excluded indexes.
+		"""
+		clone = Entity(
+			key=self.key,
+			exclude_from_indexes=self.exclude_from_indexes,
+			projection=self._projection,
+		)
+		clone.update(self)
+		clone._meanings = dict(self._meanings)
+		return clone
+
+	@property
+	def is_projection(self):
+		"""Whether the entity is the result of a projection query.
+
+		Such entities only hold some of the stored properties, so they
+		can't be saved.
+
+		:rtype: bool
+		"""
+		return bool(self._projection)
+
 	@property
 	def kind(self):
 		"""Get the kind of the current entity.
@@ -97,12 +125,20 @@ class Entity(dict):
 
 
 	def toDict( self ):
+		"""Legacy dict representation, see :mod:`.codec` for a typed encoding.
+
+		The entity itself is not modified.
+
+		:rtype: dict
+		:returns: The properties plus the key under ``__keyDB__``.
+		"""
+		data = dict(self)
 		if self.key:
-			self["__keyDB__"] = {"ext.type":"key","kind":self.key.kind, "key":self.key.id_or_name}
+			data["__keyDB__"] = {"ext.type":"key","kind":self.key.kind, "key":self.key.id_or_name}
 
-		return dict(self)
+		return data
 
 	def fromDict( self ):
-		if self["__keyDB__"]:
-			self.key = Key(self["__keyDB__"]["kind"],self["__keyDB__"]["key"])
+		if self.get("__keyDB__"):
+			self.key = Key.interned((self["__keyDB__"]["kind"],self["__keyDB__"]["key"]))
 		return self
@@ -0,0 +1,259 @@
+# Copyright 2014 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# Modifications copyright 2020 Andreas H. Kelch
+#  - removed google dependency
+#
+"""Helper functions shared by the backend drivers."""
+import ast
+import base64
+import calendar
+import datetime
+
+from .key import Key
+from .entity import Entity
+from .geopoint import GeoPoint
+from .query import KEY_PROPERTY
+
+
+class _Max(object):
+	"""Sentinel which compares greater than everything else."""
+
+	def __eq__(self, other):
+		return other is self
+
+	def __ne__(self, other):
+		return other is not self
+
+	def __lt__(self, other):
+		return False
+
+	def __le__(self, other):
+		return other is self
+
+	def __gt__(self, other):
+		return other is not self
+
+	def __ge__(self, other):
+		return True
+
+	def __hash__(self):
+		return id(self)
+
+
+MAX = _Max()
+"""Appended to a sort key tuple to get an upper bound of all its extensions."""
+
+
+def key_token(key):
+	"""Sortable representation of a key path.
+
+	Ids sort before names, and a key sorts directly before all of its
+	descendants, so ``key_token(key) + (MAX,)`` bounds the range of its
+	descendants.
+
+	:type key: :class:`~.key.Key`
+	:param key: The key to convert.
+
+	:rtype: tuple
+	:returns: One ``(kind, (0, id))`` or ``(kind, (1, name))`` pair per
+			  path element.
+	"""
+	flat_path = key.flat_path
+	token = []
+	for index in range(0, len(flat_path), 2):
+		kind = flat_path[index]
+		if index + 1 < len(flat_path):
+			id_or_name = flat_path[index + 1]
+			if isinstance(id_or_name, int):
+				token.append((kind, (0, id_or_name)))
+			else:
+				token.append((kind, (1, id_or_name)))
+		else:
+			token.append((kind, (-1, None)))
+	return tuple(token)
+
+
+def value_sort_key(value):
+	"""Sortable representation of a property value.
+
+	Values of different types never compare equal; they are ordered by
+	type first: null, booleans, numbers, timestamps, strings, blobs,
+	geo points, keys.
+
+	:param value: A single (non-list) property value.
+
+	:rtype: tuple
+	:returns: ``(type_rank, comparable_value)``.
+	"""
+	if value is None:
+		return (0, None)
+	if isinstance(value, bool):
+		return (1, value)
+	if isinstance(value, (int, float)):
+		return (2, value)
+	if isinstance(value, datetime.datetime):
+		if value.tzinfo is not None:
+			value = value.astimezone(datetime.timezone.utc)
+		return (3, calendar.timegm(value.timetuple()) * 1000000 + value.microsecond)
+	if isinstance(value, str):
+		return (4, value)
+	if isinstance(value, bytes):
+		return (5, value)
+	if isinstance(value, GeoPoint):
+		return (6, (value.latitude, value.longitude))
+	if isinstance(value, Key):
+		return (7, key_token(value))
+	return (8, repr(value))
+
+
+def index_values(value):
+	"""Distinct sort keys a property value is indexed under.
+
+	List values are indexed once per element.
+
+	:param value: A property value.
+
+	:rtype: set of tuple
+	:returns: The :func:`value_sort_key` of every indexed element.
+	"""
+	if isinstance(value, list):
+		return set(value_sort_key(item) for item in value)
+	return {value_sort_key(value)}
+
+
+def project_entity(entity, projection):
+	"""Copy only the projected properties of an entity.
+
+	:type entity: :class:`~.entity.Entity`
+	:param entity: A stored entity.
+
+	:type projection: sequence of str
+	:param projection: The projected property names, ``__key__`` alone
+					   selects only the key.
+
+	:rtype: :class:`~.entity.Entity` or :class:`~.key.Key`
+	:returns: The key for keys only projections, else a new entity marked
+			  as projection result.
+	"""
+	names = [name for name in projection if name != KEY_PROPERTY]
+	if not names:
+		return entity.key
+	projected = Entity(key=entity.key, projection=names)
+	for name in names:
+		projected[name] = entity[name]
+	return projected
+
+
+def copy_entity(entity):
+	"""Copy an entity and its list values.
+
+	Used where entities are handed out more than once, so no holder can
+	change another's state.
+
+	:rtype: :class:`~.entity.Entity`
+	"""
+	clone = entity.copy()
+	for name, value in clone.items():
+		if isinstance(value, list):
+			clone[name] = list(value)
+	return clone
+
+
+def compare_positions(position, other, directions):
+	"""Compare two query result positions.
+
+	:type position: tuple
+	:param position: The sort values of a result, key token last.
+
+	:type other: tuple
+	:param other: The position to compare with.
+
+	:type directions: tuple of bool
+	:param directions: ``True`` for every descending element.
+
+	:rtype: int
+	:returns: ``-1``, ``0`` or ``1`` like ``cmp()`` in query order.
+	"""
+	for value, other_value, descending in zip(position, other, directions):
+		if value != other_value:
+			result = -1 if value < other_value else 1
+			return -result if descending else result
+	return 0
+
+
+def encode_cursor(position):
+	"""Encode a query result position as an opaque cursor.
+
+	:type position: tuple
+	:param position: Position of the last consumed result.
+
+	:rtype: bytes
+	:returns: An urlsafe cursor.
+	"""
+	raw_bytes = repr(position).encode()
+	return base64.urlsafe_b64encode(raw_bytes).strip(b"=")
+
+
+def decode_cursor(cursor):
+	"""Decode a cursor created by :func:`encode_cursor`.
+
+	:type cursor: bytes or str
+	:param cursor: The cursor.
+
+	:rtype: tuple
+	:returns: The encoded position.
+	:raises: :class:`ValueError` if the cursor is malformed.
+	"""
+	if isinstance(cursor, str):
+		cursor = cursor.encode()
+	padding = b"=" * (-len(cursor) % 4)
+	try:
+		position = ast.literal_eval(
+			base64.urlsafe_b64decode(cursor + padding).decode()
+		)
+	except (SyntaxError, ValueError, UnicodeDecodeError) as exc:
+		raise ValueError("Invalid cursor", cursor, exc)
+	if not isinstance(position, tuple):
+		raise ValueError("Invalid cursor", cursor)
+	return position
+
+
+def estimate_size(value):
+	"""Rough estimate of the encoded size of a value.
+
+	Used to bound the amount of data sent to a backend at once; it is
+	cheap to compute rather than exact.
+
+	:param value: An entity, key or property value.
+
+	:rtype: int
+	:returns: The estimated size in bytes.
+	"""
+	if isinstance(value, (str, bytes)):
+		return len(value) + 2
+	if isinstance(value, Key):
+		return sum(len(str(element)) + 2 for element in value.flat_path) + 4
+	if isinstance(value, dict):
+		size = 4
+		if isinstance(value, Entity) and value.key is not None:
+			size += estimate_size(value.key)
+		for name, item in value.items():
+			size += len(name) + 2 + estimate_size(item)
+		return size
+	if isinstance(value, (list, tuple)):
+		return sum(estimate_size(item) for item in value) + 2
+	if isinstance(value, GeoPoint):
+		return 18
+	return 9
@@ -15,10 +15,74 @@
 # Modifications copyright 2020 Andreas H. Kelch
 #  - removed google dependency
 #
-import copy,six
-import json, base64
+import functools
+import six
+import json, binascii
+
+_interned = None
+"""Bounded cache returning shared :class:`Key` instances, if enabled."""
+
+
+def _key_from_flat_path(flat_path, project, namespace):
+	"""Unpickle a :class:`Key`, see :meth:`Key.__reduce__`."""
+	return Key._from_flat_path(flat_path, project, namespace)
+
+
+def _new_key(flat_path, project, namespace):
+	return Key(*flat_path, project=project, namespace=namespace)
+
+
+def _decoded_key(flat_path, project, namespace):
+	"""Key from a decoded, already validated flat path tuple.
+
+	Skips the validation of the constructor; shared if interning is on.
+	"""
+	if _interned is None:
+		return Key._from_flat_path(flat_path, project, namespace)
+	return _interned(flat_path, project, namespace)
+
+
+def set_key_interning(maxsize=65536):
+	"""Enable or disable interning of keys.
+
+	While enabled, :meth:`Key.interned` returns the same instance for the
+	same flat path, project and namespace as long as the key is among the
+	``maxsize`` most recently used ones. Keys built while decoding entities
+	and urlsafe strings are interned, so large result sets and caches share
+	their key objects and compare keys by identity first.
+
+	:type maxsize: int
+	:param maxsize: (Optional) Number of keys to keep. ``0`` or ``None``
+					disables interning.
+	"""
+	global _interned
+	if maxsize:
+		_interned = functools.lru_cache(maxsize=maxsize)(_new_key)
+	else:
+		_interned = None
+
+
+def key_interning_info():
+	"""Statistics of the intern table.
+
+	:rtype: :func:`functools.lru_cache` ``CacheInfo`` or ``NoneType``
+	:returns: Hits, misses, maxsize and current size, or ``None`` if
+			  interning is disabled.
+	"""
+	if _interned is None:
+		return None
+	return _interned.cache_info()
+
 
 class Key(object):
+	"""An immutable key.
+
+	Keys only store their flat path, project and namespace; everything else
+	is derived from the flat path on access. The hash is computed once, so
+	keys are cheap to use in sets and as dict keys.
+	"""
+
+	__slots__ = ("_flat_path", "_project", "_namespace", "_parent", "_hash")
 
 	def __init__(self, *path_args, **kwargs):
 		'''
@@ -29,7 +93,53 @@ class Key(object):
 		self._namespace = kwargs.get("namespace")
 		project = kwargs.get("project")
 		self._project = project
-		self._path = self._combine_args()
+		self._combine_args()
+		self._hash = hash((self._flat_path, self._project, self._namespace))
+
+	@classmethod
+	def _from_flat_path(cls, flat_path, project, namespace):
+		"""Create a key from an already validated flat path.
+
+		:type flat_path: tuple
+		:param flat_path: The complete flat path, including all ancestors.
+
+		:rtype: :class:`google.cloud.datastore.key.Key`
+		"""
+		key = cls.__new__(cls)
+		key._flat_path = flat_path
+		key._project = project
+		key._namespace = namespace
+		key._parent = None
+		key._hash = hash((flat_path, project, namespace))
+		return key
+
+	@classmethod
+	def interned(cls, flat_path, project=None, namespace=None):
+		"""Get the shared instance of a key, see :func:`set_key_interning`.
+
+		:type flat_path: tuple
+		:param flat_path: The complete flat path, including all ancestors.
+
+		:type project: str
+		:param project: (Optional) The project of the key.
+
+		:type namespace: str
+		:param namespace: (Optional) The namespace of the key.
+
+		:rtype: :class:`google.cloud.datastore.key.Key`
+		:returns: A new key if interning is disabled, else the shared one.
+		"""
+		if _interned is None or cls is not Key:
+			return cls(*flat_path, project=project, namespace=namespace)
+		return _interned(tuple(flat_path), project, namespace)
+
+	def __reduce__(self):
+		# The cached hash must not be pickled, string hashes differ between
+		# processes.
+		return (
+			_key_from_flat_path,
+			(self._flat_path, self._project, self._namespace),
+		)
 
 	def __eq__(self, other):
 		"""Compare two keys for equality.
@@ -45,13 +155,17 @@ class Key(object):
 		if not isinstance(other, Key):
 			return NotImplemented
 
-		if self.is_partial or other.is_partial:
+		if len(self._flat_path) % 2 or len(other._flat_path) % 2:
 			return False
 
+		if self is other:
+			return True
+
 		return (
-			self.flat_path == other.flat_path
-			and self.project == other.project
-			and self.namespace == other.namespace
+			self._hash == other._hash
+			and self._flat_path == other._flat_path
+			and self._project == other._project
+			and self._namespace == other._namespace
 		)
 
 	def __ne__(self, other):
@@ -65,7 +179,10 @@ class Key(object):
 		:rtype: bool
 		:returns: False if the keys compare equal, else True.
 		"""
-		return not self == other
+		result = self.__eq__(other)
+		if result is NotImplemented:
+			return result
+		return not result
 
 	def __hash__(self):
 		"""Hash a keys for use in a dictionary lookp.
@@ -73,7 +190,7 @@ class Key(object):
 		:rtype: int
 		:returns: a hash of the key's state.
 		"""
-		return hash(self.flat_path) + hash(self.project) + hash(self.namespace)
+		return self._hash
 
 	@staticmethod
 	def _parse_path(path_args):
@@ -84,9 +201,6 @@ class Key(object):
 		if len(path_args) == 0:
 			raise Exception
 
-		import logging
-
-
 		kind_list = path_args[::2]
 		id_or_name_list = list(path_args[1::2])
 		partial_ending = object()
@@ -99,8 +213,6 @@ class Key(object):
 			curr_key_path = {
 				"kind": kind
 			}
-			#logging.error(id_or_name)
-			#logging.error(kind)
 			if isinstance(id_or_name, str):
 				curr_key_path["name"] = id_or_name
 			elif isinstance(id_or_name, int):
@@ -112,15 +224,22 @@ class Key(object):
 
 		return result
 
+	@staticmethod
+	def _validate_path(path_args):
+		"""Check the types of a flat path, see :meth:`_parse_path`."""
+		if len(path_args) == 0:
+			raise Exception
+		for id_or_name in path_args[1::2]:
+			if not isinstance(id_or_name, (str, int)):
+				raise Exception
+
 	def _combine_args(self):
-		child_path = self._parse_path(self._flat_path)
+		self._validate_path(self._flat_path)
 
 		if self._parent:
 			if self._parent.is_partial:
 				raise Exception
 
-			child_path = self._parent.path + child_path
-
 			self._flat_path = self._parent.flat_path + self._flat_path
 
 			if self._namespace and self._namespace != self._parent.namespace:
@@ -133,8 +252,6 @@ class Key(object):
 
 			self._project = self._parent.project
 
-		return child_path
-
 	def _clone(self):
 		"""Duplicates the Key.
 		Most attributes are simple types, so don't require copying. Other
@@ -142,8 +259,8 @@ class Key(object):
 		:rtype: :class:`google.cloud.datastore.key.Key`
 		:returns: A new ``Key`` instance with the same data as the current one.
 		"""
-		cloned_self = self.__class__(
-			*self.flat_path, project=self.project, namespace=self.namespace
+		cloned_self = self._from_flat_path(
+			self._flat_path, self._project, self._namespace
 		)
 		# If the current parent has already been set, we re-use
 		# the same instance
@@ -163,16 +280,13 @@ class Key(object):
 		if not self.is_partial:
 			raise ValueError("Only a partial key can be completed.")
 
-		if isinstance(id_or_name, six.string_types):
-			id_or_name_key = "name"
-		elif isinstance(id_or_name, six.integer_types):
-			id_or_name_key = "id"
-		else:
+		if not isinstance(id_or_name, six.string_types + six.integer_types):
 			raise ValueError(id_or_name, "ID/name was not a string or integer.")
 
-		new_key = self._clone()
-		new_key._path[-1][id_or_name_key] = id_or_name
-		new_key._flat_path += (id_or_name,)
+		new_key = self._from_flat_path(
+			self._flat_path + (id_or_name,), self._project, self._namespace
+		)
+		new_key._parent = self._parent
 		return new_key
 
 	@property
@@ -183,7 +297,7 @@ class Key(object):
 		:returns: ``True`` if the last element of the key's path does not have
 				  an ``id`` or a ``name``.
 		"""
-		return self.id_or_name is None
+		return len(self._flat_path) % 2 == 1
 
 	@property
 	def namespace(self):
@@ -198,12 +312,12 @@ class Key(object):
 	def path(self):
 		"""Path getter.
 
-		Returns a copy so that the key remains immutable.
+		Returns a new list on every call, so the key remains immutable.
 
 		:rtype: :class:`list` of :class:`dict`
 		:returns: The (key) path of the current key.
 		"""
-		return copy.deepcopy(self._path)
+		return self._parse_path(self._flat_path)
 
 	@property
 	def flat_path(self):
@@ -221,7 +335,8 @@ class Key(object):
 		:rtype: str
 		:returns: The kind of the current key.
 		"""
-		return self.path[-1]["kind"]
+		flat_path = self._flat_path
+		return flat_path[-1] if len(flat_path) % 2 else flat_path[-2]
 
 	@property
 	def id(self):
@@ -230,7 +345,10 @@ class Key(object):
 		:rtype: int
 		:returns: The (integer) ID of the key.
 		"""
-		return self.path[-1].get("id")
+		id_or_name = self.id_or_name
+		if isinstance(id_or_name, int):
+			return id_or_name
+		return None
 
 	@property
 	def name(self):
@@ -239,7 +357,10 @@ class Key(object):
 		:rtype: str
 		:returns: The (string) name of the key.
 		"""
-		return self.path[-1].get("name")
+		id_or_name = self.id_or_name
+		if isinstance(id_or_name, str):
+			return id_or_name
+		return None
 
 	@property
 	def id_or_name(self):
@@ -249,7 +370,10 @@ class Key(object):
 		:returns: The last element of the key's path if it is either an ``id``
 				  or a ``name``.
 		"""
-		return self.id or self.name
+		flat_path = self._flat_path
+		if len(flat_path) % 2:
+			return None
+		return flat_path[-1]
 
 	@property
 	def project(self):
@@ -276,9 +400,7 @@ class Key(object):
 		else:
 			parent_args = self.flat_path[:-2]
 		if parent_args:
-			return Key(
-				*parent_args, project=self.project, namespace=self.namespace
-			)
+			return self._from_flat_path(parent_args, self.project, self.namespace)
 
 	@property
 	def parent(self):
@@ -297,29 +419,424 @@ class Key(object):
 	def __repr__(self):
 		return "<Key%s, project=%s>" % (self._flat_path, self.project)
 
+	def to_ordered_bytes(self):
+		"""Encode the path of the key with :func:`encode_path`.
+
+		The bytes of two keys compare like their paths, see
+		:func:`encode_path`. Project and namespace are not included.
+
+		:rtype: bytes
+		:raises: :class:`ValueError` if the key is partial.
+		"""
+		if self.is_partial:
+			raise ValueError("Cannot encode a partial key", self)
+		return encode_path(self._flat_path)
+
+	@classmethod
+	def from_ordered_bytes(cls, raw_bytes, project=None, namespace=None):
+		"""Decode a key encoded by :meth:`to_ordered_bytes`.
+
+		:type raw_bytes: bytes
+		:param raw_bytes: The encoded path.
+
+		:type project: str
+		:param project: (Optional) The project of the key.
+
+		:type namespace: str
+		:param namespace: (Optional) The namespace of the key.
+
+		:rtype: :class:`google.cloud.datastore.key.Key`
+		:raises: :class:`ValueError` if ``raw_bytes`` is not a valid path.
+		"""
+		return cls.interned(decode_path(raw_bytes), project=project, namespace=namespace)
+
 	def to_legacy_urlsafe( self, location_prefix = None ):
+		"""Encode the key as an urlsafe string.
+
+		The string is a versioned binary encoding, see
+		:func:`_encode_urlsafe`. :meth:`from_legacy_urlsafe` also accepts
+		the JSON based strings of earlier versions.
+
+		:type location_prefix: str
+		:param location_prefix: (Optional) Prefix for the project.
+
+		:rtype: bytes
+		:returns: The urlsafe base64 encoded key, without padding.
+		"""
 		if location_prefix is None:
-			project_id = self.project
+			project_id = self._project
 		else:
-			project_id = location_prefix + self.project
-
-		raw_bytes = json.dumps([self._flat_path,project_id,self.namespace]).encode()
+			project_id = location_prefix + self._project
 
-		return base64.urlsafe_b64encode( raw_bytes ).strip( b"=" )
+		raw_bytes = _encode_urlsafe(
+			self._flat_path, _encode_header(project_id, self._namespace)
+		)
+		return _to_urlsafe_base64(raw_bytes)
 
 	@classmethod
 	def from_legacy_urlsafe( cls, urlsafe ):
-		#try:
-		#	urlsafe = urlsafe.encode()
-		#except :
-		#	pass
-		padding = "=" * (-len( urlsafe ) % 4)
-		urlsafe += padding
-		raw_bytes = base64.urlsafe_b64decode( urlsafe )
-		import logging
-		#logging.error(urlsafe)
-		#logging.error(raw_bytes)
-		#logging.error(raw_bytes.decode("utf-8"))
-		keyobj = json.loads(raw_bytes.decode())
-
-		return cls( *keyobj[0], project = keyobj[1], namespace = keyobj[2] )
\ No newline at end of file
+		"""Decode a key encoded by :meth:`to_legacy_urlsafe`.
+
+		:type urlsafe: str or bytes
+		:param urlsafe: The encoded key, with or without padding.
+
+		:rtype: :class:`google.cloud.datastore.key.Key`
+		:raises: :class:`ValueError` if ``urlsafe`` is not a valid key.
+		"""
+		if isinstance(urlsafe, str):
+			urlsafe = urlsafe.encode()
+		raw_bytes = _from_urlsafe_base64(urlsafe)
+		if raw_bytes[:1] == _JSON_MARKER:
+			keyobj = json.loads(raw_bytes.decode())
+			flat_path, project, namespace = keyobj[0], keyobj[1], keyobj[2]
+		else:
+			flat_path, project, namespace = _decode_urlsafe(raw_bytes)
+			if cls is Key:
+				# The binary decoder only yields valid paths.
+				return _decoded_key(flat_path, project, namespace)
+
+		return cls.interned( flat_path, project = project, namespace = namespace )
+
+
+_ID_OFFSET = 1 << 63
+"""Added to ids to store them as unsigned 64 bit integers."""
+
+_ORDERED_ID = b"\x01"
+_ORDERED_NAME = b"\x02"
+
+
+def _escape(raw_bytes):
+	"""Terminate a string so that shorter strings sort first."""
+	return raw_bytes.replace(b"\x00", b"\x00\xff") + b"\x00\x01"
+
+
+def encode_path(flat_path):
+	"""Encode a complete key path to memcmp comparable bytes.
+
+	Every element is the escaped kind followed by ``\x01`` and the id as
+	big endian offset 64 bit integer, or by ``\x02`` and the escaped name.
+	The bytes compare like the paths: element by element, ids before
+	names, and a key right before its descendants. The encoding of a key
+	is a prefix of the encodings of all its descendants, so they form the
+	contiguous range ``[encoded, encoded + b"\xff")`` (UTF-8 never
+	contains ``\xff``).
+
+	:type flat_path: tuple
+	:param flat_path: The flat path of a complete key.
+
+	:rtype: bytes
+	:raises: :class:`ValueError` if an id is outside of the signed 64 bit
+			 range.
+	"""
+	parts = []
+	for index in range(0, len(flat_path), 2):
+		parts.append(_escape(flat_path[index].encode()))
+		id_or_name = flat_path[index + 1]
+		if isinstance(id_or_name, int):
+			if not -_ID_OFFSET <= id_or_name < _ID_OFFSET:
+				raise ValueError("Id out of range", id_or_name)
+			parts.append(_ORDERED_ID + (id_or_name + _ID_OFFSET).to_bytes(8, "big"))
+		else:
+			parts.append(_ORDERED_NAME + _escape(id_or_name.encode()))
+	return b"".join(parts)
+
+
+def _unescape(raw_bytes, position):
+	"""Read a string written by :func:`_escape`.
+
+	:rtype: tuple
+	:returns: ``(string, next_position)``.
+	"""
+	chunks = []
+	while True:
+		end = raw_bytes.index(b"\x00", position)
+		chunks.append(raw_bytes[position:end])
+		marker = raw_bytes[end + 1:end + 2]
+		position = end + 2
+		if marker == b"\x01":
+			return b"".join(chunks).decode(), position
+		if marker != b"\xff":
+			raise ValueError("Invalid string terminator", marker)
+		chunks.append(b"\x00")
+
+
+def decode_path(raw_bytes):
+	"""Decode a key path encoded by :func:`encode_path`.
+
+	:type raw_bytes: bytes
+	:param raw_bytes: The encoded path.
+
+	:rtype: tuple
+	:returns: The flat path.
+	:raises: :class:`ValueError` if ``raw_bytes`` is not a valid path.
+	"""
+	flat_path = []
+	position, end = 0, len(raw_bytes)
+	try:
+		while position < end:
+			kind, position = _unescape(raw_bytes, position)
+			flat_path.append(kind)
+			tag = raw_bytes[position:position + 1]
+			if tag == _ORDERED_ID:
+				flat_path.append(
+					int.from_bytes(raw_bytes[position + 1:position + 9], "big") - _ID_OFFSET
+				)
+				position += 9
+			elif tag == _ORDERED_NAME:
+				name, position = _unescape(raw_bytes, position + 1)
+				flat_path.append(name)
+			else:
+				raise ValueError("Invalid path element tag", tag)
+	except UnicodeDecodeError as exc:
+		raise ValueError("Invalid path", exc)
+	if position != end or not flat_path:
+		raise ValueError("Invalid path", raw_bytes)
+	return tuple(flat_path)
+
+
+_URLSAFE_VERSION = b"\x01"
+"""First byte of the binary urlsafe encoding."""
+
+_JSON_MARKER = b"["
+"""First byte of the JSON urlsafe encoding used before the binary one."""
+
+_ID, _NAME, _PARTIAL = 0, 1, 2
+"""Tags of a path element, stored in the low bits of the kind length."""
+
+
+_TO_URLSAFE = bytes.maketrans(b"+/", b"-_")
+_FROM_URLSAFE = bytes.maketrans(b"-_", b"+/")
+
+
+def _to_urlsafe_base64(raw_bytes):
+	"""Urlsafe base64 without padding, like :func:`base64.urlsafe_b64encode`."""
+	return binascii.b2a_base64(raw_bytes, newline=False).translate(_TO_URLSAFE).rstrip(b"=")
+
+
+def _from_urlsafe_base64(urlsafe):
+	"""Decode urlsafe base64 with or without padding."""
+	padding = b"=" * (-len(urlsafe) % 4)
+	try:
+		return binascii.a2b_base64((urlsafe + padding).translate(_FROM_URLSAFE))
+	except binascii.Error as exc:
+		raise ValueError("Invalid urlsafe key", exc)
+
+
+_SMALL_VARINTS = tuple(bytes((value,)) for value in range(0x80))
+"""Varints of a single byte, by value."""
+
+
+def _varint(value):
+	"""Encode an unsigned integer as a little endian base 128 varint."""
+	if value < 0x80:
+		return _SMALL_VARINTS[value]
+	out = bytearray()
+	while value >= 0x80:
+		out.append((value & 0x7f) | 0x80)
+		value >>= 7
+	out.append(value)
+	return bytes(out)
+
+
+def _read_varint(raw_bytes, position):
+	"""Decode a varint of more than one byte, starting at ``position``.
+
+	The single byte case is handled inline by the callers.
+
+	:rtype: tuple
+	:returns: ``(value, next_position)``.
+	"""
+	value = 0
+	shift = 0
+	while True:
+		byte = raw_bytes[position]
+		position += 1
+		value |= (byte & 0x7f) << shift
+		if byte < 0x80:
+			return value, position
+		shift += 7
+
+
+def _encode_string(value):
+	"""Length prefixed string; ``None`` is stored as length ``0``."""
+	if value is None:
+		return b"\x00"
+	raw = value.encode()
+	return _varint(len(raw) + 1) + raw
+
+
+@functools.lru_cache(maxsize=256)
+def _encode_header(project, namespace):
+	return _URLSAFE_VERSION + _encode_string(project) + _encode_string(namespace)
+
+
+def _encode_urlsafe(flat_path, header):
+	"""Binary urlsafe encoding (version 1) of a key.
+
+	Layout: version byte, project and namespace as length prefixed
+	strings, then per path element ``varint(len(kind) << 2 | tag)``, the
+	kind and, depending on the tag, the zigzag varint id or the length
+	prefixed name.
+	"""
+	parts = [header]
+	append = parts.append
+	length = len(flat_path)
+	for index in range(0, length, 2):
+		kind = flat_path[index].encode()
+		if index + 1 == length:
+			append(_varint(len(kind) << 2 | _PARTIAL))
+			append(kind)
+			break
+		id_or_name = flat_path[index + 1]
+		if id_or_name.__class__ is int:
+			append(_varint(len(kind) << 2 | _ID))
+			append(kind)
+			append(_varint(id_or_name << 1 if id_or_name >= 0 else (~id_or_name << 1) | 1))
+		elif isinstance(id_or_name, int):  # bool and other int subclasses
+			append(_varint(len(kind) << 2 | _ID))
+			append(kind)
+			id_or_name = int(id_or_name)
+			append(_varint(id_or_name << 1 if id_or_name >= 0 else (~id_or_name << 1) | 1))
+		else:
+			name = id_or_name.encode()
+			append(_varint(len(kind) << 2 | _NAME))
+			append(kind)
+			append(_varint(len(name)))
+			append(name)
+	return b"".join(parts)
+
+
+_decoded_headers = {}
+"""Project and namespace of recently decoded urlsafe headers."""
+
+_MAX_DECODED_HEADERS = 256
+
+
+def _decode_header(raw_bytes):
+	"""Read the version, project and namespace of an urlsafe key.
+
+	:rtype: tuple
+	:returns: ``(project, namespace, next_position)``.
+	"""
+	if raw_bytes[:1] != _URLSAFE_VERSION:
+		raise ValueError("Unknown urlsafe key version", raw_bytes[:1])
+	strings = []
+	position = 1
+	for _ in range(2):
+		length = raw_bytes[position]
+		if length < 0x80:
+			position += 1
+		else:
+			length, position = _read_varint(raw_bytes, position)
+		if length:
+			strings.append(raw_bytes[position:position + length - 1].decode())
+			position += length - 1
+		else:
+			strings.append(None)
+	if position > len(raw_bytes):
+		raise IndexError("Truncated header")
+	return strings[0], strings[1], position
+
+
+def _decode_urlsafe(raw_bytes):
+	"""Decode :func:`_encode_urlsafe`.
+
+	Single byte varints, the common case for lengths, are read inline,
+	and the project and namespace of recently seen headers are looked up
+	instead of decoded.
+
+	:rtype: tuple
+	:returns: ``(flat_path, project, namespace)``.
+	:raises: :class:`ValueError` if the encoding is invalid.
+	"""
+	try:
+		header = None
+		project_length = raw_bytes[1]
+		if project_length < 0x80:
+			at = 1 + (project_length or 1)
+			namespace_length = raw_bytes[at]
+			if namespace_length < 0x80:
+				header = raw_bytes[:at + (namespace_length or 1)]
+		decoded = _decoded_headers.get(header)
+		if decoded is None:
+			decoded = _decode_header(raw_bytes)
+			if header is not None:
+				if len(_decoded_headers) >= _MAX_DECODED_HEADERS:
+					_decoded_headers.clear()
+				_decoded_headers[header] = decoded
+		project, namespace, position = decoded
+
+		flat_path = []
+		append = flat_path.append
+		end = len(raw_bytes)
+		while position < end:
+			header = raw_bytes[position]
+			if header < 0x80:
+				position += 1
+			else:
+				header, position = _read_varint(raw_bytes, position)
+			length = header >> 2
+			append(raw_bytes[position:position + length].decode())
+			position += length
+			tag = header & 3
+			if tag == _ID:
+				value = raw_bytes[position]
+				if value < 0x80:
+					position += 1
+				else:
+					value, position = _read_varint(raw_bytes, position)
+				append(~(value >> 1) if value & 1 else value >> 1)
+			elif tag == _NAME:
+				length = raw_bytes[position]
+				if length < 0x80:
+					position += 1
+				else:
+					length, position = _read_varint(raw_bytes, position)
+				append(raw_bytes[position:position + length].decode())
+				position += length
+			elif tag != _PARTIAL or position != end:
+				raise ValueError("Invalid path element tag", tag)
+	except (IndexError, UnicodeDecodeError) as exc:
+		raise ValueError("Invalid urlsafe key", exc)
+	if position != end or not flat_path:
+		raise ValueError("Invalid urlsafe key")
+	return tuple(flat_path), project, namespace
+
+
+def keys_to_legacy_urlsafe(keys, location_prefix=None):
+	"""Encode many keys, see :meth:`Key.to_legacy_urlsafe`.
+
+	The project/namespace header is encoded once per distinct pair.
+
+	:type keys: iterable of :class:`Key`
+	:param keys: The keys to encode.
+
+	:type location_prefix: str
+	:param location_prefix: (Optional) Prefix for the projects.
+
+	:rtype: list of bytes
+	"""
+	headers = {}
+	result = []
+	for key in keys:
+		scope = (key._project, key._namespace)
+		header = headers.get(scope)
+		if header is None:
+			project_id = key._project
+			if location_prefix is not None:
+				project_id = location_prefix + project_id
+			header = headers[scope] = _encode_header(project_id, key._namespace)
+		result.append(_to_urlsafe_base64(_encode_urlsafe(key._flat_path, header)))
+	return result
+
+
+def keys_from_legacy_urlsafe(urlsafes):
+	"""Decode many keys, see :meth:`Key.from_legacy_urlsafe`.
+
+	:type urlsafes: iterable of str or bytes
+	:param urlsafes: The encoded keys.
+
+	:rtype: list of :class:`Key`
+	:raises: :class:`ValueError` if one of them is not a valid key.
+	"""
+	return [Key.from_legacy_urlsafe(urlsafe) for urlsafe in urlsafes]
@@ -0,0 +1,285 @@
+# Copyright 2020 Andreas H. Kelch
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+"""Entity cache shared by processes through memcached.
+
+:class:`MemcacheEntityCache` is the second level behind the
+:class:`~.cache.EntityCache` of a :class:`~.client.Client`: lookups
+missing the in-process cache ask memcached, with one ``get`` per server,
+before going to the datastore, and store what they fetched there.
+
+Writes replace the cached entities with a short-lived empty tombstone
+instead of deleting them, and entities are stored with ``add``, which
+fails while the tombstone exists. So a lookup which read an entity before
+a write can't put the old state back into the cache after the write.
+
+The cache is best effort: memcached errors are logged and count as
+misses.
+"""
+import collections
+import hashlib
+import logging
+import socket
+import zlib
+
+from .codec import decode_entity, encode_entity
+from .pool import ConnectionPool
+
+logger = logging.getLogger(__name__)
+
+_FORMAT_VERSION = 1
+"""Part of every memcached key, bumped when the stored format changes."""
+
+_MAX_KEY_LENGTH = 250
+
+_MAX_KEYS_PER_GET = 100
+
+
+class _Connection(object):
+	"""Socket to one memcached server."""
+
+	def __init__(self, address, timeout):
+		self.socket = socket.create_connection(address, timeout)
+		self.socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+		self.file = self.socket.makefile("rb")
+
+	def close(self):
+		self.file.close()
+		self.socket.close()
+
+	def send(self, data):
+		self.socket.sendall(data)
+
+	def line(self):
+		line = self.file.readline()
+		if not line.endswith(b"\r\n"):
+			raise ConnectionError("Connection to memcached closed")
+		return line[:-2]
+
+	def read(self, size):
+		data = self.file.read(size + 2)
+		if len(data) != size + 2:
+			raise ConnectionError("Connection to memcached closed")
+		return data[:-2]
+
+
+def _address(server):
+	host, _, port = server.rpartition(":")
+	return host, int(port)
+
+
+class MemcacheClient(object):
+	"""Minimal memcached client for the text protocol.
+
+	Keys are spread over the servers by their CRC32. Commands to one
+	server are pipelined: sent at once, then their replies are read.
+
+	:type servers: list of str
+	:param servers: ``host:port`` of every server.
+
+	:type timeout: float
+	:param timeout: (Optional) Socket timeout in seconds.
+
+	:type pool_size: int
+	:param pool_size: (Optional) Maximum connections per server.
+	"""
+
+	def __init__(self, servers, timeout=1.0, pool_size=4):
+		self._pools = [
+			ConnectionPool(
+				lambda address=_address(server): _Connection(address, timeout),
+				max_size=pool_size,
+				timeout=timeout,
+			)
+			for server in servers
+		]
+
+	def _server(self, key):
+		return self._pools[zlib.crc32(key) % len(self._pools)]
+
+	def _by_server(self, keys):
+		servers = {}
+		for key in keys:
+			servers.setdefault(self._server(key), []).append(key)
+		return servers
+
+	def _call(self, pool, function):
+		"""Run ``function(connection)``, dropping the connection on errors."""
+		connection = pool.checkout()
+		try:
+			result = function(connection)
+		except BaseException:
+			pool.checkin(connection, broken=True)
+			raise
+		pool.checkin(connection)
+		return result
+
+	def get_multi(self, keys):
+		"""Fetch values.
+
+		:type keys: list of bytes
+		:param keys: The keys to fetch.
+
+		:rtype: dict
+		:returns: The values found, by key.
+		"""
+		values = {}
+
+		def get(connection, keys):
+			for start in range(0, len(keys), _MAX_KEYS_PER_GET):
+				chunk = keys[start:start + _MAX_KEYS_PER_GET]
+				connection.send(b"get " + b" ".join(chunk) + b"\r\n")
+				while True:
+					line = connection.line()
+					if line == b"END":
+						break
+					parts = line.split()
+					if parts[0] != b"VALUE":
+						raise ValueError("Unexpected reply from memcached", line)
+					values[parts[1]] = connection.read(int(parts[3]))
+
+		for pool, server_keys in self._by_server(keys).items():
+			self._call(pool, lambda connection: get(connection, server_keys))
+		return values
+
+	def _store(self, command, items, expire):
+		def store(connection, items):
+			connection.send(b"".join(
+				b"%s %s 0 %d %d\r\n%s\r\n" % (command, key, expire, len(value), value)
+				for key, value in items
+			))
+			for _ in items:
+				reply = connection.line()
+				if reply not in (b"STORED", b"NOT_STORED"):
+					raise ValueError("Unexpected reply from memcached", reply)
+
+		servers = {}
+		for key, value in items:
+			servers.setdefault(self._server(key), []).append((key, value))
+		for pool, server_items in servers.items():
+			self._call(pool, lambda connection: store(connection, server_items))
+
+	def set_multi(self, items, expire=0):
+		"""Store values.
+
+		:type items: list of tuple
+		:param items: ``(key, value)`` pairs of bytes.
+
+		:type expire: int
+		:param expire: (Optional) Seconds until the values expire, never
+					   if ``0``.
+		"""
+		self._store(b"set", items, expire)
+
+	def add_multi(self, items, expire=0):
+		"""Store values of keys which have none, see :meth:`set_multi`."""
+		self._store(b"add", items, expire)
+
+	def close(self):
+		for pool in self._pools:
+			pool.close()
+
+
+class MemcacheEntityCache(object):
+	"""Second level entity cache in memcached.
+
+	Counts ``hits``, ``misses`` and ``errors`` in :attr:`stats`.
+
+	:type servers: list of str
+	:param servers: (Optional) ``host:port`` of the memcached servers.
+
+	:type prefix: str
+	:param prefix: (Optional) Prefix of the memcached keys, to share
+				   servers between applications.
+
+	:type ttl: int
+	:param ttl: (Optional) Seconds an entity is cached, forever if ``0``.
+
+	:type hold: int
+	:param hold: (Optional) Seconds after a write during which the entity
+				 isn't cached again.
+
+	:type timeout: float
+	:param timeout: (Optional) Socket timeout in seconds.
+	"""
+
+	def __init__(
+		self, servers=("127.0.0.1:11211",), prefix="datastore", ttl=3600, hold=2, timeout=1.0
+	):
+		self.ttl = ttl
+		self.hold = hold
+		self.stats = collections.Counter()
+		self._prefix = ("%s:%d:" % (prefix, _FORMAT_VERSION)).encode("ascii")
+		self._client = MemcacheClient(servers, timeout=timeout)
+
+	def _cache_key(self, key):
+		cache_key = self._prefix + key.to_legacy_urlsafe()
+		if len(cache_key) > _MAX_KEY_LENGTH:
+			cache_key = self._prefix + hashlib.sha1(cache_key).hexdigest().encode("ascii")
+		return cache_key
+
+	def lookup(self, keys):
+		"""Look up entities.
+
+		:type keys: list of :class:`~.key.Key`
+		:param keys: The keys to look up.
+
+		:rtype: tuple
+		:returns: ``(found, missing)``: a dict of the cached entities by
+				  key and the keys not cached, each once.
+		"""
+		cache_keys = dict((key, self._cache_key(key)) for key in keys)
+		try:
+			values = self._client.get_multi(list(cache_keys.values()))
+		except (OSError, ValueError):
+			logger.warning("memcached lookup failed", exc_info=True)
+			self.stats["errors"] += 1
+			values = {}
+
+		found = {}
+		missing = []
+		for key, cache_key in cache_keys.items():
+			value = values.get(cache_key)
+			if value:  # tombstones are empty
+				found[key] = decode_entity(value)
+			else:
+				missing.append(key)
+		self.stats["hits"] += len(found)
+		self.stats["misses"] += len(missing)
+		return found, missing
+
+	def fill(self, entities):
+		"""Cache entities fetched from the datastore."""
+		items = [(self._cache_key(entity.key), encode_entity(entity)) for entity in entities]
+		if not items:
+			return
+		try:
+			self._client.add_multi(items, self.ttl)
+		except (OSError, ValueError):
+			logger.warning("memcached fill failed", exc_info=True)
+			self.stats["errors"] += 1
+
+	def invalidate(self, keys):
+		"""Replace entities by tombstones, e.g. after they were written."""
+		items = [(self._cache_key(key), b"") for key in keys]
+		if not items:
+			return
+		try:
+			self._client.set_multi(items, self.hold)
+		except (OSError, ValueError):
+			logger.warning("memcached invalidation failed", exc_info=True)
+			self.stats["errors"] += 1
+
+	def close(self):
+		self._client.close()
@@ -0,0 +1,460 @@
+# Copyright 2020 Andreas H. Kelch
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+"""In-process reference driver.
+
+Entities live in plain dicts. Every kind keeps a sorted list of its key
+tokens and one sorted ``(value, key token)`` list per indexed property, so
+filters and orders are answered with :mod:`bisect` range lookups instead
+of scanning the kind.
+"""
+import bisect
+import functools
+import itertools
+import threading
+from operator import itemgetter
+
+from .driver import Driver
+from .entity import Entity
+from .helpers import (
+	MAX,
+	compare_positions,
+	decode_cursor,
+	encode_cursor,
+	index_values,
+	key_token,
+	project_entity,
+	value_sort_key,
+)
+from .query import KEY_PROPERTY
+
+
+def _clone(entity):
+	"""Copy an entity so callers can't modify the stored state."""
+	clone = Entity(key=entity.key, exclude_from_indexes=entity.exclude_from_indexes)
+	for name, value in entity.items():
+		clone[name] = _copied(value)
+	return clone
+
+
+def _copied(value):
+	"""Copy the mutable containers of a property value, at any depth."""
+	if isinstance(value, list):
+		return [_copied(item) for item in value]
+	if isinstance(value, Entity):
+		return _clone(value)
+	if isinstance(value, dict):
+		return {name: _copied(item) for name, item in value.items()}
+	return value
+
+
+def _sort(results, directions):
+	"""Sort ``(position, entity)`` pairs in query order."""
+	if any(directions):
+		results.sort(
+			key=functools.cmp_to_key(
+				lambda a, b: compare_positions(a[0], b[0], directions)
+			)
+		)
+	else:
+		results.sort(key=itemgetter(0))
+
+
+class _Scope(object):
+	"""Storage and indexes of one kind in one project and namespace."""
+
+	def __init__(self):
+		self.entities = {}
+		self.tokens = []
+		self.indexes = {}
+
+	def index(self, token, entity):
+		for name, value in entity.items():
+			if name in entity.exclude_from_indexes:
+				continue
+			entries = self.indexes.setdefault(name, [])
+			for sort_key in index_values(value):
+				bisect.insort(entries, (sort_key, token))
+
+	def unindex(self, token, entity):
+		for name, value in entity.items():
+			if name in entity.exclude_from_indexes:
+				continue
+			entries = self.indexes[name]
+			for sort_key in index_values(value):
+				position = bisect.bisect_left(entries, (sort_key, token))
+				del entries[position]
+
+	def put(self, entity):
+		token = key_token(entity.key)
+		stored = self.entities.get(token)
+		if stored is None:
+			bisect.insort(self.tokens, token)
+		else:
+			self.unindex(token, stored)
+		stored = _clone(entity)
+		self.entities[token] = stored
+		self.index(token, stored)
+
+	def delete(self, key):
+		token = key_token(key)
+		stored = self.entities.pop(token, None)
+		if stored is not None:
+			self.unindex(token, stored)
+			del self.tokens[bisect.bisect_left(self.tokens, token)]
+
+
+class _Transaction(object):
+	"""Handle of a :class:`MemoryDriver` transaction.
+
+	Writes are applied right away; ``undo`` holds the previous state of
+	every written key, as ``(key, stored entity or None, version)``, so
+	:meth:`MemoryDriver.rollback` can restore it.
+	"""
+
+	def __init__(self, lock):
+		self.lock = lock
+		self.undo = []
+
+
+class MemoryDriver(Driver):
+	"""Driver keeping all entities in memory.
+
+	Nothing is persisted; every instance is an independent, empty
+	datastore. All operations are serialized by a lock, so an instance can
+	be shared between threads. A transaction holds the lock from
+	:meth:`begin` until :meth:`commit` or :meth:`rollback`, and a rollback
+	undoes all of its writes.
+	"""
+
+	def __init__(self):
+		self._lock = threading.RLock()
+		self._scopes = {}
+		self._versions = {}
+		self._ids = itertools.count(1)
+
+	@staticmethod
+	def _scope_id(key):
+		return (key.project, key.namespace, key.kind)
+
+	def get_multi(self, keys, transaction=None):
+		entities = []
+		with self._lock:
+			for key in keys:
+				scope = self._scopes.get(self._scope_id(key))
+				if scope is None:
+					continue
+				entity = scope.entities.get(key_token(key))
+				if entity is not None:
+					entities.append(_clone(entity))
+		return entities
+
+	def put_multi(self, entities, transaction=None):
+		with self._lock:
+			for entity in entities:
+				if entity.key.is_partial:
+					entity.key = self._complete(entity.key)
+				if transaction is not None:
+					transaction.undo.append(self._saved(entity.key))
+				scope_id = self._scope_id(entity.key)
+				scope = self._scopes.get(scope_id)
+				if scope is None:
+					scope = self._scopes[scope_id] = _Scope()
+				scope.put(entity)
+				self._bump(entity.key)
+
+	def delete_multi(self, keys, transaction=None):
+		with self._lock:
+			for key in keys:
+				if transaction is not None:
+					transaction.undo.append(self._saved(key))
+				scope = self._scopes.get(self._scope_id(key))
+				if scope is not None:
+					scope.delete(key)
+				self._bump(key)
+
+	def _bump(self, key):
+		version_id = (key.project, key.namespace, key_token(key))
+		self._versions[version_id] = self._versions.get(version_id, 0) + 1
+
+	def _saved(self, key):
+		"""Current state of ``key``, for the undo log of a transaction."""
+		scope = self._scopes.get(self._scope_id(key))
+		stored = None if scope is None else scope.entities.get(key_token(key))
+		version = self._versions.get((key.project, key.namespace, key_token(key)))
+		return key, stored, version
+
+	def _restore(self, key, stored, version):
+		"""Undo a write, see :meth:`_saved`."""
+		scope = self._scopes.get(self._scope_id(key))  # scopes are never dropped
+		if stored is not None:
+			scope.put(stored)
+		elif scope is not None:
+			scope.delete(key)
+		version_id = (key.project, key.namespace, key_token(key))
+		if version is None:
+			self._versions.pop(version_id, None)
+		else:
+			self._versions[version_id] = version
+
+	def versions(self, keys, transaction=None):
+		with self._lock:
+			return [
+				self._versions.get((key.project, key.namespace, key_token(key)), 0)
+				for key in keys
+			]
+
+	def begin(self):
+		self._lock.acquire()
+		return _Transaction(self._lock)
+
+	def commit(self, transaction):
+		if transaction is not None:
+			transaction.lock.release()
+
+	def rollback(self, transaction):
+		if transaction is None:
+			return
+		try:
+			while transaction.undo:
+				self._restore(*transaction.undo.pop())
+		finally:
+			transaction.lock.release()
+
+	def allocate_ids(self, incomplete_key, num_ids):
+		with self._lock:
+			return [self._complete(incomplete_key) for _ in range(num_ids)]
+
+	def _complete(self, incomplete_key):
+		"""Complete a partial key with an id not in use yet."""
+		scope = self._scopes.get(self._scope_id(incomplete_key))
+		while True:
+			key = incomplete_key.completed_key(next(self._ids))
+			if scope is None or key_token(key) not in scope.entities:
+				return key
+
+	def run_query(
+		self,
+		query,
+		limit=None,
+		offset=0,
+		start_cursor=None,
+		end_cursor=None,
+		transaction=None,
+	):
+		orders = [
+			(name[1:], True) if name.startswith("-") else (name, False)
+			for name in query.order
+		]
+		directions = tuple(descending for _, descending in orders) + (False,)
+
+		with self._lock:
+			scopes = [
+				scope
+				for (project, namespace, kind), scope in self._scopes.items()
+				if project == query.project
+				and namespace == query.namespace
+				and (query.kind is None or kind == query.kind)
+			]
+			results = []
+			for scope in scopes:
+				results.extend(self._run_scope(scope, query, orders))
+
+		if len(scopes) > 1:
+			_sort(results, directions)
+
+		start = 0
+		if start_cursor is not None:
+			start = self._bisect(results, decode_cursor(start_cursor), directions)
+		end = len(results)
+		if end_cursor is not None:
+			end = self._bisect(results, decode_cursor(end_cursor), directions)
+		start = min(start + (offset or 0), end)
+		stop = end if limit is None else min(start + limit, end)
+
+		projection = query.projection
+		entities = []
+		for _, entity in results[start:stop]:
+			if projection:
+				entity = project_entity(entity, projection)
+			else:
+				entity = _clone(entity)
+			entities.append(entity)
+
+		if stop:
+			cursor = encode_cursor(results[stop - 1][0])
+		else:
+			cursor = start_cursor
+		return entities, cursor, stop < end
+
+	@staticmethod
+	def _bisect(results, position, directions):
+		"""Index of the first result behind ``position``."""
+		low, high = 0, len(results)
+		while low < high:
+			middle = (low + high) // 2
+			if compare_positions(results[middle][0], position, directions) <= 0:
+				low = middle + 1
+			else:
+				high = middle
+		return low
+
+	def _run_scope(self, scope, query, orders):
+		"""Collect the matching entities of one kind.
+
+		:rtype: list of tuple
+		:returns: ``(position, entity)`` pairs in key order, where
+				  ``position`` holds the sort values of ``orders`` followed
+				  by the key token.
+		"""
+		low, high = (), (MAX,)
+		candidates = None
+		key_filters = []
+		ranges = {}
+
+		if query.ancestor is not None:
+			low = key_token(query.ancestor)
+			high = low + (MAX,)
+
+		for name, operator, value in query.filters:
+			if name == KEY_PROPERTY:
+				key_filters.append((operator, key_token(value)))
+			elif operator == "=":
+				sort_key = value_sort_key(value)
+				matches = self._match(scope, name, (sort_key, False), (sort_key, True))
+				candidates = matches if candidates is None else candidates & matches
+			else:
+				bound = ranges.setdefault(name, [None, None])
+				sort_key = value_sort_key(value)
+				if operator in (">", ">="):
+					new_bound = (sort_key, operator == ">")
+					if bound[0] is None or new_bound > bound[0]:
+						bound[0] = new_bound
+				else:
+					new_bound = (sort_key, operator == "<=")
+					if bound[1] is None or new_bound < bound[1]:
+						bound[1] = new_bound
+
+		for name, (lower, upper) in ranges.items():
+			matches = self._match(scope, name, lower, upper)
+			candidates = matches if candidates is None else candidates & matches
+
+		for operator, token in key_filters:
+			# ``token + ((),)`` sorts after ``token`` but before its descendants.
+			if operator == "=":
+				low, high = max(low, token), min(high, token + ((),))
+			elif operator == ">":
+				low = max(low, token + ((),))
+			elif operator == ">=":
+				low = max(low, token)
+			elif operator == "<":
+				high = min(high, token)
+			elif operator == "<=":
+				high = min(high, token + ((),))
+
+		entities = scope.entities
+		if (
+			candidates is None
+			and not query.projection
+			and len(orders) == 1
+			and orders[0][0] != KEY_PROPERTY
+			and (low, high) == ((), (MAX,))
+		):
+			return self._walk_index(scope, orders[0][0], orders[0][1])
+
+		if candidates is None:
+			tokens = scope.tokens[
+				bisect.bisect_left(scope.tokens, low):bisect.bisect_left(scope.tokens, high)
+			]
+		else:
+			tokens = sorted(token for token in candidates if low <= token < high)
+
+		projection = [name for name in query.projection if name != KEY_PROPERTY]
+		results = []
+		for token in tokens:
+			entity = entities[token]
+			if projection and not all(
+				name in entity and name not in entity.exclude_from_indexes
+				for name in projection
+			):
+				continue
+			position = []
+			for name, descending in orders:
+				if name == KEY_PROPERTY:
+					position.append(token)
+					continue
+				if name not in entity or name in entity.exclude_from_indexes:
+					break
+				values = index_values(entity[name])
+				position.append(max(values) if descending else min(values))
+			else:
+				position.append(token)
+				results.append((tuple(position), entity))
+		if orders:
+			_sort(results, tuple(descending for _, descending in orders) + (False,))
+		return results
+
+	@staticmethod
+	def _walk_index(scope, name, descending):
+		"""Read a kind in the order of one property straight off its index.
+
+		Multi-valued properties are listed at their lowest (ascending) or
+		highest (descending) value only, like the datastore does.
+		"""
+		entries = scope.indexes.get(name, [])
+		if descending:
+			# Walk backwards but keep equal values in ascending key order.
+			entries = itertools.chain.from_iterable(
+				reversed(list(group))
+				for _, group in itertools.groupby(
+					reversed(entries), key=itemgetter(0)
+				)
+			)
+		seen = set()
+		results = []
+		entities = scope.entities
+		for sort_key, token in entries:
+			if token not in seen:
+				seen.add(token)
+				results.append(((sort_key, token), entities[token]))
+		return results
+
+	@staticmethod
+	def _match(scope, name, lower, upper):
+		"""Key tokens with an indexed value of ``name`` inside a range.
+
+		:type lower: tuple
+		:param lower: ``(sort_key, exclusive)``, or ``None`` if unbounded.
+
+		:type upper: tuple
+		:param upper: ``(sort_key, inclusive)``, or ``None`` if unbounded.
+
+		:rtype: set of tuple
+		"""
+		entries = scope.indexes.get(name)
+		if not entries:
+			return set()
+		if lower is None:
+			start = 0
+		elif lower[1]:
+			start = bisect.bisect_left(entries, (lower[0], MAX))
+		else:
+			start = bisect.bisect_left(entries, (lower[0],))
+		if upper is None:
+			stop = len(entries)
+		elif upper[1]:
+			stop = bisect.bisect_left(entries, (upper[0], MAX))
+		else:
+			stop = bisect.bisect_left(entries, (upper[0],))
+		return set(token for _, token in entries[start:stop])
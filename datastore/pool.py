@@ -0,0 +1,269 @@
+# Copyright 2020 Andreas H. Kelch
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+"""Connection pool for drivers.
+
+Pools are shared: :func:`acquire_pool` hands out the same pool for the
+same settings until every user released it, so clients with identical
+driver settings share their connections.
+
+A pool used in a forked child process drops the connections inherited
+from its parent, without closing them as they still belong to the
+parent, and opens new ones.
+"""
+import collections
+import contextlib
+import os
+import threading
+import time
+
+
+class ConnectionPool(object):
+	"""Bounded pool of backend connections.
+
+	:type connect: callable
+	:param connect: Opens a new connection.
+
+	:type close: callable
+	:param close: (Optional) Closes a connection. Defaults to calling its
+				  ``close()`` method.
+
+	:type check: callable
+	:param check: (Optional) Health check, raises if a connection is
+				  broken. Run when a connection idle for more than
+				  ``check_after`` seconds is checked out.
+
+	:type max_size: int
+	:param max_size: (Optional) Maximum number of open connections.
+
+	:type timeout: float
+	:param timeout: (Optional) Seconds :meth:`checkout` waits for a free
+					connection.
+
+	:type max_idle: float
+	:param max_idle: (Optional) Seconds after which idle connections are
+					 closed.
+
+	:type check_after: float
+	:param check_after: (Optional) Idle seconds before a connection is
+						checked.
+	"""
+
+	def __init__(
+		self,
+		connect,
+		close=None,
+		check=None,
+		max_size=10,
+		timeout=30.0,
+		max_idle=300.0,
+		check_after=30.0,
+	):
+		self._connect = connect
+		self._close = close or (lambda connection: connection.close())
+		self._check = check
+		self.max_size = max_size
+		self.timeout = timeout
+		self.max_idle = max_idle
+		self.check_after = check_after
+		self.stats = collections.Counter()
+		self._closed = False
+		self._reset()
+
+	def _reset(self):
+		"""Forget all connections, e.g. those inherited from a parent."""
+		self._pid = os.getpid()
+		self._condition = threading.Condition(threading.Lock())
+		self._idle = []  # (connection, last use), most recently used last
+		self._size = 0
+
+	@property
+	def size(self):
+		"""Number of open connections, idle or checked out."""
+		return self._size
+
+	def checkout(self, timeout=None):
+		"""Take a connection out of the pool.
+
+		:type timeout: float
+		:param timeout: (Optional) Seconds to wait for a free connection,
+						defaults to :attr:`timeout`.
+
+		:returns: A connection, to be given back with :meth:`checkin`.
+		:raises: :class:`TimeoutError` if no connection got free in time.
+		:raises: :class:`ValueError` if the pool is closed.
+		"""
+		if self._pid != os.getpid():
+			self._reset()
+		if timeout is None:
+			timeout = self.timeout
+		deadline = time.monotonic() + timeout
+
+		while True:
+			connection, last_use = self._take(deadline, timeout)
+			if connection is None:
+				return self._open()
+			if self._check is None or time.monotonic() - last_use < self.check_after:
+				return connection
+			try:
+				self._check(connection)
+			except Exception:
+				self.stats["broken"] += 1
+				self._discard(connection)
+			else:
+				return connection
+
+	def _take(self, deadline, timeout):
+		"""Pop an idle connection or reserve room for a new one.
+
+		:rtype: tuple
+		:returns: ``(connection, last use)``, or ``(None, None)`` if a new
+				  connection is to be opened.
+		"""
+		with self._condition:
+			while True:
+				if self._closed:
+					raise ValueError("Connection pool is closed")
+				self._evict()
+				if self._idle:
+					return self._idle.pop()
+				if self._size < self.max_size:
+					self._size += 1
+					return None, None
+				remaining = deadline - time.monotonic()
+				if remaining <= 0:
+					self.stats["timeouts"] += 1
+					raise TimeoutError(
+						"No connection available within %s seconds" % timeout
+					)
+				self.stats["waits"] += 1
+				self._condition.wait(remaining)
+
+	def _open(self):
+		try:
+			connection = self._connect()
+		except BaseException:
+			with self._condition:
+				self._size -= 1
+				self._condition.notify()
+			raise
+		self.stats["opened"] += 1
+		return connection
+
+	def _evict(self):
+		"""Close connections idle for longer than :attr:`max_idle`.
+
+		Must be called with the lock held.
+		"""
+		expired = time.monotonic() - self.max_idle
+		while self._idle and self._idle[0][1] < expired:
+			connection, _ = self._idle.pop(0)
+			self._size -= 1
+			self.stats["evicted"] += 1
+			self._close_quietly(connection)
+
+	def _close_quietly(self, connection):
+		try:
+			self._close(connection)
+		except Exception:
+			pass
+		self.stats["closed"] += 1
+
+	def _discard(self, connection):
+		with self._condition:
+			self._size -= 1
+			self._condition.notify()
+		self._close_quietly(connection)
+
+	def checkin(self, connection, broken=False):
+		"""Give a connection back to the pool.
+
+		:type broken: bool
+		:param broken: (Optional) Close the connection instead of reusing
+					   it.
+		"""
+		if self._pid != os.getpid():
+			return  # checked out before a fork, belongs to the parent
+		if broken or self._closed:
+			self._discard(connection)
+			return
+		with self._condition:
+			self._idle.append((connection, time.monotonic()))
+			self._condition.notify()
+
+	@contextlib.contextmanager
+	def connection(self, timeout=None):
+		"""Check out a connection for the duration of a ``with`` block."""
+		connection = self.checkout(timeout)
+		try:
+			yield connection
+		finally:
+			self.checkin(connection)
+
+	def close(self):
+		"""Close the idle connections, and the others once checked in."""
+		with self._condition:
+			self._closed = True
+			idle, self._idle = self._idle, []
+			self._size -= len(idle)
+			self._condition.notify_all()
+		if self._pid == os.getpid():
+			for connection, _ in idle:
+				self._close_quietly(connection)
+
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def acquire_pool(key, factory):
+	"""Use the shared pool for ``key``.
+
+	:type key: tuple
+	:param key: The settings of the pool, e.g. database and options.
+
+	:type factory: callable
+	:param factory: Creates the :class:`ConnectionPool` if there is none
+					for ``key`` yet.
+
+	:rtype: :class:`ConnectionPool`
+	:returns: The pool, to be given back with :func:`release_pool`.
+	"""
+	with _pools_lock:
+		entry = _pools.get(key)
+		if entry is None:
+			entry = _pools[key] = [factory(), 0]
+		entry[1] += 1
+		return entry[0]
+
+
+def release_pool(key):
+	"""Stop using the shared pool for ``key``, closing it if unused."""
+	with _pools_lock:
+		entry = _pools[key]
+		entry[1] -= 1
+		if entry[1]:
+			return
+		del _pools[key]
+	entry[0].close()
+
+
+def _after_fork():
+	global _pools_lock
+	# Another thread of the parent may have held the lock while forking.
+	_pools_lock = threading.Lock()
+
+
+if hasattr(os, "register_at_fork"):
+	os.register_at_fork(after_in_child=_after_fork)
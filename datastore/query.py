@@ -16,6 +16,8 @@
 #  - removed google dependency
 #
 import six, base64,logging
+import queue
+import threading
 from .key import Key
 from .entity import Entity
 
@@ -31,6 +33,9 @@ _FINISHED = (
 	"MORE RESULTS AFTER CURSOR",
 )
 
+DEFAULT_PAGE_SIZE = 500
+"""Number of results fetched per page unless ``page_size`` is given."""
+
 
 class Query(object):
 
@@ -66,8 +71,10 @@ class Query(object):
 		for property_name, operator, value in filters:
 			self.add_filter(property_name, operator, value)
 		self._projection = list(projection)
-		self._order = list(("order", order))
-		self._distinct_on = list(("distinct_on", distinct_on))
+		self._order = [order] if isinstance(order, str) else list(order)
+		self._distinct_on = (
+			[distinct_on] if isinstance(distinct_on, str) else list(distinct_on)
+		)
 
 	@property
 	def project(self):
@@ -255,6 +262,97 @@ class Query(object):
 			value = [value]
 		self._distinct_on[:] = value
 
+	def _copy(self):
+		return type(self)(
+			self._client,
+			kind=self._kind,
+			project=self._project,
+			namespace=self._namespace,
+			ancestor=self._ancestor,
+			filters=self._filters,
+			projection=self._projection,
+			order=self._order,
+			distinct_on=self._distinct_on,
+		)
+
+	def split(self, num_shards, sample_size=None):
+		"""Partition the query into queries over disjoint key ranges.
+
+		The boundaries are taken from evenly spaced matching keys, so the
+		ranges hold about the same number of results. The sample is read
+		one key at a time with keys only queries, each resuming at the
+		cursor of the previous one with a bounded offset which doubles
+		whenever the sample fills up; only the sampled keys are
+		transferred, never all of them. Together the queries return exactly the results
+		of this query. See
+		:meth:`~google.cloud.datastore.client.Client.fetch_parallel` to
+		run them.
+
+		:type num_shards: int
+		:param num_shards: The number of queries wanted.
+
+		:type sample_size: int
+		:param sample_size: (Optional) Number of keys sampled, defaults to
+							8 per shard; up to twice as many are kept.
+
+		:rtype: list of :class:`Query`
+		:returns: The queries in key order, fewer than ``num_shards`` if
+				  there are too few results.
+		:raises: :class:`ValueError` if ``num_shards`` is not positive.
+		"""
+		if num_shards < 1:
+			raise ValueError("num_shards must be positive", num_shards)
+		if num_shards == 1:
+			return [self._copy()]
+
+		sample_size = sample_size or 8 * num_shards
+		sampler = self._sampler()
+		sample, cursor, stride = [], None, 1
+		while True:
+			iterator = sampler.fetch(limit=1, offset=stride - 1, start_cursor=cursor)
+			keys = list(iterator)
+			if not keys:
+				break
+			sample.append(keys[0])
+			cursor = iterator.next_page_token
+			if cursor is None:
+				break
+			if len(sample) >= 2 * sample_size:
+				del sample[::2]  # the remaining keys are spaced twice as far
+				stride *= 2
+		return self._split_at(sample, num_shards)
+
+	def _sampler(self):
+		"""Keys only copy of the query, used to sample boundaries."""
+		sampler = self._copy()
+		sampler.keys_only()
+		sampler.order = []
+		sampler.distinct_on = []
+		return sampler
+
+	def _split_at(self, sample, num_shards):
+		"""Partition the query at keys picked from ``sample``."""
+		sample.sort(key=Key.to_ordered_bytes)
+		boundaries = []
+		for shard in range(1, num_shards):
+			if not sample:
+				break
+			key = sample[shard * len(sample) // num_shards]
+			if key != sample[0] and (not boundaries or key != boundaries[-1]):
+				boundaries.append(key)
+
+		queries = []
+		lower = None
+		for upper in boundaries + [None]:
+			query = self._copy()
+			if lower is not None:
+				query.key_filter(lower, ">=")
+			if upper is not None:
+				query.key_filter(upper, "<")
+			queries.append(query)
+			lower = upper
+		return queries
+
 	def fetch(
 		self,
 		limit=None,
@@ -263,7 +361,38 @@ class Query(object):
 		end_cursor=None,
 		client=None,
 		eventual=False,
+		page_size=DEFAULT_PAGE_SIZE,
+		prefetch=0,
 	):
+		"""Execute the query.
+
+		:type limit: int
+		:param limit: (Optional) Maximum number of results.
+
+		:type offset: int
+		:param offset: (Optional) Number of results to skip.
+
+		:type start_cursor: bytes
+		:param start_cursor: (Optional) Cursor to resume at, e.g. the
+							 ``next_page_token`` of an earlier iterator.
+
+		:type end_cursor: bytes
+		:param end_cursor: (Optional) Cursor to stop at.
+
+		:type client: :class:`~google.cloud.datastore.client.Client`
+		:param client: (Optional) Client to run the query with.
+
+		:type page_size: int
+		:param page_size: (Optional) Maximum number of results fetched from
+						  the backend at once.
+
+		:type prefetch: int
+		:param prefetch: (Optional) Number of pages fetched ahead on a
+						 background thread while the current one is
+						 consumed. ``0`` fetches every page on demand.
+
+		:rtype: :class:`Iterator`
+		"""
 		if client is None:
 			client = self._client
 
@@ -275,6 +404,8 @@ class Query(object):
 			start_cursor=start_cursor,
 			end_cursor=end_cursor,
 			eventual=eventual,
+			page_size=page_size,
+			prefetch=prefetch,
 		)
 
 
@@ -291,6 +422,8 @@ class Iterator(object):
 		start_cursor=None,
 		end_cursor=None,
 		eventual=False,
+		page_size=DEFAULT_PAGE_SIZE,
+		prefetch=0,
 	):
 		self._started = False
 		self.client = client
@@ -305,6 +438,25 @@ class Iterator(object):
 		self._eventual = eventual
 		self._more_results = True
 		self._skipped_results = 0
+		self._page_size = page_size
+		self._fetched = 0
+		self._cursor = start_cursor
+		self._prefetch = prefetch
+		self._cancelled = threading.Event()
+		self._query_cache = None
+		self._transaction = client.current_transaction
+		if self._transaction is None:
+			self._query_cache = client.query_cache
+
+	@property
+	def _tracked(self):
+		"""Whether results are whole entities read by a transaction."""
+		transaction = self._transaction
+		return (
+			transaction is not None
+			and transaction._status == transaction._IN_PROGRESS
+			and not self._query.projection
+		)
 
 	@property
 	def pages(self):
@@ -314,10 +466,14 @@ class Iterator(object):
 		return self._page_iter(increment=True)
 
 	def _items_iter(self):
-		for page in self._page_iter(increment=False):
-			for item in page:
-				self.num_results += 1
-				yield item
+		pages = self._page_iter(increment=False)
+		try:
+			for page in pages:
+				for item in page:
+					self.num_results += 1
+					yield item
+		finally:
+			pages.close()
 
 	def __iter__(self):
 		if self._started:
@@ -325,31 +481,155 @@ class Iterator(object):
 		self._started = True
 		return self._items_iter()
 
+	def close(self):
+		"""Stop fetching pages.
+
+		Only needed to stop a prefetching iterator which is not consumed
+		to the end; closing or dropping the iteration does the same.
+		"""
+		self._cancelled.set()
+
 	def _page_iter(self, increment):
-		page = self._next_page()
-		while page is not None:
-			self.page_number += 1
-			if increment:
-				self.num_results += page.num_items
-			yield page
-			page = self._next_page()
+		if self._prefetch:
+			pages = self._prefetched_pages()
+		else:
+			pages = iter(self._next_page, None)
+		try:
+			for page in pages:
+				self.page_number += 1
+				self.next_page_token = page.next_page_token
+				if increment:
+					self.num_results += page.num_items
+				yield page
+		finally:
+			self.close()
+
+	def _prefetched_pages(self):
+		"""Fetch pages on a background thread, up to ``prefetch`` ahead."""
+		pages = queue.Queue(maxsize=self._prefetch)
+		cancelled = self._cancelled
+
+		def fetch():
+			try:
+				while not cancelled.is_set():
+					page = self._next_page()
+					pages.put(page)
+					if page is None:
+						return
+			except Exception as exc:
+				pages.put(exc)
+
+		thread = threading.Thread(target=fetch, name="datastore-prefetch", daemon=True)
+		thread.start()
+		try:
+			while True:
+				page = pages.get()
+				if page is None:
+					return
+				if isinstance(page, Exception):
+					raise page
+				yield page
+		finally:
+			cancelled.set()
+			# Make room, so the fetching thread isn't stuck in put().
+			while True:
+				try:
+					pages.get_nowait()
+				except queue.Empty:
+					break
 
 	def _next_page(self):
+		request = self._page_request()
+		if request is None:
+			return None
+		cached, fingerprint, token = self._cached_page(request)
+		if cached is not None:
+			results, cursor, more_results, by_key = cached
+			if by_key:
+				results = self.client.get_multi(results)
+			return self._page(results, cursor, more_results)
+		# Transactions are optimistic: queries read committed state, and the
+		# entities they return are tracked like lookups.
+		entities, cursor, more_results = self.client.driver.run_query(self._query, **request)
+		if self._tracked:
+			entities = self._transaction._query_results(entities)
+		self._cache_page(fingerprint, token, entities, cursor, more_results)
+		return self._page(entities, cursor, more_results)
+
+	def _cached_page(self, request):
+		"""Look up the next page in the client's query cache.
+
+		Not used for iterators created inside a transaction.
+
+		:rtype: tuple
+		:returns: ``(page, fingerprint, token)``, see
+				  :meth:`~.cache.QueryCache.lookup`. ``fingerprint`` is
+				  ``None`` if the page is not to be cached.
+		"""
+		cache = self._query_cache
+		if cache is None:
+			return None, None, None
+		from .cache import query_fingerprint  # cache imports helpers, which import us
+		fingerprint = query_fingerprint(self._query, request)
+		if fingerprint is None:
+			return None, None, None
+		page, token = cache.lookup(fingerprint, self._query.kind)
+		return page, fingerprint, token
+
+	def _cache_page(self, fingerprint, token, results, cursor, more_results):
+		"""Store a page fetched after :meth:`_cached_page` missed."""
+		if fingerprint is None:
+			return
+		by_key = not self._query.projection
+		if by_key:
+			results = [entity.key for entity in results]
+		self._query_cache.store(
+			fingerprint, self._query.kind, results, cursor, more_results, by_key, token
+		)
+
+	def _page_request(self):
+		"""Arguments of the driver's ``run_query`` for the next page.
+
+		:rtype: dict
+		:returns: ``None`` if there are no more pages.
+		"""
 		if not self._more_results:
 			return None
 
-		transaction = self.client.current_transaction
-		if transaction is None:
-			transaction_id = None
-		else:
-			transaction_id = transaction.id #FIXME
+		limit = self._page_size
+		if self.max_results is not None:
+			remaining = self.max_results - self._fetched
+			limit = remaining if limit is None else min(limit, remaining)
 
-		from viur.xeno.databases import dbinterface
-		entities = dbinterface.query(self._query)
+		return dict(
+			limit=limit,
+			offset=self._offset,
+			start_cursor=self._cursor,
+			end_cursor=self._end_cursor,
+		)
+
+	def _page(self, entities, cursor, more_results):
+		"""Advance past a page returned by the driver.
+
+		:rtype: :class:`Page`
+		"""
+		self._offset = 0
+		self._fetched += len(entities)
+		self._cursor = cursor
 
-		return Page(self, entities, self.item_to_value)
+		limit_reached = self.max_results is not None and self._fetched >= self.max_results
+		self._more_results = more_results and not limit_reached and bool(entities)
+
+		page = Page(self, entities, self.item_to_value)
+		# The token stays set after the limit, so the query can be resumed.
+		page.next_page_token = cursor if more_results else None
+		return page
 
 class Page(object):
+
+	next_page_token = None
+	"""Cursor behind this page, ``None`` if it is the last one."""
+
 	def __init__(self, parent, items, item_to_value, raw_page=None):
 		self._parent = parent
 		self._num_items = len(items)
@@ -0,0 +1,698 @@
+# Copyright 2020 Andreas H. Kelch
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+"""SQLite driver.
+
+Entities are stored in one ``entities`` table. Every kind gets its own
+index table holding one row per indexed property value, and queries are
+compiled to SQL which reads those index tables:
+
+* filters become ``path IN (SELECT path FROM <index> ...)`` range lookups,
+* orders join the index table and sort on ``(rank, value)``,
+* ancestors and key filters are ranges on the key path encoded by
+  :func:`~.key.encode_path`,
+* cursors are keyset conditions on the sort columns, so resuming a query
+  never re-reads skipped rows.
+
+Connections come from a :class:`~.pool.ConnectionPool` shared by all
+drivers of the same database; file databases run in WAL mode so readers
+don't block each other or the writer.
+"""
+import contextlib
+import datetime
+import functools
+import itertools
+import json
+import pathlib
+import sqlite3
+import struct
+
+from .codec import LazyEntity, decode_entity, encode_entity
+from .driver import Driver
+from .geopoint import GeoPoint
+from .helpers import decode_cursor, encode_cursor
+from .key import Key, encode_path
+from .pool import ConnectionPool, acquire_pool, release_pool
+from .query import KEY_PROPERTY
+
+_SCHEMA = (
+	"""CREATE TABLE IF NOT EXISTS entities (
+		project TEXT NOT NULL,
+		namespace TEXT NOT NULL,
+		kind TEXT NOT NULL,
+		path BLOB NOT NULL,
+		key TEXT NOT NULL,
+		data BLOB NOT NULL,
+		PRIMARY KEY (project, namespace, kind, path)
+	) WITHOUT ROWID""",
+	"""CREATE TABLE IF NOT EXISTS versions (
+		project TEXT NOT NULL,
+		namespace TEXT NOT NULL,
+		kind TEXT NOT NULL,
+		path BLOB NOT NULL,
+		version INTEGER NOT NULL,
+		PRIMARY KEY (project, namespace, kind, path)
+	) WITHOUT ROWID""",
+	"""CREATE TABLE IF NOT EXISTS ids (
+		project TEXT NOT NULL,
+		namespace TEXT NOT NULL,
+		kind TEXT NOT NULL,
+		last_id INTEGER NOT NULL,
+		PRIMARY KEY (project, namespace, kind)
+	) WITHOUT ROWID""",
+)
+
+_INDEX_SCHEMA = (
+	"""CREATE TABLE IF NOT EXISTS {table} (
+		project TEXT NOT NULL,
+		namespace TEXT NOT NULL,
+		path BLOB NOT NULL,
+		name TEXT NOT NULL,
+		rank INTEGER NOT NULL,
+		value,
+		first INTEGER NOT NULL,
+		last INTEGER NOT NULL
+	)""",
+	"CREATE INDEX IF NOT EXISTS {value_index} "
+	"ON {table} (project, namespace, name, rank, value, path)",
+	"CREATE INDEX IF NOT EXISTS {path_index} ON {table} (project, namespace, path)",
+)
+
+_INDEX_PREFIX = "index:"
+
+_BUMP_VERSION = (
+	"INSERT INTO versions VALUES (?, ?, ?, ?, 1) "
+	"ON CONFLICT (project, namespace, kind, path) DO UPDATE SET version = version + 1"
+)
+
+_MAX_VARIABLES = 500
+"""Keys looked up per statement, well below SQLite's variable limit."""
+
+_ID_OFFSET = 1 << 63
+
+_memory_databases = itertools.count()
+
+_double = struct.Struct(">d")
+
+
+def _quote(identifier):
+	return '"%s"' % identifier.replace('"', '""')
+
+
+def _index_table(kind):
+	return _quote(_INDEX_PREFIX + kind)
+
+
+def _sql_value(value):
+	"""Convert a single property value to its ``(rank, value)`` index columns.
+
+	The ranks order the types like :func:`~.helpers.value_sort_key`.
+	"""
+	if value is None:
+		return (0, 0)
+	if isinstance(value, bool):
+		return (1, int(value))
+	if isinstance(value, int):
+		if -_ID_OFFSET <= value < _ID_OFFSET:
+			return (2, value)
+		return (2, float(value))
+	if isinstance(value, float):
+		return (2, value)
+	if isinstance(value, datetime.datetime):
+		if value.tzinfo is not None:
+			value = value.astimezone(datetime.timezone.utc).replace(tzinfo=None)
+		delta = value - datetime.datetime(1970, 1, 1)
+		return (3, (delta.days * 86400 + delta.seconds) * 1000000 + delta.microseconds)
+	if isinstance(value, str):
+		return (4, value)
+	if isinstance(value, bytes):
+		return (5, value)
+	if isinstance(value, GeoPoint):
+		return (6, _ordered_double(value.latitude) + _ordered_double(value.longitude))
+	if isinstance(value, Key):
+		return (7, encode_path(value.flat_path))
+	return (8, repr(value))
+
+
+def _ordered_double(value):
+	"""Eight bytes comparing like the float ``value``.
+
+	Positive floats get their sign bit set, negative ones all bits
+	flipped, so the big endian bytes sort in numeric order.
+	"""
+	bits = int.from_bytes(_double.pack(value + 0.0), "big")  # -0.0 == 0.0
+	bits ^= 0xFFFFFFFFFFFFFFFF if bits >> 63 else 1 << 63
+	return bits.to_bytes(8, "big")
+
+
+def _encode_key(key):
+	return json.dumps([key.flat_path, key.project, key.namespace])
+
+
+def _decode_key(raw):
+	flat_path, project, namespace = json.loads(raw)
+	return Key.interned(flat_path, project=project, namespace=namespace)
+
+
+def _index_rows(project, namespace, path, entity):
+	"""Rows of the kind's index table for an entity."""
+	rows = []
+	for name, value in entity.items():
+		if name in entity.exclude_from_indexes:
+			continue
+		if isinstance(value, list):
+			values = sorted(set(_sql_value(item) for item in value))
+		else:
+			values = [_sql_value(value)]
+		for position, (rank, sql_value) in enumerate(values):
+			rows.append((
+				project, namespace, path, name, rank, sql_value,
+				int(position == 0), int(position == len(values) - 1),
+			))
+	return rows
+
+
+def _after(columns, position, directions):
+	"""SQL condition selecting the rows behind a keyset position.
+
+	:type columns: list of str
+	:param columns: SQL expression of every position element.
+
+	:type position: tuple
+	:param position: The position, as stored in a cursor.
+
+	:type directions: list of bool
+	:param directions: ``True`` for every descending element.
+
+	:rtype: tuple
+	:returns: ``(sql, params)``.
+	"""
+	clauses = []
+	params = []
+	for index, (column, value, descending) in enumerate(
+		zip(columns, position, directions)
+	):
+		parts = []
+		for previous, previous_value in zip(columns[:index], position[:index]):
+			parts.append("%s = %s" % (previous, _placeholder(previous_value)))
+			params.extend(_flatten(previous_value))
+		parts.append("%s %s %s" % (column, "<" if descending else ">", _placeholder(value)))
+		params.extend(_flatten(value))
+		clauses.append("(%s)" % " AND ".join(parts))
+	return "(%s)" % " OR ".join(clauses), params
+
+
+def _placeholder(value):
+	return "(?, ?)" if isinstance(value, tuple) else "?"
+
+
+def _flatten(value):
+	return list(value) if isinstance(value, tuple) else [value]
+
+
+def _open(uri, timeout, wal):
+	connection = sqlite3.connect(
+		uri,
+		timeout=timeout,
+		isolation_level=None,
+		check_same_thread=False,
+		uri=True,
+	)
+	if wal:
+		connection.execute("PRAGMA journal_mode=WAL")
+		connection.execute("PRAGMA synchronous=NORMAL")
+	return connection
+
+
+def _ping(connection):
+	connection.execute("SELECT 1").fetchone()
+
+
+class SQLiteDriver(Driver):
+	"""Driver storing entities in an SQLite database.
+
+	:type path: str
+	:param path: (Optional) Filename of the database. Defaults to a private
+				 in-memory database.
+
+	:type timeout: float
+	:param timeout: (Optional) Seconds to wait for a locked database.
+
+	:type pool_size: int
+	:param pool_size: (Optional) Maximum number of open connections. An
+					  in-memory database always uses one: its connections
+					  share a cache whose table locks don't wait for
+					  ``timeout``, so concurrent ones fail instead.
+
+	:type pool_timeout: float
+	:param pool_timeout: (Optional) Seconds to wait for a free connection.
+
+	:type max_idle: float
+	:param max_idle: (Optional) Seconds after which idle connections are
+					 closed.
+	"""
+
+	def __init__(
+		self, path=":memory:", timeout=5.0, pool_size=10, pool_timeout=30.0, max_idle=300.0
+	):
+		if path == ":memory:":
+			self._uri = "file:datastore-%d?mode=memory&cache=shared" % next(
+				_memory_databases
+			)
+		else:
+			# Escaped, so "#", "?" and "%" are part of the filename.
+			self._uri = pathlib.Path(path).resolve().as_uri()
+		self._memory = path == ":memory:"
+		self._timeout = timeout
+		self._pool_key = (self._uri, timeout, pool_size, pool_timeout, max_idle)
+		self._pool = None
+		self._connected = False
+		self._anchor = None
+		self._tables = set()
+		self._created = {}  # connection: tables created in its open transaction
+
+	def _new_pool(self):
+		uri, timeout, pool_size, pool_timeout, max_idle = self._pool_key
+		return ConnectionPool(
+			functools.partial(_open, uri, timeout, not self._memory),
+			check=_ping,
+			max_size=1 if self._memory else pool_size,
+			timeout=pool_timeout,
+			max_idle=max_idle,
+		)
+
+	def connect(self):
+		if not self._connected:
+			if self._memory:
+				# An in-memory database lives as long as a connection to it,
+				# and is private to this driver.
+				self._anchor = _open(self._uri, self._timeout, False)
+				self._pool = self._new_pool()
+			else:
+				self._pool = acquire_pool(self._pool_key, self._new_pool)
+			self._connected = True
+		with self._pool.connection() as connection:
+			for statement in _SCHEMA:
+				connection.execute(statement)
+			for (name,) in connection.execute(
+				"SELECT name FROM sqlite_master WHERE type = 'table' AND name LIKE ?",
+				(_INDEX_PREFIX + "%",),
+			):
+				self._tables.add(_quote(name))
+
+	def close(self):
+		if self._connected:
+			self._connected = False
+			if self._memory:
+				self._pool.close()
+			else:
+				release_pool(self._pool_key)
+		if self._anchor is not None:
+			self._anchor.close()
+			self._anchor = None
+
+	@contextlib.contextmanager
+	def _read(self, transaction):
+		"""Run reads in ``transaction`` or on a pooled connection."""
+		if transaction is not None:
+			yield transaction
+			return
+		with self._pool.connection() as connection:
+			yield connection
+
+	@contextlib.contextmanager
+	def _write(self, transaction):
+		"""Run writes in ``transaction`` or, if there is none, in a new one."""
+		if transaction is not None:
+			yield transaction
+			return
+		with self._pool.connection() as connection:
+			connection.execute("BEGIN IMMEDIATE")
+			try:
+				yield connection
+			except BaseException:
+				connection.execute("ROLLBACK")
+				self._ended(connection, committed=False)
+				raise
+			connection.execute("COMMIT")
+			self._ended(connection, committed=True)
+
+	def _ended(self, connection, committed):
+		"""Publish the index tables created by a finished transaction."""
+		created = self._created.pop(connection, None)
+		if created and committed:
+			self._tables.update(created)
+
+	def _ensure_table(self, connection, kind):
+		table = _index_table(kind)
+		if table in self._tables:
+			return table
+		created = self._created.setdefault(connection, set())
+		if table not in created:
+			name = _INDEX_PREFIX + kind
+			for statement in _INDEX_SCHEMA:
+				connection.execute(statement.format(
+					table=table,
+					value_index=_quote(name + ":value"),
+					path_index=_quote(name + ":path"),
+				))
+			created.add(table)
+		return table
+
+	def _has_table(self, connection, kind):
+		"""Whether the index table of ``kind`` exists.
+
+		Other drivers on the same database, e.g. of other processes, create
+		tables too, so on a miss the schema is checked again.
+		"""
+		table = _index_table(kind)
+		if table in self._tables or table in self._created.get(connection, ()):
+			return True
+		exists = connection.execute(
+			"SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?",
+			(_INDEX_PREFIX + kind,),
+		).fetchone()
+		if exists:
+			self._tables.add(table)
+		return bool(exists)
+
+	def begin(self):
+		connection = self._pool.checkout()
+		try:
+			connection.execute("BEGIN IMMEDIATE")
+		except BaseException:
+			self._pool.checkin(connection)
+			raise
+		return connection
+
+	def commit(self, transaction):
+		if transaction is None:
+			return
+		committed = False
+		try:
+			if transaction.in_transaction:
+				transaction.execute("COMMIT")
+			committed = True
+		except BaseException:
+			if transaction.in_transaction:
+				transaction.execute("ROLLBACK")
+			raise
+		finally:
+			self._ended(transaction, committed)
+			self._pool.checkin(transaction)
+
+	def rollback(self, transaction):
+		if transaction is None:
+			return
+		try:
+			if transaction.in_transaction:
+				transaction.execute("ROLLBACK")
+		finally:
+			self._ended(transaction, committed=False)
+			self._pool.checkin(transaction)
+
+	def get_multi(self, keys, transaction=None):
+		found = {}
+		scopes = {}
+		for key in keys:
+			scope = (key.project or "", key.namespace or "", key.kind)
+			scopes.setdefault(scope, []).append(encode_path(key.flat_path))
+		with self._read(transaction) as connection:
+			for (project, namespace, kind), paths in scopes.items():
+				for start in range(0, len(paths), _MAX_VARIABLES):
+					chunk = paths[start:start + _MAX_VARIABLES]
+					rows = connection.execute(
+						"SELECT path, key, data FROM entities "
+						"WHERE project = ? AND namespace = ? AND kind = ? AND path IN (%s)"
+						% ", ".join("?" * len(chunk)),
+						[project, namespace, kind] + chunk,
+					)
+					for path, key, data in rows:
+						found[(project, namespace, kind, path)] = (key, data)
+
+		entities = []
+		for key in keys:
+			row = found.get(
+				(key.project or "", key.namespace or "", key.kind, encode_path(key.flat_path))
+			)
+			if row is not None:
+				entities.append(decode_entity(row[1]))
+		return entities
+
+	def versions(self, keys, transaction=None):
+		versions = []
+		with self._read(transaction) as connection:
+			for key in keys:
+				row = connection.execute(
+					"SELECT version FROM versions "
+					"WHERE project = ? AND namespace = ? AND kind = ? AND path = ?",
+					(
+						key.project or "", key.namespace or "", key.kind,
+						encode_path(key.flat_path),
+					),
+				).fetchone()
+				versions.append(row[0] if row else 0)
+		return versions
+
+	def put_multi(self, entities, transaction=None):
+		with self._write(transaction) as connection:
+			index_rows = {}
+			version_rows = []
+			for entity in entities:
+				if entity.key.is_partial:
+					entity.key = self._allocate(connection, entity.key, 1)[0]
+				key = entity.key
+				project, namespace, kind = key.project or "", key.namespace or "", key.kind
+				path = encode_path(key.flat_path)
+				table = self._ensure_table(connection, kind)
+				connection.execute(
+					"DELETE FROM %s WHERE project = ? AND namespace = ? AND path = ?" % table,
+					(project, namespace, path),
+				)
+				connection.execute(
+					"INSERT OR REPLACE INTO entities VALUES (?, ?, ?, ?, ?, ?)",
+					(
+						project, namespace, kind, path, _encode_key(key),
+						encode_entity(entity),
+					),
+				)
+				index_rows.setdefault(table, []).extend(
+					_index_rows(project, namespace, path, entity)
+				)
+				version_rows.append((project, namespace, kind, path))
+			connection.executemany(_BUMP_VERSION, version_rows)
+			for table, rows in index_rows.items():
+				connection.executemany(
+					"INSERT INTO %s VALUES (?, ?, ?, ?, ?, ?, ?, ?)" % table, rows
+				)
+
+	def delete_multi(self, keys, transaction=None):
+		with self._write(transaction) as connection:
+			for key in keys:
+				project, namespace, kind = key.project or "", key.namespace or "", key.kind
+				path = encode_path(key.flat_path)
+				connection.execute(
+					"DELETE FROM entities "
+					"WHERE project = ? AND namespace = ? AND kind = ? AND path = ?",
+					(project, namespace, kind, path),
+				)
+				connection.execute(_BUMP_VERSION, (project, namespace, kind, path))
+				if self._has_table(connection, kind):
+					connection.execute(
+						"DELETE FROM %s WHERE project = ? AND namespace = ? AND path = ?"
+						% _index_table(kind),
+						(project, namespace, path),
+					)
+
+	def allocate_ids(self, incomplete_key, num_ids):
+		with self._write(None) as connection:
+			return self._allocate(connection, incomplete_key, num_ids)
+
+	@staticmethod
+	def _allocate(connection, incomplete_key, num_ids):
+		"""Complete a partial key with ``num_ids`` ids not in use yet."""
+		scope = (
+			incomplete_key.project or "",
+			incomplete_key.namespace or "",
+			incomplete_key.kind,
+		)
+		row = connection.execute(
+			"SELECT last_id FROM ids WHERE project = ? AND namespace = ? AND kind = ?",
+			scope,
+		).fetchone()
+		last_id = row[0] if row else 0
+		keys = []
+		while len(keys) < num_ids:
+			last_id += 1
+			key = incomplete_key.completed_key(last_id)
+			exists = connection.execute(
+				"SELECT 1 FROM entities "
+				"WHERE project = ? AND namespace = ? AND kind = ? AND path = ?",
+				scope + (encode_path(key.flat_path),),
+			).fetchone()
+			if not exists:
+				keys.append(key)
+		connection.execute("INSERT OR REPLACE INTO ids VALUES (?, ?, ?, ?)", scope + (last_id,))
+		return keys
+
+	def run_query(
+		self,
+		query,
+		limit=None,
+		offset=0,
+		start_cursor=None,
+		end_cursor=None,
+		transaction=None,
+	):
+		project, namespace, kind = query.project or "", query.namespace or "", query.kind
+		orders = [
+			(name[1:], True) if name.startswith("-") else (name, False)
+			for name in query.order
+		]
+		projection = [name for name in query.projection if name != KEY_PROPERTY]
+		keys_only = bool(query.projection) and not projection
+
+		if kind is None:
+			if any(name != KEY_PROPERTY for name, _, _ in query.filters) or any(
+				name != KEY_PROPERTY for name, _ in orders
+			):
+				raise ValueError("Kindless queries only support key filters and orders")
+			table = None
+		else:
+			table = _index_table(kind)
+
+		joins, join_params = [], []
+		where = ["e.project = ?", "e.namespace = ?"]
+		params = [project, namespace]
+		if kind is not None:
+			where.append("e.kind = ?")
+			params.append(kind)
+
+		if query.ancestor is not None:
+			path = encode_path(query.ancestor.flat_path)
+			where.append("e.path >= ? AND e.path < ?")
+			params.extend([path, path + b"\xff"])
+
+		ranges = {}
+		for name, operator, value in query.filters:
+			if name == KEY_PROPERTY:
+				where.append("e.path %s ?" % operator)
+				params.append(encode_path(value.flat_path))
+			elif operator == "=":
+				where.append(
+					"e.path IN (SELECT path FROM %s WHERE project = ? AND namespace = ? "
+					"AND name = ? AND rank = ? AND value = ?)" % table
+				)
+				params.extend((project, namespace, name) + _sql_value(value))
+			else:
+				ranges.setdefault(name, []).append((operator, _sql_value(value)))
+		for name, conditions in ranges.items():
+			where.append(
+				"e.path IN (SELECT path FROM %s WHERE project = ? AND namespace = ? "
+				"AND name = ? AND %s)"
+				% (table, " AND ".join("(rank, value) %s (?, ?)" % op for op, _ in conditions))
+			)
+			params.extend([project, namespace, name])
+			for _, sql_value in conditions:
+				params.extend(sql_value)
+
+		for name in projection:
+			where.append(
+				"e.path IN (SELECT path FROM %s WHERE project = ? AND namespace = ? "
+				"AND name = ?)" % table
+			)
+			params.extend([project, namespace, name])
+
+		columns, directions, order_by = [], [], []
+		for index, (name, descending) in enumerate(orders):
+			if name == KEY_PROPERTY:
+				column = "e.path"
+				order_by.append("e.path DESC" if descending else "e.path")
+			else:
+				alias = "o%d" % index
+				joins.append(
+					"JOIN %s %s ON %s.project = e.project AND %s.namespace = e.namespace "
+					"AND %s.path = e.path AND %s.name = ? AND %s.%s = 1"
+					% ((table, alias) + (alias,) * 5 + ("last" if descending else "first",))
+				)
+				join_params.append(name)
+				column = "(%s.rank, %s.value)" % (alias, alias)
+				suffix = " DESC" if descending else ""
+				order_by.append("%s.rank%s, %s.value%s" % (alias, suffix, alias, suffix))
+			columns.append(column)
+			directions.append(descending)
+		columns.append("e.path")
+		directions.append(False)
+		order_by.append("e.path")
+
+		if start_cursor is not None:
+			condition, condition_params = _after(
+				columns, decode_cursor(start_cursor), directions
+			)
+			where.append(condition)
+			params.extend(condition_params)
+		if end_cursor is not None:
+			condition, condition_params = _after(
+				columns, decode_cursor(end_cursor), directions
+			)
+			where.append("NOT " + condition)
+			params.extend(condition_params)
+
+		select = ["e.key"] if keys_only else ["e.key", "e.data"]
+		for column in columns:
+			if column.startswith("("):
+				select.extend(column[1:-1].split(", "))
+			else:
+				select.append(column)
+		sql = "SELECT %s FROM entities e %s WHERE %s ORDER BY %s LIMIT ? OFFSET ?" % (
+			", ".join(select),
+			" ".join(joins),
+			" AND ".join(where),
+			", ".join(order_by),
+		)
+		params = join_params + params + [
+			-1 if limit is None else limit + 1,
+			offset or 0,
+		]
+		with self._read(transaction) as connection:
+			if table is not None and not self._has_table(connection, kind):
+				return [], start_cursor, False
+			rows = connection.execute(sql, params).fetchall()
+
+		more_results = limit is not None and len(rows) > limit
+		rows = rows[:limit] if more_results else rows
+		entities = []
+		for row in rows:
+			if keys_only:
+				entities.append(_decode_key(row[0]))
+			else:
+				entities.append(LazyEntity(row[1], projection or None))
+
+		if rows:
+			cursor = encode_cursor(self._position(rows[-1], columns, keys_only))
+		else:
+			cursor = start_cursor
+		return entities, cursor, more_results
+
+	@staticmethod
+	def _position(row, columns, keys_only):
+		"""Read the keyset position of a result row."""
+		values = iter(row[1 if keys_only else 2:])
+		position = []
+		for column in columns:
+			if column.startswith("("):
+				position.append(tuple(itertools.islice(values, 2)))
+			else:
+				position.append(next(values))
+		return tuple(position)
@@ -15,17 +15,39 @@
 # Modifications copyright 2020 Andreas H. Kelch
 #  - removed google dependency
 #
+import uuid
+
 from .batch import Batch
 
 
+class Conflict(RuntimeError):
+	"""Raised on commit if an entity read by the transaction has changed.
+
+	The transaction has been rolled back and can be retried, see
+	:meth:`~google.cloud.datastore.client.Client.run_in_transaction`.
+	"""
+
+
 class Transaction(Batch):
+	"""An optimistic transaction.
+
+	Entities read through the transaction are remembered with their
+	version stamp. On :meth:`commit` the stamps are compared inside a
+	backend transaction; if any of them changed since, nothing is written
+	and :class:`Conflict` is raised. Drivers without version stamps skip
+	that check.
+	"""
+
 	_status = None
+	_stream = False  # all mutations are sent atomically on commit
 
 	def __init__(self, client, read_only=False):
 		super(Transaction, self).__init__(client)
 		self._id = None
+		self._read_versions = {}
+		self._snapshot = {}
 
-		self._options = {"read_only": False}
+		self._options = {"read_only": read_only}
 
 	@property
 	def id(self):
@@ -62,13 +84,16 @@ class Transaction(Batch):
 				 already begun.
 		"""
 		super(Transaction, self).begin()
-		# FIXME
-		try:
-			response_pb = self._client._datastore_api.begin_transaction(self.project)
-			self._id = response_pb.transaction
-		except:  # noqa: E722 do not use bare except, specify exception instead
-			pass #self._status = self._ABORTED
-			#raise
+		self._id = uuid.uuid4().hex
+		self._read_versions.clear()
+		self._snapshot.clear()
+
+	def _end(self):
+		"""Forget the state of a committed or rolled back transaction."""
+		# Clear our own ID in case this gets accidentally reused.
+		self._id = None
+		self._read_versions.clear()
+		self._snapshot.clear()
 
 	def rollback(self):
 		"""Rolls back the current transaction.
@@ -78,13 +103,9 @@ class Transaction(Batch):
 		- Sets the current transaction's ID to None.
 		"""
 		try:
-			# No need to use the response it contains nothing.
-			#self._client._datastore_api.rollback(self.project, self._id)
-			pass
-		finally:
 			super(Transaction, self).rollback()
-			# Clear our own ID in case this gets accidentally reused.
-			self._id = None
+		finally:
+			self._end()
 
 	def commit(self):
 		"""Commits the transaction.
@@ -96,12 +117,143 @@ class Transaction(Batch):
 		This method has necessary side-effects:
 
 		- Sets the current transaction's ID to None.
+
+		:raises: :class:`Conflict` if an entity read in this transaction
+				 has been changed by someone else in the meantime.
 		"""
 		try:
 			super(Transaction, self).commit()
 		finally:
-			# Clear our own ID in case this gets accidentally reused.
-			self._id = None
+			self._end()
+
+	def _get_multi(self, keys):
+		"""Read entities as seen by this transaction.
+
+		Pending puts are returned and pending deletes hidden without asking
+		the backend; keys read before are served from the transaction's
+		snapshot. Only the remaining keys are fetched, once.
+
+		:type keys: list of :class:`google.cloud.datastore.key.Key`
+		:param keys: The keys to read.
+
+		:rtype: list of :class:`google.cloud.datastore.entity.Entity`
+		:returns: Copies of the entities which exist, in the order of
+				  ``keys``.
+		"""
+		fetch = self._unknown(keys)
+		if fetch:
+			self._track_reads(fetch)
+			self._remember(fetch, self._driver.get_multi(fetch))
+		return self._visible(keys)
+
+	def _query_results(self, entities):
+		"""Track whole entities returned by a query in this transaction.
+
+		The query may have read an entity before a concurrent write whose
+		version stamp a later read would see, so entities not read before
+		are fetched again once their stamps are remembered, like in
+		:meth:`_get_multi`.
+
+		:type entities: list of :class:`google.cloud.datastore.entity.Entity`
+		:param entities: The results of the query.
+
+		:rtype: list of :class:`google.cloud.datastore.entity.Entity`
+		:returns: The results, as read by the transaction.
+		"""
+		fetch = self._unknown(entity.key for entity in entities)
+		if fetch:
+			self._track_reads(fetch)
+			self._remember(fetch, self._driver.get_multi(fetch))
+		return self._seen(entities)
+
+	def _seen(self, entities):
+		"""Replace query results by copies of the snapshot's entities."""
+		results = []
+		for entity in entities:
+			known = self._snapshot.get(entity.key)
+			results.append(entity if known is None else known.copy())
+		return results
+
+	def _unknown(self, keys):
+		"""Keys neither written nor read by the transaction yet, once each."""
+		return list(dict.fromkeys(
+			key for key in keys
+			if key not in self._mutations and key not in self._snapshot
+		))
+
+	def _remember(self, keys, entities):
+		"""Add fetched entities (and the absence of the others) to the snapshot."""
+		for key in keys:
+			self._snapshot[key] = None
+		for entity in entities:
+			self._snapshot[entity.key] = entity
+
+	def _visible(self, keys):
+		"""Entities as seen by the transaction, see :meth:`_get_multi`."""
+		entities = []
+		for key in keys:
+			mutation = self._mutations.get(key)
+			if mutation is not None:
+				operation, entity = mutation
+				if operation == "delete":
+					continue
+			else:
+				entity = self._snapshot[key]
+				if entity is None:
+					continue
+			entities.append(entity.copy())
+		return entities
+
+	def _track_reads(self, keys):
+		"""Remember the version stamps of keys read in this transaction.
+
+		Only the first read of a key counts; it is the state later writes
+		are based on. Must be called before the entities are fetched, so
+		a concurrent write in between is detected rather than missed.
+
+		:type keys: list of :class:`google.cloud.datastore.key.Key`
+		:param keys: The keys about to be read.
+		"""
+		keys = self._untracked(keys)
+		if keys:
+			self._track_versions(keys, self._driver.versions(keys))
+
+	def _untracked(self, keys):
+		"""Keys whose version stamp still has to be remembered."""
+		if self._status != self._IN_PROGRESS:
+			return []
+		return [key for key in keys if key not in self._read_versions]
+
+	def _track_versions(self, keys, versions):
+		if versions is None:
+			return
+		for key, version in zip(keys, versions):
+			self._read_versions.setdefault(key, version)
+
+	def _validate(self, transaction):
+		"""Compare the version stamps of all keys read.
+
+		:raises: :class:`Conflict` if a stamp changed.
+		"""
+		if not self._read_versions:
+			return
+		keys = list(self._read_versions)
+		self._check_versions(keys, self._driver.versions(keys, transaction=transaction))
+
+	def _check_versions(self, keys, versions):
+		"""Compare the current version stamps with the remembered ones.
+
+		:raises: :class:`Conflict` if a stamp changed.
+		"""
+		if versions is None:
+			return
+		changed = [
+			key
+			for key, version in zip(keys, versions)
+			if self._read_versions[key] != version
+		]
+		if changed:
+			raise Conflict("Entities changed during the transaction", changed)
 
 	def put(self, entity):
 		"""Adds an entity to be committed.
@@ -120,3 +272,21 @@ class Transaction(Batch):
 			raise RuntimeError("Transaction is read only")
 		else:
 			super(Transaction, self).put(entity)
+
+	def delete(self, key):
+		"""Adds a key to be deleted on commit.
+
+		Ensures the transaction is not marked readonly.
+		Please see documentation at
+		:meth:`~google.cloud.datastore.batch.Batch.delete`
+
+		:type key: :class:`~google.cloud.datastore.key.Key`
+		:param key: the key to be deleted.
+
+		:raises: :class:`RuntimeError` if the transaction
+				 is marked ReadOnly
+		"""
+		if self._options["read_only"]:
+			raise RuntimeError("Transaction is read only")
+		else:
+			super(Transaction, self).delete(key)
@@ -0,0 +1,91 @@
+"""Local stand-in for memcached, speaking the text protocol.
+
+Supports the ``get``, ``set`` and ``add`` commands used by
+:class:`~viur.database.datastore.memcache.MemcacheClient`. Expiry uses a
+clock which tests can move forward with :meth:`MemcachedServer.advance`.
+"""
+import socketserver
+import threading
+import time
+
+
+class _Handler(socketserver.StreamRequestHandler):
+
+	def handle(self):
+		server = self.server
+		while True:
+			line = self.rfile.readline()
+			if not line:
+				return
+			parts = line.split()
+			command = parts[0]
+			if command == b"get":
+				server.gets.append(parts[1:])
+				replies = []
+				for key in parts[1:]:
+					value = server.value(key)
+					if value is not None:
+						replies.append(b"VALUE %s 0 %d\r\n%s\r\n" % (key, len(value), value))
+				self.wfile.write(b"".join(replies) + b"END\r\n")
+			elif command in (b"set", b"add"):
+				key, expire, size = parts[1], int(parts[3]), int(parts[4])
+				value = self.rfile.read(size + 2)[:-2]
+				stored = server.store(key, value, expire, replace=command == b"set")
+				self.wfile.write(b"STORED\r\n" if stored else b"NOT_STORED\r\n")
+			else:
+				self.wfile.write(b"ERROR\r\n")
+
+
+class MemcachedServer(socketserver.ThreadingTCPServer):
+	"""memcached stand-in on a free port of localhost.
+
+	:attr:`gets` records the keys of every ``get`` command received.
+	"""
+
+	allow_reuse_address = True
+	daemon_threads = True
+
+	def __init__(self):
+		socketserver.ThreadingTCPServer.__init__(self, ("127.0.0.1", 0), _Handler)
+		self.values = {}
+		self.gets = []
+		self.offset = 0.0
+		self._lock = threading.Lock()
+		self._thread = threading.Thread(
+			target=self.serve_forever, kwargs={"poll_interval": 0.01}, daemon=True
+		)
+		self._thread.start()
+
+	@property
+	def address(self):
+		"""``host:port`` of the server."""
+		return "%s:%d" % self.server_address
+
+	def now(self):
+		return time.monotonic() + self.offset
+
+	def advance(self, seconds):
+		"""Move the clock used for expiry forward."""
+		self.offset += seconds
+
+	def value(self, key):
+		with self._lock:
+			return self._alive(key)
+
+	def store(self, key, value, expire, replace):
+		with self._lock:
+			if not replace and self._alive(key) is not None:
+				return False
+			self.values[key] = (value, self.now() + expire if expire else None)
+			return True
+
+	def _alive(self, key):
+		value, expires = self.values.get(key, (None, None))
+		if expires is not None and expires <= self.now():
+			del self.values[key]
+			return None
+		return value
+
+	def stop(self):
+		self.shutdown()
+		self.server_close()
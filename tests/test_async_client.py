@@ -0,0 +1,88 @@
+import asyncio
+import os
+
+import pytest
+
+from viur.database.datastore.async_client import AsyncClient, AsyncIterator
+from viur.database.datastore.entity import Entity
+
+
+def _client(tmp_path):
+	return AsyncClient(
+		project="test",
+		driver="sqlite",
+		driver_options={"path": os.path.join(str(tmp_path), "test.db")},
+	)
+
+
+def test_batch_first_call_connects(tmp_path):
+	async def run():
+		client = _client(tmp_path)
+		async with client.batch() as batch:
+			batch.put(Entity(client.key("Kind", 1)))
+		assert (await client.get(client.key("Kind", 1))) is not None
+		await client.close()
+
+	asyncio.run(run())
+
+
+def test_transaction_first_call_connects(tmp_path):
+	async def run():
+		client = _client(tmp_path)
+		async with client.transaction() as transaction:
+			transaction.put(Entity(client.key("Kind", 1)))
+		assert (await client.get(client.key("Kind", 1))) is not None
+		await client.close()
+
+	asyncio.run(run())
+
+
+def test_reconnect_after_close(tmp_path):
+	async def run():
+		client = _client(tmp_path)
+		await client.put(Entity(client.key("Kind", 1)))
+		await client.close()
+		assert (await client.get(client.key("Kind", 1))) is not None
+		await client.close()
+
+	asyncio.run(run())
+
+
+def test_query_fetch_and_split(tmp_path):
+	async def run():
+		client = _client(tmp_path)
+		await client.put_multi([Entity(client.key("Kind", i)) for i in range(1, 51)])
+		query = client.query(kind="Kind")
+		iterator = query.fetch(page_size=20)
+		assert isinstance(iterator, AsyncIterator)
+		assert len([entity async for entity in iterator]) == 50
+
+		keys = []
+		for shard in await query.split(4):
+			keys.extend([entity.key async for entity in shard.fetch()])
+		assert sorted(key.id for key in keys) == list(range(1, 51))
+		await client.close()
+
+	asyncio.run(run())
+
+
+def test_failed_lookup_cancels_chunks():
+	async def run():
+		client = AsyncClient(project="test", driver="memory", lookup_chunk_size=1)
+		started = []
+
+		async def get_multi(keys, transaction=None):
+			started.append(asyncio.current_task())
+			if keys[0].id == 1:
+				raise RuntimeError("lookup failed")
+			await asyncio.sleep(10)
+			return []
+
+		client.driver.get_multi = get_multi
+		keys = [client.key("Kind", i) for i in range(1, 4)]
+		with pytest.raises(RuntimeError):
+			await client.get_multi(keys, deferred=[])
+		await asyncio.sleep(0)
+		assert all(task.cancelled() for task in started[1:])
+
+	asyncio.run(run())
@@ -0,0 +1,212 @@
+import os
+import threading
+
+import pytest
+
+from viur.database.datastore.client import Client
+from viur.database.datastore.entity import Entity
+from viur.database.datastore.transaction import Conflict
+
+
+@pytest.fixture(params=["memory", "sqlite"])
+def client(request, tmp_path):
+	if request.param == "memory":
+		return Client(project="test", driver="memory")
+	path = os.path.join(str(tmp_path), "test.db")
+	return Client(project="test", driver="sqlite", driver_options={"path": path})
+
+
+def _entities(client, count, kind="Kind"):
+	return [Entity(client.key(kind, number + 1)) for number in range(count)]
+
+
+def _in_thread(function):
+	"""Run ``function`` outside of the current batch or transaction."""
+	errors = []
+
+	def run():
+		try:
+			function()
+		except Exception as exc:
+			errors.append(exc)
+
+	thread = threading.Thread(target=run)
+	thread.start()
+	thread.join()
+	if errors:
+		raise errors[0]
+
+
+def test_batch_sends_chunks(client):
+	progress = []
+	with client.batch(max_entities=3, progress=lambda *args: progress.append(args)) as batch:
+		for entity in _entities(client, 7):
+			batch.put(entity)
+		# Full chunks are sent before the commit.
+		assert batch.chunks_sent == 2
+		assert len(batch.mutations) == 1
+	assert batch.chunks_sent == 3
+	assert [(chunk, count) for chunk, count, size in progress] == [(1, 3), (2, 3), (3, 1)]
+	assert all(size > 0 for _, _, size in progress)
+	assert len(list(client.query(kind="Kind").fetch())) == 7
+
+
+def test_batch_chunks_by_bytes(client):
+	entities = _entities(client, 6)
+	for entity in entities:
+		entity["blob"] = b"x" * 1000
+	with client.batch(max_bytes=2500) as batch:
+		for entity in entities:
+			batch.put(entity)
+	assert batch.chunks_sent >= 3
+	assert len(list(client.query(kind="Kind").fetch())) == 6
+
+
+def test_put_multi_chunks_and_completes_keys(client):
+	progress = []
+	client.chunk_entities = 4
+	entities = [Entity(client.key("Kind")) for _ in range(10)]
+	client.put_multi(entities, progress=lambda *args: progress.append(args))
+	assert [count for _, count, _ in progress] == [4, 4, 2]
+	assert all(not entity.key.is_partial for entity in entities)
+	assert len(set(entity.key for entity in entities)) == 10
+	client.delete_multi([entity.key for entity in entities])
+	assert list(client.query(kind="Kind").fetch()) == []
+
+
+def test_batch_mutations_of_a_key_replace_each_other(client):
+	entity = Entity(client.key("Kind", 1))
+	with client.batch() as batch:
+		batch.put(entity)
+		batch.delete(entity.key)
+		assert len(batch.mutations) == 1
+	assert client.get(entity.key) is None
+
+
+def test_batch_rollback_drops_unsent_mutations(client):
+	with pytest.raises(RuntimeError):
+		with client.batch(max_entities=2) as batch:
+			for entity in _entities(client, 3):
+				batch.put(entity)
+			raise RuntimeError("stop")
+	# The first chunk was already sent, the rest is dropped.
+	keys = [entity.key for entity in client.query(kind="Kind").fetch()]
+	assert keys == [client.key("Kind", 1), client.key("Kind", 2)]
+
+
+def test_transaction_commits_atomically(client):
+	with client.transaction() as transaction:
+		for entity in _entities(client, 700):
+			transaction.put(entity)
+		_in_thread(lambda: _assert_missing(client, client.key("Kind", 1)))
+	assert len(list(client.query(kind="Kind").fetch())) == 700
+
+
+def test_transaction_reads_its_writes(client):
+	with client.transaction() as transaction:
+		entity = Entity(client.key("Kind", 1))
+		entity["value"] = 1
+		transaction.put(entity)
+		assert client.get(entity.key)["value"] == 1
+		_in_thread(lambda: _assert_missing(client, entity.key))
+
+
+def _assert_missing(client, key):
+	assert client.get(key) is None
+
+
+def test_transaction_conflict(client):
+	counter = Entity(client.key("Counter", 1))
+	counter["value"] = 0
+	client.put(counter)
+
+	def concurrent_write():
+		entity = client.get(counter.key)
+		entity["value"] = 100
+		client.put(entity)
+
+	with pytest.raises(Conflict):
+		with client.transaction() as transaction:
+			entity = client.get(counter.key)
+			_in_thread(concurrent_write)
+			entity["value"] += 1
+			transaction.put(entity)
+	assert client.get(counter.key)["value"] == 100
+
+
+def test_query_results_are_tracked(client):
+	entity = Entity(client.key("Kind", 1))
+	entity["value"] = 0
+	client.put(entity)
+
+	def concurrent_write():
+		client.put(entity)
+
+	with pytest.raises(Conflict):
+		with client.transaction() as transaction:
+			found = list(client.query(kind="Kind").fetch())
+			_in_thread(concurrent_write)
+			transaction.put(found[0])
+
+
+def test_run_in_transaction_retries(client):
+	counter = Entity(client.key("Counter", 1))
+	counter["value"] = 0
+	client.put(counter)
+	attempts = []
+
+	def increment(transaction):
+		entity = client.get(counter.key)
+		if not attempts:
+			_in_thread(lambda: client.put(client.get(counter.key)))
+		attempts.append(entity["value"])
+		entity["value"] += 1
+		transaction.put(entity)
+
+	client.run_in_transaction(increment, backoff=0)
+	assert len(attempts) == 2
+	assert client.get(counter.key)["value"] == 1
+	assert client.transaction_stats["retries"] == 1
+
+
+def test_read_only_transaction_rejects_writes(client):
+	with client.transaction(read_only=True) as transaction:
+		with pytest.raises(RuntimeError):
+			transaction.put(Entity(client.key("Kind", 1)))
+		with pytest.raises(RuntimeError):
+			transaction.delete(client.key("Kind", 1))
+
+
+def test_failed_chunk_rolls_back_earlier_chunks(client):
+	existing = Entity(client.key("Kind", 1))
+	existing["value"] = "old"
+	client.put(existing)
+	client.chunk_entities = 2
+	driver = client.driver
+	put_multi = driver.put_multi
+	calls = []
+
+	def failing_put_multi(entities, transaction=None):
+		calls.append(len(entities))
+		if len(calls) == 2:
+			raise RuntimeError("chunk failed")
+		return put_multi(entities, transaction=transaction)
+
+	driver.put_multi = failing_put_multi
+	try:
+		with pytest.raises(RuntimeError):
+			with client.transaction() as transaction:
+				for entity in _entities(client, 5):
+					entity["value"] = "new"
+					transaction.put(entity)
+				transaction.delete(client.key("Other", 1))
+	finally:
+		del driver.put_multi
+	assert len(calls) == 2
+	assert [entity["value"] for entity in client.query(kind="Kind").fetch()] == ["old"]
+	# The versions are restored too, so reading transactions don't conflict.
+	with client.transaction() as transaction:
+		entity = client.get(existing.key)
+		entity["value"] = "newer"
+		transaction.put(entity)
+	assert client.get(existing.key)["value"] == "newer"
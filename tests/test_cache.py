@@ -0,0 +1,47 @@
+import pytest
+
+from viur.database.datastore.cache import QueryCache, query_fingerprint
+from viur.database.datastore.client import Client
+from viur.database.datastore.entity import Entity
+
+REQUEST = dict(limit=None, offset=0, start_cursor=None, end_cursor=None)
+
+
+def _fingerprint(client, *filters):
+	return query_fingerprint(client.query(kind="Kind", filters=list(filters)), REQUEST)
+
+
+def test_fingerprint_ignores_filter_order():
+	client = Client(project="test", driver="memory")
+	assert _fingerprint(client, ("a", "=", 1), ("b", ">", "x")) == _fingerprint(
+		client, ("b", ">", "x"), ("a", "=", 1)
+	)
+
+
+@pytest.mark.parametrize("first, second", [
+	(True, 1),
+	(1, 1.0),
+	(False, 0),
+	([1], [True]),
+	({"v": 1}, {"v": True}),
+])
+def test_fingerprint_tells_equal_values_of_other_types_apart(first, second):
+	client = Client(project="test", driver="memory")
+	assert _fingerprint(client, ("x", "=", first)) != _fingerprint(client, ("x", "=", second))
+
+
+def test_bool_and_int_filters_are_cached_apart():
+	client = Client(project="test", driver="memory", query_cache=QueryCache())
+	for number, value in ((1, True), (2, 1)):
+		entity = Entity(client.key("Kind", number))
+		entity["x"] = value
+		client.put(entity)
+
+	def ids(value):
+		query = client.query(kind="Kind", filters=[("x", "=", value)])
+		return [entity.key.id for entity in query.fetch()]
+
+	assert ids(True) == [1]
+	assert ids(1) == [2]
+	assert ids(True) == [1]
+	assert client.query_cache.stats["hits"] == 1
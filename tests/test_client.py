@@ -0,0 +1,49 @@
+import threading
+import time
+
+import pytest
+
+from viur.database.datastore.client import Client
+from viur.database.datastore.entity import Entity
+
+
+def _client(**options):
+	client = Client(
+		project="test", driver="memory", lookup_chunk_size=2, lookup_workers=2, **options
+	)
+	client.put_multi([Entity(client.key("Kind", number + 1)) for number in range(20)])
+	return client
+
+
+def test_chunked_lookup_keeps_key_order():
+	client = _client()
+	keys = [client.key("Kind", number) for number in (20, 3, 999, 7, 1, 3)]
+	missing = []
+	entities = client.get_multi(keys, missing=missing)
+	assert [entity.key.id for entity in entities] == [20, 3, 7, 1, 3]
+	assert [entity.key for entity in missing] == [client.key("Kind", 999)]
+
+
+@pytest.mark.parametrize("deferred", [None, []])
+def test_failed_chunk_cancels_the_others(deferred):
+	client = _client()
+	driver = client.driver
+	get_multi = driver.get_multi
+	started = []
+	lock = threading.Lock()
+
+	def failing_get_multi(keys, transaction=None):
+		with lock:
+			started.append(keys)
+		if keys[0].id == 1:
+			raise RuntimeError("lookup failed")
+		time.sleep(0.05)
+		return get_multi(keys, transaction=transaction)
+
+	driver.get_multi = failing_get_multi
+	keys = [client.key("Kind", number + 1) for number in range(20)]
+	with pytest.raises(RuntimeError):
+		client.get_multi(keys, deferred=deferred)
+	time.sleep(0.3)
+	# Only the chunks already running when the first one failed were fetched.
+	assert len(started) <= 3
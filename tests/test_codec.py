@@ -0,0 +1,138 @@
+import datetime
+import io
+import pickle
+
+import pytest
+
+from viur.database.datastore.codec import (
+	LazyEntity,
+	decode_entities,
+	decode_entity,
+	encode_entities,
+	encode_entity,
+)
+from viur.database.datastore.entity import Entity
+from viur.database.datastore.geopoint import GeoPoint
+from viur.database.datastore.key import Key
+
+
+def _entity():
+	entity = Entity(
+		Key("Parent", "p", "Kind", 42, project="proj", namespace="ns"),
+		exclude_from_indexes=("text",),
+	)
+	nested = Entity()
+	nested["inner"] = [1, "two"]
+	entity.update({
+		"none": None,
+		"false": False,
+		"true": True,
+		"int": 7,
+		"negative": -(1 << 70),
+		"zero": 0,
+		"float": -2.5,
+		"str": "hällo",
+		"text": "x" * 1000,
+		"bytes": b"\x00\xff",
+		"naive": datetime.datetime(1901, 2, 3, 4, 5, 6, 7),
+		"aware": datetime.datetime(2020, 1, 2, 3, 4, 5, 6, tzinfo=datetime.timezone.utc),
+		"geo": GeoPoint(-12.5, 130.25),
+		"key": Key("Other", "name", project="proj"),
+		"list": [1, 2.0, "three", None, [True]],
+		"empty_list": [],
+		"dict": {"a": {"b": [b"c"]}},
+		"nested": nested,
+	})
+	return entity
+
+
+def _assert_same(decoded, entity):
+	assert decoded.key == entity.key
+	assert decoded.key.flat_path == entity.key.flat_path
+	assert set(decoded.exclude_from_indexes) == set(entity.exclude_from_indexes)
+	assert dict(decoded) == dict(entity)
+	for name, value in entity.items():
+		assert type(decoded[name]) is type(value), name
+
+
+def test_round_trip():
+	entity = _entity()
+	decoded = decode_entity(encode_entity(entity))
+	_assert_same(decoded, entity)
+	assert decoded["aware"].tzinfo is datetime.timezone.utc
+	assert decoded["naive"].tzinfo is None
+	assert decoded["nested"].key is None
+
+
+def test_round_trip_keyless_and_empty():
+	entity = Entity()
+	decoded = decode_entity(encode_entity(entity))
+	assert decoded.key is None and dict(decoded) == {}
+
+
+def test_projection():
+	decoded = decode_entity(encode_entity(_entity()), projection=["int", "str"])
+	assert dict(decoded) == {"int": 7, "str": "hällo"}
+
+
+def test_invalid_encodings():
+	raw_bytes = encode_entity(_entity())
+	with pytest.raises(ValueError):
+		decode_entity(b"\x09" + raw_bytes[1:])
+	with pytest.raises(ValueError):
+		decode_entity(raw_bytes[:-3])
+	with pytest.raises(ValueError):
+		decode_entity(raw_bytes + b"\x00")
+	entity = Entity()
+	entity["object"] = object()
+	with pytest.raises(TypeError):
+		encode_entity(entity)
+
+
+@pytest.mark.parametrize("wrap", [bytes, memoryview])
+def test_lazy_entity(wrap):
+	entity = _entity()
+	lazy = LazyEntity(wrap(encode_entity(entity)))
+	assert lazy.is_lazy
+	assert list(lazy) == list(entity)
+	assert lazy["int"] == 7
+	assert lazy.get("missing", "default") == "default"
+	assert lazy.is_lazy
+	_assert_same(lazy, entity)
+	assert lazy == entity
+
+
+def test_lazy_entity_mutation_decodes_everything():
+	lazy = LazyEntity(encode_entity(_entity()))
+	lazy["int"] = 8
+	assert not lazy.is_lazy
+	expected = _entity()
+	expected["int"] = 8
+	assert dict(lazy) == dict(expected)
+
+
+def test_lazy_entity_projection_and_pickle():
+	lazy = LazyEntity(encode_entity(_entity()), projection=["geo", "list"])
+	assert sorted(lazy) == ["geo", "list"]
+	unpickled = pickle.loads(pickle.dumps(lazy))
+	assert type(unpickled) is Entity
+	assert dict(unpickled) == dict(lazy)
+	assert unpickled.key == lazy.key
+
+
+@pytest.mark.parametrize("lazy", [False, True])
+def test_stream_round_trip(lazy):
+	entities = [_entity() for _ in range(5)]
+	for number, entity in enumerate(entities):
+		entity["int"] = number
+	encoded = b"".join(encode_entities(entities))
+
+	decoded = list(decode_entities(encoded, lazy=lazy))
+	assert [entity["int"] for entity in decoded] == list(range(5))
+	# Chunks smaller than an entity are joined.
+	decoded = list(decode_entities(io.BytesIO(encoded), chunk_size=7, lazy=lazy))
+	for got, entity in zip(decoded, entities):
+		_assert_same(got, entity)
+
+	with pytest.raises(ValueError):
+		list(decode_entities(io.BytesIO(encoded[:-1]), chunk_size=100))
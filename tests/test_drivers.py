@@ -0,0 +1,170 @@
+import os
+
+import pytest
+
+from viur.database.datastore.client import Client
+from viur.database.datastore.entity import Entity
+from viur.database.datastore.geopoint import GeoPoint
+from viur.database.datastore.helpers import key_token
+
+
+def _fill(client):
+	parent = client.key("Parent", "root")
+	entities = []
+	for number in range(30):
+		if number % 4 == 0:
+			key = client.key("Item", "name%02d" % number, parent=parent)
+		else:
+			key = client.key("Item", number + 1)
+		entity = Entity(key)
+		entity["n"] = number % 7
+		entity["s"] = "abc"[number % 3]
+		entity["tags"] = ["x", "y"] if number % 2 else ["y"]
+		entity["b"] = number % 5 == 0
+		entity["f"] = number / 4.0
+		if number % 6:
+			entity["maybe"] = None if number % 2 else number
+		entities.append(entity)
+	client.put_multi(entities)
+
+
+@pytest.fixture(scope="module")
+def clients(tmp_path_factory):
+	path = os.path.join(str(tmp_path_factory.mktemp("drivers")), "test.db")
+	memory = Client(project="test", driver="memory")
+	sqlite = Client(project="test", driver="sqlite", driver_options={"path": path})
+	for client in (memory, sqlite):
+		_fill(client)
+	return memory, sqlite
+
+
+QUERIES = [
+	dict(),
+	dict(filters=[("n", "=", 3)]),
+	dict(filters=[("n", ">=", 5)]),
+	dict(filters=[("n", ">", 1), ("n", "<", 4)]),
+	dict(filters=[("s", "=", "b")]),
+	dict(filters=[("tags", "=", "x")]),
+	dict(filters=[("b", "=", True)]),
+	dict(filters=[("f", ">", 2.5)]),
+	dict(filters=[("maybe", "=", None)]),
+	dict(filters=[("s", "=", "a"), ("n", ">", 2)]),
+	dict(order=["n"]),
+	dict(order=["-n"]),
+	dict(order=["s", "-n"]),
+	dict(order=["-f"]),
+	dict(order=["maybe"]),
+	dict(order=["-__key__"]),
+	dict(filters=[("n", ">", 2)], order=["-n", "s"]),
+	dict(ancestor=("Parent", "root")),
+	dict(ancestor=("Parent", "root"), order=["-n"]),
+	dict(ancestor=("Parent", "root"), filters=[("s", "=", "a")]),
+	dict(projection=["n"], order=["n"]),
+]
+
+
+def _with_ancestor(client, arguments):
+	arguments = dict(arguments)
+	if "ancestor" in arguments:
+		arguments["ancestor"] = client.key(*arguments["ancestor"])
+	return arguments
+
+
+def _run(client, arguments, **fetch_arguments):
+	query = client.query(kind="Item", **_with_ancestor(client, arguments))
+	return [(entity.key, dict(entity)) for entity in query.fetch(**fetch_arguments)]
+
+
+@pytest.mark.parametrize("arguments", QUERIES)
+def test_same_results(clients, arguments):
+	memory, sqlite = clients
+	expected = _run(memory, arguments)
+	assert expected
+	assert _run(sqlite, arguments) == expected
+
+
+@pytest.mark.parametrize("arguments", QUERIES)
+def test_same_limit_and_offset(clients, arguments):
+	memory, sqlite = clients
+	expected = _run(memory, arguments)[3:8]
+	assert _run(memory, arguments, offset=3, limit=5) == expected
+	assert _run(sqlite, arguments, offset=3, limit=5) == expected
+
+
+@pytest.mark.parametrize("arguments", QUERIES)
+def test_cursors_resume(clients, arguments):
+	for client in clients:
+		expected = _run(client, arguments)
+		query = client.query(kind="Item", **_with_ancestor(client, arguments))
+		results = []
+		cursor = None
+		while True:
+			iterator = query.fetch(start_cursor=cursor, limit=4)
+			results.extend((entity.key, dict(entity)) for entity in iterator)
+			cursor = iterator.next_page_token
+			if cursor is None:
+				break
+		assert results == expected
+
+
+def test_end_cursor(clients):
+	for client in clients:
+		query = client.query(kind="Item", order=["n"])
+		iterator = query.fetch(limit=10)
+		head = [entity.key for entity in iterator]
+		stop = iterator.next_page_token
+		assert [entity.key for entity in query.fetch(end_cursor=stop)] == head
+
+
+def test_ancestor_includes_only_descendants(clients):
+	for client in clients:
+		results = _run(client, dict(ancestor=("Parent", "root")))
+		assert len(results) == 8
+		assert all(key.parent == client.key("Parent", "root") for key, _ in results)
+
+
+def test_key_order(clients):
+	for client in clients:
+		keys = [key for key, _ in _run(client, dict())]
+		assert keys == sorted(keys, key=key_token)
+
+
+def test_memory_driver_copies_nested_values():
+	client = Client(project="test", driver="memory")
+	nested = Entity()
+	nested["list"] = [1]
+	entity = Entity(client.key("Kind", 1))
+	entity.update({"dict": {"value": 1}, "nested": nested, "list": [{"value": 1}]})
+	client.put(entity)
+	entity["dict"]["value"] = 2
+	entity["nested"]["list"].append(2)
+	entity["list"][0]["value"] = 2
+
+	stored = client.get(entity.key)
+	assert stored["dict"] == {"value": 1}
+	assert stored["nested"]["list"] == [1]
+	assert stored["list"] == [{"value": 1}]
+	stored["dict"]["value"] = 3
+	assert client.get(entity.key)["dict"] == {"value": 1}
+
+
+def test_geopoint_order(clients):
+	points = [(-1.0, 0.0), (-2.0, 5.0), (10.0, 1.0), (9.0, -3.0), (9.0, 3.0), (-0.0, -1.0)]
+	results = []
+	for client in clients:
+		entities = []
+		for number, (latitude, longitude) in enumerate(points):
+			entity = Entity(client.key("Geo", number + 1))
+			entity["point"] = GeoPoint(latitude, longitude)
+			entities.append(entity)
+		client.put_multi(entities)
+		results.append([
+			[entity.key.id for entity in client.query(kind="Geo", **arguments).fetch()]
+			for arguments in (
+				dict(order=["point"]),
+				dict(order=["-point"]),
+				dict(filters=[("point", ">", GeoPoint(0.0, 0.0))]),
+			)
+		])
+	assert results[0][0] == [2, 1, 6, 4, 5, 3]
+	assert results[0] == results[1]
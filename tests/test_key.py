@@ -0,0 +1,93 @@
+import base64
+import itertools
+import json
+import random
+
+import pytest
+
+from viur.database.datastore.helpers import key_token
+from viur.database.datastore.key import Key, decode_path, encode_path
+
+
+def _paths():
+	kinds = ["", "a", "a\x00", "a\x00b", "ab", "b", "\xe9", "€", "\U0001f600"]
+	ids = [-(1 << 63), -1, 0, 1, 255, 256, (1 << 63) - 1]
+	names = ["", "\x00", "a", "a\x00", "a\xff", "b", "€"]
+	elements = [
+		(kind, id_or_name) for kind in kinds for id_or_name in ids + names
+	]
+	random.seed(1)
+	paths = list(elements)
+	for _ in range(300):
+		depth = random.randint(2, 3)
+		paths.append(
+			tuple(itertools.chain.from_iterable(random.choice(elements) for _ in range(depth)))
+		)
+	return paths
+
+
+PATHS = _paths()
+
+
+def test_encode_path_order_matches_key_order():
+	keys = [Key(*path, project="p") for path in PATHS]
+	by_token = sorted(keys, key=key_token)
+	by_bytes = sorted(keys, key=lambda key: encode_path(key.flat_path))
+	assert [key.flat_path for key in by_bytes] == [key.flat_path for key in by_token]
+
+
+def test_encoded_descendants_share_prefix():
+	for path in PATHS:
+		encoded = encode_path(path)
+		child = encode_path(path + ("Child", 1))
+		assert child.startswith(encoded)
+		assert encoded <= child < encoded + b"\xff"
+
+
+@pytest.mark.parametrize("path", PATHS[::7])
+def test_decode_path_round_trip(path):
+	assert decode_path(encode_path(path)) == path
+	key = Key(*path, project="p", namespace="ns")
+	assert Key.from_ordered_bytes(key.to_ordered_bytes(), "p", "ns") == key
+
+
+def test_encode_path_rejects_out_of_range_ids():
+	with pytest.raises(ValueError):
+		encode_path(("Kind", 1 << 63))
+	with pytest.raises(ValueError):
+		decode_path(b"Kind\x00\x01\x03")
+
+
+@pytest.mark.parametrize("path", PATHS[::7] + [("Kind",), ("Parent", "p", "Kind")])
+@pytest.mark.parametrize("namespace", [None, "", "ns"])
+def test_legacy_urlsafe_round_trip(path, namespace):
+	key = Key(*path, project="proj", namespace=namespace)
+	urlsafe = key.to_legacy_urlsafe()
+	assert b"=" not in urlsafe
+	padded = urlsafe + b"=" * (-len(urlsafe) % 4)
+	for encoded in (urlsafe, urlsafe.decode(), padded):
+		decoded = Key.from_legacy_urlsafe(encoded)
+		# Partial keys never compare equal, so compare their parts.
+		assert decoded.flat_path == key.flat_path
+		assert decoded.project == key.project
+		assert decoded.namespace == key.namespace
+
+
+def test_legacy_urlsafe_location_prefix():
+	key = Key("Kind", 1, project="proj")
+	decoded = Key.from_legacy_urlsafe(key.to_legacy_urlsafe("s~"))
+	assert decoded.project == "s~proj"
+	assert decoded.flat_path == key.flat_path
+
+
+def test_legacy_urlsafe_reads_json_encoding():
+	raw_bytes = json.dumps([["Parent", "p", "Kind", 7], "proj", "ns"]).encode()
+	urlsafe = base64.urlsafe_b64encode(raw_bytes).rstrip(b"=")
+	assert Key.from_legacy_urlsafe(urlsafe) == Key(
+		"Parent", "p", "Kind", 7, project="proj", namespace="ns"
+	)
+
+
+def test_legacy_urlsafe_rejects_garbage():
+	with pytest.raises(ValueError):
+		Key.from_legacy_urlsafe(b"!!!!")
@@ -0,0 +1,155 @@
+import logging
+
+import pytest
+
+from viur.database.datastore.cache import EntityCache
+from viur.database.datastore.client import Client
+from viur.database.datastore.entity import Entity
+from viur.database.datastore.memcache import MemcacheClient, MemcacheEntityCache
+
+from memcached_server import MemcachedServer
+
+
+@pytest.fixture
+def servers():
+	servers = [MemcachedServer(), MemcachedServer()]
+	yield servers
+	for server in servers:
+		server.stop()
+
+
+@pytest.fixture
+def memcache(servers):
+	client = MemcacheClient([server.address for server in servers])
+	yield client
+	client.close()
+
+
+@pytest.fixture
+def shared_cache(servers):
+	cache = MemcacheEntityCache([server.address for server in servers], ttl=60, hold=2)
+	yield cache
+	cache.close()
+
+
+def test_set_and_get_multi(memcache, servers):
+	items = [(b"key%d" % number, b"value%d" % number) for number in range(50)]
+	memcache.set_multi(items)
+	assert memcache.get_multi([key for key, _ in items] + [b"missing"]) == dict(items)
+	# The keys are spread over both servers.
+	assert all(server.values for server in servers)
+
+
+def test_get_multi_is_batched_per_server(memcache, servers):
+	keys = [b"key%d" % number for number in range(500)]
+	memcache.set_multi([(key, b"v") for key in keys])
+	assert len(memcache.get_multi(keys)) == 500
+	for server in servers:
+		stored = len(server.values)
+		assert [len(keys) for keys in server.gets] == (
+			[100] * (stored // 100) + ([stored % 100] if stored % 100 else [])
+		)
+
+
+def test_add_multi_keeps_existing_values(memcache):
+	memcache.set_multi([(b"a", b"old")])
+	memcache.add_multi([(b"a", b"new"), (b"b", b"new")])
+	assert memcache.get_multi([b"a", b"b"]) == {b"a": b"old", b"b": b"new"}
+
+
+def test_values_expire(memcache, servers):
+	memcache.set_multi([(b"a", b"value")], expire=5)
+	assert memcache.get_multi([b"a"]) == {b"a": b"value"}
+	for server in servers:
+		server.advance(6)
+	assert memcache.get_multi([b"a"]) == {}
+
+
+def _entities(client, count):
+	entities = []
+	for number in range(count):
+		entity = Entity(client.key("Kind", number + 1))
+		entity["value"] = number
+		entities.append(entity)
+	return entities
+
+
+def test_entity_cache_round_trip(shared_cache):
+	client = Client(project="test", driver="memory")
+	entities = _entities(client, 150)
+	shared_cache.fill(entities)
+	keys = [entity.key for entity in entities] + [client.key("Kind", 999)]
+	found, missing = shared_cache.lookup(keys + keys[:3])
+	assert missing == [client.key("Kind", 999)]
+	assert [found[entity.key] for entity in entities] == entities
+	assert shared_cache.stats["hits"] == 150
+
+
+def test_tombstone_blocks_refill_until_hold_ends(shared_cache, servers):
+	client = Client(project="test", driver="memory")
+	entity = _entities(client, 1)[0]
+	shared_cache.fill([entity])
+	shared_cache.invalidate([entity.key])
+	assert shared_cache.lookup([entity.key]) == ({}, [entity.key])
+
+	# A lookup which read the old state can't put it back after the write.
+	stale = entity.copy()
+	stale["value"] = "stale"
+	shared_cache.fill([stale])
+	assert shared_cache.lookup([entity.key]) == ({}, [entity.key])
+
+	for server in servers:
+		server.advance(shared_cache.hold + 1)
+	shared_cache.fill([entity])
+	assert shared_cache.lookup([entity.key])[0] == {entity.key: entity}
+
+
+def test_long_keys_are_hashed(shared_cache):
+	client = Client(project="test", driver="memory")
+	first = Entity(client.key("Kind", "x" * 300))
+	second = Entity(client.key("Kind", "x" * 299 + "y"))
+	first["value"], second["value"] = 1, 2
+	cache_keys = [shared_cache._cache_key(entity.key) for entity in (first, second)]
+	assert all(len(cache_key) <= 250 for cache_key in cache_keys)
+	assert cache_keys[0] != cache_keys[1]
+
+	shared_cache.fill([first, second])
+	found, missing = shared_cache.lookup([first.key, second.key])
+	assert missing == []
+	assert found[first.key]["value"] == 1 and found[second.key]["value"] == 2
+
+
+def test_unreachable_server_counts_as_miss(caplog):
+	server = MemcachedServer()
+	address = server.address
+	server.stop()
+	cache = MemcacheEntityCache([address], timeout=0.2)
+	client = Client(project="test", driver="memory")
+	with caplog.at_level(logging.CRITICAL):
+		found, missing = cache.lookup([client.key("Kind", 1)])
+		cache.fill(_entities(client, 1))
+		cache.invalidate([client.key("Kind", 1)])
+	assert (found, missing) == ({}, [client.key("Kind", 1)])
+	assert cache.stats["errors"] == 3
+	cache.close()
+
+
+def test_client_uses_shared_cache(shared_cache, servers):
+	client = Client(
+		project="test", driver="memory", cache=EntityCache(), shared_cache=shared_cache
+	)
+	entities = _entities(client, 3)
+	client.put_multi(entities)
+	for server in servers:
+		server.advance(shared_cache.hold + 1)  # the put left tombstones
+	assert client.get_multi([entity.key for entity in entities]) == entities
+	assert shared_cache.stats["misses"] == 3
+
+	# Another process shares the memcached entries but not the local cache.
+	other = Client(project="test", driver=client.driver, shared_cache=shared_cache)
+	assert other.get(entities[0].key) == entities[0]
+	assert shared_cache.stats["hits"] == 1
+
+	entities[0]["value"] = "changed"
+	client.put(entities[0])
+	assert other.get(entities[0].key)["value"] == "changed"
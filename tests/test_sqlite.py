@@ -0,0 +1,53 @@
+import os
+import threading
+
+import pytest
+
+from viur.database.datastore.client import Client
+from viur.database.datastore.entity import Entity
+
+
+@pytest.mark.parametrize("name", ["a#b.db", "c?d.db", "e%20f.db", "g h.db"])
+def test_path_is_not_parsed_as_uri(tmp_path, name):
+	path = os.path.join(str(tmp_path), name)
+	client = Client(project="test", driver="sqlite", driver_options={"path": path})
+	client.put(Entity(client.key("Kind", 1)))
+	client.driver.close()
+	assert os.listdir(str(tmp_path)) == [name]
+
+	client = Client(project="test", driver="sqlite", driver_options={"path": path})
+	assert client.get(client.key("Kind", 1)) is not None
+	client.driver.close()
+
+
+@pytest.mark.parametrize("in_memory", [True, False])
+def test_concurrent_threads(tmp_path, in_memory):
+	options = {} if in_memory else {"path": os.path.join(str(tmp_path), "test.db")}
+	client = Client(project="test", driver="sqlite", driver_options=options)
+	errors = []
+
+	def work(number):
+		kind = "Kind%d" % (number % 3)
+		try:
+			for step in range(20):
+				entity = Entity(client.key(kind, number * 100 + step + 1))
+				entity["value"] = step
+				client.put(entity)
+				list(client.query(kind=kind, filters=[("value", ">", 3)]).fetch())
+				with client.transaction() as transaction:
+					entity = client.get(entity.key)
+					entity["value"] += 1
+					transaction.put(entity)
+		except Exception as exc:
+			errors.append(exc)
+
+	threads = [threading.Thread(target=work, args=(number,)) for number in range(8)]
+	for thread in threads:
+		thread.start()
+	for thread in threads:
+		thread.join()
+	assert errors == []
+	assert sum(
+		len(list(client.query(kind="Kind%d" % number).fetch())) for number in range(3)
+	) == 160
+	client.driver.close()